@@ -1,13 +1,17 @@
 # app.py - Main application file
 from flask import Flask
 from flask_cors import CORS
+from compression import init_compression
+from json_provider import JSONProvider
 from routes import setup_routes
 from models import Base, engine
 
 
 def create_app():
     app = Flask(__name__)
+    app.json = JSONProvider(app)
     CORS(app)
+    init_compression(app)
 
     # Initialize the database
     Base.metadata.create_all(bind=engine)
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from config import Config
+from natlang import convert_and_describe_async, convert_query_async
+from sqlparser import split_statements
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
+
+
+# Convert and execute a list of natural language prompts against one schema, yielding each
+# item's result as it finishes. At most `concurrency` prompts are in flight at once, and SQL
+# runs on no more pooled connections than the pool allows; execute(queries) runs the statements
+async def run_batch(
+    prompts,
+    schema,
+    execute,
+    analyze=False,
+    use_cache=True,
+    concurrency=Config.BATCH_CONCURRENCY,
+):
+    llm_slots = asyncio.Semaphore(concurrency)
+    db_slots = asyncio.Semaphore(min(concurrency, Config.POOL_MAX_SIZE))
+
+    async def run_item(index, prompt):
+        started = time.perf_counter()
+        item = {"index": index, "prompt": prompt}
+        timings = item["timings"] = {}
+        try:
+            async with llm_slots:
+                timings["queuedMs"] = elapsed_ms(started)
+                llm_started = time.perf_counter()
+                if analyze:
+                    answer = await convert_and_describe_async(prompt, schema, use_cache)
+                    item["name"] = answer["name"]
+                    item["description"] = answer["description"]
+                    sql = answer["sql"]
+                else:
+                    sql = await convert_query_async(prompt, schema, use_cache)
+                timings["llmMs"] = elapsed_ms(llm_started)
+            if not sql:
+                raise ValueError("Failed to generate SQL command(s) from the query")
+            async with db_slots:
+                execute_started = time.perf_counter()
+                item["results"] = await asyncio.to_thread(execute, split_statements(sql))
+                timings["executeMs"] = elapsed_ms(execute_started)
+        except Exception as e:
+            # Statement failures carry the statement, as routes.SQLExecutionError does
+            if getattr(e, "query", None):
+                item["error"] = f"SQL Execution Error: {e}"
+                item["query"] = e.query
+            else:
+                item["error"] = str(e)
+        timings["totalMs"] = elapsed_ms(started)
+        return item
+
+    tasks = [asyncio.ensure_future(run_item(i, p)) for i, p in enumerate(prompts)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Drive an async iterator from synchronous code, such as a streamed response body, on its own event loop
+def iterate_sync(async_iterator):
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.close()
@@ -0,0 +1,66 @@
+# Benchmark serializing wide result sets: the old per-value conversion plus the stdlib encoder,
+# against the JSON provider with and without orjson
+#
+# Run from backend/:
+#   python benchmarks/bench_json.py --rows 50000 --columns 20
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask  # noqa: E402
+from json_provider import JSONProvider, default  # noqa: E402
+
+
+def build_rows(rows, columns):
+    values = [
+        lambda i: i,
+        lambda i: f"name {i}",
+        lambda i: Decimal(i) / 100,
+        lambda i: datetime(2024, 1, 1) + timedelta(seconds=i),
+        lambda i: date(2024, 1, 1) + timedelta(days=i % 365),
+        lambda i: uuid.UUID(int=i),
+        lambda i: None,
+    ]
+    return [{f"c{j}": values[j % len(values)](i) for j in range(columns)} for i in range(rows)]
+
+
+# How /table-details rendered rows before the provider: convert every value, then encode
+def legacy(rows):
+    converted = [dict((k, default(v) if v is not None and not isinstance(v, (int, str)) else v) for k, v in row.items()) for row in rows]
+    return json.dumps(converted, sort_keys=True)
+
+
+def timed(label, rows, run):
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<30} {elapsed * 1000:10.1f} ms {len(rows) / elapsed:12.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--columns", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = build_rows(args.rows, args.columns)
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+
+    timed("convert_value + json.dumps", rows, lambda: legacy(rows))
+    with patch("json_provider.orjson", None):
+        timed("provider (stdlib)", rows, lambda: app.json.dumps(rows))
+    timed("provider (orjson)", rows, lambda: app.json.dumps(rows))
+    timed("provider (orjson, unsorted)", rows, lambda: app.json.dumps(rows, sort_keys=False))
+
+
+if __name__ == "__main__":
+    main()
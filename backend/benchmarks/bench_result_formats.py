@@ -0,0 +1,60 @@
+# Benchmark the result shapes /queries and /table-details can return: payload size, encode time
+# and client decode time for rows as objects, columnar JSON and an Arrow IPC stream
+#
+# Run from backend/:
+#   python benchmarks/bench_result_formats.py --rows 100000 --columns 12
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask  # noqa: E402
+from json_provider import JSONProvider  # noqa: E402
+from result_formats import arrow_available, pyarrow, rows_to_arrow, to_columnar  # noqa: E402
+from bench_json import build_rows  # noqa: E402
+
+
+def timed(run):
+    start = time.perf_counter()
+    result = run()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def report(label, encode, decode):
+    payload, encode_ms = timed(encode)
+    _, decode_ms = timed(lambda: decode(payload))
+    print(f"{label:<12} {len(payload) / 1e6:10.2f} MB {encode_ms:10.1f} ms encode {decode_ms:10.1f} ms decode")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--columns", type=int, default=12)
+    args = parser.parse_args()
+
+    rows = build_rows(args.rows, args.columns)
+    columns = list(rows[0])
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+
+    report("rows", lambda: app.json.dumps(rows, sort_keys=False).encode(), json.loads)
+    report(
+        "columnar",
+        lambda: app.json.dumps(to_columnar(rows, columns), sort_keys=False).encode(),
+        json.loads,
+    )
+    if arrow_available():
+        report(
+            "arrow",
+            lambda: rows_to_arrow(columns, rows),
+            lambda data: pyarrow.ipc.open_stream(data).read_all(),
+        )
+    else:
+        print("arrow        skipped, pyarrow is not installed")
+
+
+if __name__ == "__main__":
+    main()
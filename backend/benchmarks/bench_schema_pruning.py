@@ -0,0 +1,105 @@
+# Benchmark schema pruning: prompt size with and without it, and the cost of indexing and selection
+#
+# Run from backend/:
+#   python benchmarks/bench_schema_pruning.py --tables 400
+# Add --live to also time convert_query end to end against the OpenAI API (needs OPENAI_API_KEY)
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import natlang  # noqa: E402
+from natlang import format_schema  # noqa: E402
+from schema_index import SchemaIndex, prune_schema  # noqa: E402
+
+ENTITIES = [
+    "customer", "order", "order_item", "product", "category", "supplier", "warehouse", "shipment",
+    "invoice", "payment", "refund", "employee", "department", "salary", "review", "coupon",
+    "campaign", "address", "store", "inventory", "return", "vendor", "contract", "ticket",
+]
+COLUMNS = ["name", "status", "created_at", "updated_at", "amount", "notes", "code", "region"]
+
+PROMPTS = [
+    "Show the ten customers with the most orders last month",
+    "Total payment amount per invoice status",
+    "Which warehouses have inventory below 100 units for each product?",
+    "List employees in the sales department with their salary",
+    "Average review score per product category",
+]
+
+
+# Schemas of --tables tables spread over a few schemas, each with a few foreign keys to earlier tables
+def build_schema(table_count):
+    rng = random.Random(0)
+    schema, names = {}, []
+    for i in range(table_count):
+        schema_name = f"s{i % 8}"
+        table = f"{ENTITIES[i % len(ENTITIES)]}_{i // len(ENTITIES)}"
+        columns = [
+            {"name": "id", "type": "integer", "nullable": False, "default": None,
+             "primary_key": True, "foreign_keys": [], "description": None}
+        ]
+        for column in rng.sample(COLUMNS, 5):
+            columns.append(
+                {"name": column, "type": "text", "nullable": True, "default": None,
+                 "primary_key": False, "foreign_keys": [],
+                 "description": f"The {column.replace('_', ' ')} of the {table.split('_')[0]}"}
+            )
+        for target in rng.sample(names, min(len(names), 2)):
+            columns.append(
+                {"name": f"{target.split('.')[1]}_id", "type": "integer", "nullable": True,
+                 "default": None, "primary_key": False,
+                 "foreign_keys": [{"table": target, "column": "id"}], "description": None}
+            )
+        schema.setdefault(schema_name, {})[table] = columns
+        names.append(f"{schema_name}.{table}")
+    return schema
+
+
+# Rough token count; prompts are English and identifiers, which average about four characters a token
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=400)
+    parser.add_argument("--top-k", type=int, default=12)
+    parser.add_argument("--live", action="store_true", help="Also time convert_query against the OpenAI API")
+    args = parser.parse_args()
+
+    schema = build_schema(args.tables)
+    full_tokens = estimate_tokens(format_schema(schema))
+    print(f"{args.tables} tables, full schema ~{full_tokens} tokens")
+
+    start = time.perf_counter()
+    SchemaIndex(schema)
+    print(f"index build                  {(time.perf_counter() - start) * 1000:10.1f} ms")
+
+    for prompt in PROMPTS:
+        start = time.perf_counter()
+        pruned = prune_schema(schema, prompt, top_k=args.top_k, min_tables=0)
+        elapsed = time.perf_counter() - start
+        tables = sum(len(t) for t in pruned.values())
+        tokens = estimate_tokens(format_schema(pruned))
+        print(
+            f"{tables:4d} tables ~{tokens:6d} tokens ({tokens / full_tokens:6.1%} of full) "
+            f"{elapsed * 1000:7.2f} ms  {prompt}"
+        )
+
+    if args.live:
+        unpruned = natlang.prune_schema
+        for label, prune in [("full schema", lambda schema, prompt: schema), ("pruned", unpruned)]:
+            natlang.prune_schema = prune
+            start = time.perf_counter()
+            for prompt in PROMPTS:
+                natlang.convert_query(prompt, schema, use_cache=False)
+            print(f"convert_query, {label:<13} {(time.perf_counter() - start) / len(PROMPTS) * 1000:10.1f} ms avg")
+        natlang.prune_schema = unpruned
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Benchmark the SQL lexer, statement splitter and statement parser on large multi-statement scripts
+#
+# Run from backend/:
+#   python benchmarks/bench_sqlparser.py --statements 20000
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlparser import StatementSplitter, parse_statement, split_statements, tokenize  # noqa: E402
+
+TEMPLATES = [
+    "SELECT c.id, c.name, count(o.id) FROM sales.customers c LEFT JOIN sales.orders o ON o.customer_id = c.id "
+    "WHERE c.region = 'north;east' GROUP BY c.id, c.name ORDER BY 3 DESC LIMIT {n}",
+    "INSERT INTO audit.events (kind, payload) VALUES ('login', '{{\"id\": {n}, \"note\": \"it''s; ok\"}}')",
+    "UPDATE inventory.items SET qty = qty - 1 WHERE id = {n} AND qty > 0",
+    "DELETE FROM public.sessions WHERE expires_at < now() - interval '{n} minutes'",
+    "WITH recent AS (SELECT * FROM sales.orders WHERE placed > now() - interval '1 day') "
+    "SELECT * FROM recent r JOIN sales.customers c ON c.id = r.customer_id WHERE r.total > {n}",
+    "CREATE FUNCTION f{n}() RETURNS int AS $$ BEGIN RETURN {n}; END; $$ LANGUAGE plpgsql",
+    "/* report; block */ SELECT E'line\\'s; end', \"Odd;Name\" FROM \"Reports\" -- trailing; comment\n",
+]
+
+
+def build_script(statements):
+    rng = random.Random(0)
+    return ";\n".join(rng.choice(TEMPLATES).format(n=i) for i in range(statements)) + ";"
+
+
+def timed(label, size, run):
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:10.1f} ms {size / elapsed / 1e6:8.2f} MB/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--statements", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=16, help="Chunk size for the incremental splitter")
+    args = parser.parse_args()
+
+    script = build_script(args.statements)
+    size = len(script)
+    print(f"{args.statements} statements, {size / 1e6:.2f} MB")
+
+    timed("naive str.split(';')", size, lambda: [s for s in script.split(";") if s.strip()])
+    timed("tokenize", size, lambda: sum(1 for _ in tokenize(script)))
+    statements = timed("split_statements", size, lambda: split_statements(script))
+
+    def incremental():
+        splitter, found = StatementSplitter(), []
+        for pos in range(0, size, args.chunk_size):
+            found += splitter.feed(script[pos: pos + args.chunk_size])
+        return found + splitter.finish()
+
+    timed(f"StatementSplitter ({args.chunk_size} B chunks)", size, incremental)
+    parse_statement.cache_clear()
+    timed("parse_statement (each)", size, lambda: [parse_statement(s) for s in statements])
+
+    # Doubling the input should roughly double the time if the splitter is linear
+    doubled = script + "\n" + script
+    start = time.perf_counter()
+    split_statements(script)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    split_statements(doubled)
+    print(f"2x input time ratio:         {(time.perf_counter() - start) / single:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
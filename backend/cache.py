@@ -0,0 +1,215 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache with an optional time-to-live and hit/miss counters
+# With maxbytes set, entries are also evicted to keep the total of sizeof(value) within it
+class TTLCache:
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        # Maps key -> (value, stored_at, size), least recently used first
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Look up a key, treating expired entries and entries rejected by validate as misses
+    def get(self, key, default=None, validate=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None and validate is not None and not validate(entry[0]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    # Look up a key without touching the counters or the LRU order
+    def peek(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            return default if entry is None else entry[0]
+
+    # Seconds since the entry for key was stored, or None if it is not cached
+    def age(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+            return None if entry is None else time.monotonic() - entry[1]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.maxbytes else 0
+        with self._lock:
+            if self.maxbytes and size > self.maxbytes:
+                # Too large to ever fit; do not flush everything else for it
+                self._remove(key)
+                return
+            self._remove(key)
+            self._data[key] = (value, time.monotonic(), size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes and self.bytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._data),
+                **({"bytes": self.bytes} if self.maxbytes else {}),
+            }
+
+    # Drop every entry for which predicate(key, value) is true, returning how many were dropped
+    def discard(self, predicate):
+        with self._lock:
+            stale = [key for key, entry in self._data.items() if predicate(key, entry[0])]
+            for key in stale:
+                self._remove(key)
+            return len(stale)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+
+
+# Persistent cache tier backed by a SQLite file, so entries survive restarts
+# Values must be strings; callers serialize anything richer themselves
+class SQLiteCache:
+    def __init__(self, path, ttl=None, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, stored_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and time.time() - row[1] > self.ttl:
+                self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self._writes += 1
+            # Trim the oldest entries now and then rather than on every write
+            if self.maxsize and self._writes % 100 == 0:
+                self._connection.execute(
+                    "DELETE FROM cache WHERE key NOT IN "
+                    "(SELECT key FROM cache ORDER BY stored_at DESC LIMIT ?)",
+                    (self.maxsize,),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache")
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute("SELECT count(*) FROM cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "size": size,
+            }
+
+
+# An in-memory TTLCache in front of an optional persistent tier; disk hits are copied into memory
+class TieredCache:
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        memory = self.memory.stats()
+        disk = self.disk.stats() if self.disk is not None else None
+        hits = memory["hits"] + (disk["hits"] if disk else 0)
+        # A memory miss that the disk tier answered is still a hit overall
+        misses = disk["misses"] if disk else memory["misses"]
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hitRate": hits / lookups if lookups else 0.0,
+            "memory": memory,
+            "disk": disk,
+        }
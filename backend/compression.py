@@ -0,0 +1,181 @@
+import threading
+import time
+import zlib
+from flask import request
+from config import Config
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard is optional
+    zstandard = None
+
+# Levels favour speed: responses are compressed on every request, not once ahead of time
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/vnd.",
+    "application/javascript",
+)
+
+
+# Each encoder returns (compress, flush, finish): compress(data) -> bytes, flush() -> the bytes
+# needed to decode everything so far, finish() -> the end of the stream
+def gzip_encoder():
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def brotli_encoder():
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def zstd_encoder():
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+
+def available_encoders():
+    encoders = {"gzip": gzip_encoder}
+    if brotli is not None:
+        encoders["br"] = brotli_encoder
+    if zstandard is not None:
+        encoders["zstd"] = zstd_encoder
+    return encoders
+
+
+# Pick the encoding the client rates highest in Accept-Encoding, breaking ties by the configured
+# order; None when the client accepts none of them
+def choose_encoding(accept_encodings, preference=None):
+    if preference is None:
+        preference = [e.strip() for e in Config.COMPRESSION_ENCODINGS.split(",") if e.strip()]
+    encoders = available_encoders()
+    best, best_quality = None, 0
+    for encoding in preference:
+        if encoding not in encoders:
+            continue
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+# Per-route bytes in and out and CPU time spent compressing, for /metrics
+class CompressionStats:
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, encoding, size_in, size_out, cpu_seconds):
+        with self._lock:
+            stats = self._routes.setdefault(
+                route, {"responses": 0, "bytesIn": 0, "bytesOut": 0, "cpuMs": 0.0, "encodings": {}}
+            )
+            stats["responses"] += 1
+            stats["bytesIn"] += size_in
+            stats["bytesOut"] += size_out
+            stats["cpuMs"] += cpu_seconds * 1000
+            stats["encodings"][encoding] = stats["encodings"].get(encoding, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                route: {
+                    **stats,
+                    "encodings": dict(stats["encodings"]),
+                    "cpuMs": round(stats["cpuMs"], 3),
+                    "ratio": stats["bytesIn"] / stats["bytesOut"] if stats["bytesOut"] else 0.0,
+                }
+                for route, stats in self._routes.items()
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if "Content-Encoding" in response.headers or request.method == "HEAD":
+        return False
+    if "no-transform" in response.headers.get("Cache-Control", ""):
+        return False
+    return (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+
+
+# Compress a streamed body chunk by chunk, flushing after each so events still arrive as they are
+# produced; statistics are recorded when the stream ends
+def compress_stream(chunks, encoder, route, encoding):
+    compress, flush, finish = encoder()
+    size_in = size_out = 0
+    cpu = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            started = time.thread_time()
+            data = compress(chunk) + flush()
+            cpu += time.thread_time() - started
+            size_in += len(chunk)
+            size_out += len(data)
+            yield data
+        started = time.thread_time()
+        data = finish()
+        cpu += time.thread_time() - started
+        size_out += len(data)
+        yield data
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        compression_stats.record(route, encoding, size_in, size_out, cpu)
+
+
+# after_request hook compressing responses with the best encoding the client accepts
+def compress_response(response):
+    if not compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    encoder = available_encoders()[encoding]
+    route = request.url_rule.rule if request.url_rule else request.path
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoder, route, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < Config.COMPRESSION_MIN_SIZE:
+            return response
+        started = time.thread_time()
+        compress, _, finish = encoder()
+        compressed = compress(data) + finish()
+        compression_stats.record(
+            route, encoding, len(data), len(compressed), time.thread_time() - started
+        )
+        response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -9,3 +9,87 @@ class Config:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     DATABASE_URL = os.getenv("DATABASE_URL")
     TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+    # Connection pool sizing and housekeeping for the target databases
+    POOL_MIN_SIZE = int(os.getenv("POOL_MIN_SIZE", "1"))
+    POOL_MAX_SIZE = int(os.getenv("POOL_MAX_SIZE", "10"))
+    POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", "300"))
+    POOL_CHECKOUT_TIMEOUT = float(os.getenv("POOL_CHECKOUT_TIMEOUT", "30"))
+    POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("POOL_HEALTH_CHECK_INTERVAL", "30"))
+    # Seconds the in-memory connection registry is trusted before it is reloaded from SQLite, so
+    # changes made through other worker processes are picked up; 0 never reloads (one process only)
+    CONNECTION_REGISTRY_TTL = float(os.getenv("CONNECTION_REGISTRY_TTL", "5"))
+
+    # In-process cache of introspected schemas, revalidated against a catalog fingerprint
+    SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "600"))
+    SCHEMA_CACHE_SIZE = int(os.getenv("SCHEMA_CACHE_SIZE", "64"))
+    # Rendered per-table fragments of the schema prompt
+    SCHEMA_FRAGMENT_CACHE_SIZE = int(os.getenv("SCHEMA_FRAGMENT_CACHE_SIZE", "20000"))
+
+    # Paging for /table-details; rows are streamed through a server-side cursor in itersize batches
+    TABLE_PAGE_SIZE = int(os.getenv("TABLE_PAGE_SIZE", "500"))
+    TABLE_MAX_PAGE_SIZE = int(os.getenv("TABLE_MAX_PAGE_SIZE", "10000"))
+    TABLE_CURSOR_ITERSIZE = int(os.getenv("TABLE_CURSOR_ITERSIZE", "2000"))
+
+    # Rows per batch when streaming SELECT results as NDJSON
+    STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "500"))
+
+    # Cache of LLM completions; set LLM_CACHE_PATH to also keep them in a SQLite file across restarts
+    LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+    LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+    LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+    LLM_CACHE_DISK_SIZE = int(os.getenv("LLM_CACHE_DISK_SIZE", "100000"))
+
+    # Retries of rate-limited LLM calls, backing off from LLM_RATE_LIMIT_BACKOFF seconds
+    LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "5"))
+    LLM_RATE_LIMIT_BACKOFF = float(os.getenv("LLM_RATE_LIMIT_BACKOFF", "1"))
+
+    # /queries/batch: most prompts per request, and how many are converted and executed at once
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "500"))
+    BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+    # /generate-descriptions splits the missing descriptions into chunks of at most this many prompt
+    # tokens of schema context and items, generated concurrently
+    DESCRIPTION_CHUNK_TOKENS = int(os.getenv("DESCRIPTION_CHUNK_TOKENS", "6000"))
+    DESCRIPTION_CHUNK_MAX_ITEMS = int(os.getenv("DESCRIPTION_CHUNK_MAX_ITEMS", "40"))
+    DESCRIPTION_TOKENS_PER_ITEM = int(os.getenv("DESCRIPTION_TOKENS_PER_ITEM", "80"))
+
+    # Large schemas are cut down to the tables most relevant to a request before prompting the LLM;
+    # the tables they reference within SCHEMA_PRUNE_FK_DEPTH hops are kept so joins still resolve.
+    # SCHEMA_PRUNE_TOP_K=0 always sends the full schema
+    SCHEMA_PRUNE_TOP_K = int(os.getenv("SCHEMA_PRUNE_TOP_K", "12"))
+    SCHEMA_PRUNE_MIN_TABLES = int(os.getenv("SCHEMA_PRUNE_MIN_TABLES", "30"))
+    SCHEMA_PRUNE_FK_DEPTH = int(os.getenv("SCHEMA_PRUNE_FK_DEPTH", "2"))
+
+    # Negotiated response compression: encodings in order of preference (br and zstd need the
+    # brotli and zstandard packages), and the smallest buffered body worth compressing.
+    # Streamed responses are always compressed, flushing after every chunk
+    COMPRESSION_ENCODINGS = os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip")
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+    # Default execution budget for generated SQL; each registered connection can set its own, and a
+    # request can tighten it with ?timeout_ms=, ?max_rows= and ?max_bytes=. 0 means no limit
+    QUERY_STATEMENT_TIMEOUT_MS = int(os.getenv("QUERY_STATEMENT_TIMEOUT_MS", "30000"))
+    QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "10000"))
+    QUERY_MAX_BYTES = int(os.getenv("QUERY_MAX_BYTES", str(50 * 1024 * 1024)))
+
+    # Preflight: EXPLAIN generated statements before running them (always with QUERY_PREFLIGHT=1,
+    # or per request with ?preflight=1). Statements whose estimated total cost or rows go over these
+    # thresholds need ?confirm=1 to run; 0 disables a threshold
+    QUERY_PREFLIGHT = os.getenv("QUERY_PREFLIGHT", "0").lower() in ("1", "true", "yes")
+    QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", "1000000"))
+    QUERY_MAX_PLAN_ROWS = int(os.getenv("QUERY_MAX_PLAN_ROWS", "1000000"))
+
+    # Cache of read-only SELECT results per connection and normalized statement, bounded by the
+    # estimated JSON size of the cached rows; RESULT_CACHE_TTL=0 turns it off
+    RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+    RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))
+
+    # Read replicas: introspection and read-only statements go to a connection's replicas in turn,
+    # skipping any more than REPLICA_MAX_LAG seconds behind the primary (0 skips the check). Lag is
+    # checked at most every REPLICA_LAG_CHECK_INTERVAL seconds per replica, and a replica that
+    # fails or lags is left out for REPLICA_RETRY_INTERVAL seconds
+    REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+    REPLICA_RETRY_INTERVAL = float(os.getenv("REPLICA_RETRY_INTERVAL", "30"))
@@ -1,27 +1,537 @@
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import extensions
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
+from config import Config
 from models import SessionLocal, DatabaseConnection
 
 
-# Get a database connection using the connection ID
-def get_db_connection(connection_id):
-    # New databasae connection
-    session = SessionLocal()
-    try:
-        # Query the DatabaseConnection table to get the connection details
-        connection = (
-            session.query(DatabaseConnection)
-            .filter(DatabaseConnection.id == connection_id)
-            .first()
-        )
-        if not connection:
+# Pool of reusable connections to a single target database
+class ConnectionPool:
+    def __init__(
+        self,
+        dsn,
+        minconn=Config.POOL_MIN_SIZE,
+        maxconn=Config.POOL_MAX_SIZE,
+        idle_timeout=Config.POOL_IDLE_TIMEOUT,
+        health_check_interval=Config.POOL_HEALTH_CHECK_INTERVAL,
+    ):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.closed = False
+        # Idle connections as (connection, last_used) pairs, most recently used last
+        self._idle = []
+        # Number of open connections, both idle and checked out
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+
+    # Borrow a connection, reusing an idle one when possible and dialing a new one otherwise
+    def getconn(self, timeout=Config.POOL_CHECKOUT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                connection, last_used = None, None
+                while True:
+                    if self.closed:
+                        raise PoolError("connection pool is closed")
+                    self._evict_idle()
+                    if self._idle:
+                        connection, last_used = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        # Reserve the slot now, dial outside the lock
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError("connection pool exhausted")
+                    self._cond.wait(remaining)
+
+            if connection is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(connection, last_used):
+                return connection
+            self._close(connection)
+            self._release_slot()
+
+    # Return a borrowed connection to the pool, closing it if it is no longer usable
+    def putconn(self, connection, discard=False):
+        if not discard and not connection.closed:
+            try:
+                status = connection.info.transaction_status
+                if status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            if discard or self.closed or connection.closed:
+                self._close(connection)
+                self._size -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    # Close every idle connection; checked out connections are closed when they are returned
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            for connection, _ in self._idle:
+                self._close(connection)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    # Close idle connections that have not been used recently, keeping at least minconn open
+    def evict_idle(self):
+        with self._cond:
+            self._evict_idle()
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        # The oldest connections sit at the front of the idle list
+        while self._idle and self._size > self.minconn and self._idle[0][1] < cutoff:
+            connection, _ = self._idle.pop(0)
+            self._close(connection)
+            self._size -= 1
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        # Ping connections that have been idle for a while, since the server may have dropped them
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+# Keeps one ConnectionPool per DatabaseConnection.id, plus one per read replica of it
+class PoolManager:
+    def __init__(self):
+        # Keyed by (connection id, replica index), with None for the primary
+        self._pools = {}
+        # Bumped on invalidation so a pool built from a stale registry row is never stored
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, connection_id, replica=None):
+        key = (str(connection_id), replica)
+        with self._lock:
+            pool = self._pools.get(key)
+            generation = self._generations.get(key[0], 0)
+        if pool is not None:
+            return pool
+
+        # Look up the registry outside the lock so other connections are not blocked
+        pool = ConnectionPool(get_connection_dsn(connection_id, replica))
+        with self._lock:
+            existing = None
+            if self._generations.get(key[0], 0) == generation:
+                existing = self._pools.setdefault(key, pool)
+                if existing is pool:
+                    return pool
+        # Another request won the race, or the row changed while we were reading it
+        pool.closeall()
+        return existing if existing is not None else self.get_pool(connection_id, replica)
+
+    # Drop the pools for a connection whose registry row was changed or deleted
+    def invalidate(self, connection_id):
+        connection_id = str(connection_id)
+        with self._lock:
+            stale = [key for key in self._pools if key[0] == connection_id]
+            pools = [self._pools.pop(key) for key in stale]
+            self._generations[connection_id] = self._generations.get(connection_id, 0) + 1
+        for pool in pools:
+            pool.closeall()
+
+    def evict_idle(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.evict_idle()
+
+    def closeall(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+        for pool in pools:
+            pool.closeall()
+
+
+pool_manager = PoolManager()
+
+
+# Replicas as stored on a registry row, from a list of "host[:port]" strings or {"host", "port"}
+# objects (or an already formatted string); None when there are none
+def format_replicas(replicas):
+    if not replicas:
+        return None
+    if isinstance(replicas, str):
+        replicas = replicas.split(",")
+    entries = []
+    for replica in replicas:
+        if isinstance(replica, dict):
+            replica = f"{replica['host']}:{replica['port']}" if replica.get("port") else replica["host"]
+        replica = str(replica).strip()
+        if replica:
+            entries.append(replica)
+    return ",".join(entries) or None
+
+
+# Replicas of a registry row as [{"host", "port"}], defaulting to the primary's port
+def parse_replicas(value, default_port):
+    replicas = []
+    for entry in (value or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(":")
+        if not host or not port.isdigit():
+            host, port = entry, default_port
+        replicas.append({"host": host, "port": int(port)})
+    return replicas
+
+
+# Plain copy of a registry row, safe to use after its session is closed
+def connection_record(connection):
+    return {
+        "id": connection.id,
+        "name": connection.name,
+        "host": connection.host,
+        "port": connection.port,
+        "database": connection.database,
+        "username": connection.username,
+        "password": connection.password,
+        "statement_timeout_ms": connection.statement_timeout_ms,
+        "max_rows": connection.max_rows,
+        "max_bytes": connection.max_bytes,
+        "replicas": parse_replicas(connection.replicas, connection.port),
+    }
+
+
+# In-memory copy of the database_connections registry, kept current by the /connections handlers
+# writing through it, so request paths rarely query the registry. Rows changed through other
+# processes are picked up by reloading it every ttl seconds, and an id it does not know is looked
+# up once more, in case another process registered it
+class ConnectionRegistry:
+    def __init__(self, ttl=Config.CONNECTION_REGISTRY_TTL):
+        self.ttl = ttl
+        self._records = None
+        self._loaded_at = None
+        # Bumped by every write through, so a reload that raced one is not kept
+        self._writes = 0
+        self._dsns = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    # Call callback(connection_id) when a reload finds a row that another process changed or deleted
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    def _load(self):
+        session = SessionLocal()
+        try:
+            return {
+                str(connection.id): connection_record(connection)
+                for connection in session.query(DatabaseConnection).all()
+            }
+        finally:
+            session.close()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._records is not None and (
+                not self.ttl or time.monotonic() - self._loaded_at < self.ttl
+            ):
+                return
+            writes = self._writes
+        records = self._load()
+        with self._lock:
+            if self._writes != writes and self._records is not None:
+                # A row was written through meanwhile; the next lookup reloads again
+                return
+            previous = self._records
+            self._records = records
+            self._loaded_at = time.monotonic()
+            changed = []
+            if previous is not None:
+                changed = [
+                    key
+                    for key in previous.keys() | records.keys()
+                    if previous.get(key) != records.get(key)
+                ]
+            for key in changed:
+                self._dsns.pop(key, None)
+        for key in changed:
+            for callback in self._listeners:
+                callback(key)
+
+    # Every registered connection, ordered by id
+    def all(self):
+        self._ensure_loaded()
+        with self._lock:
+            records = list(self._records.values())
+        return sorted(records, key=lambda record: record["id"])
+
+    def get(self, connection_id):
+        self._ensure_loaded()
+        key = str(connection_id)
+        with self._lock:
+            record = (self._records or {}).get(key)
+        if record is None:
+            record = self._fetch(connection_id)
+        return record
+
+    # DSN for a registered connection, or for one of its replicas, built once per registry row
+    def dsn(self, connection_id, replica=None):
+        record = self.get(connection_id)
+        if record is None:
             raise Exception("Connection not found")
+        key = str(connection_id)
+        with self._lock:
+            dsn = self._dsns.get(key, {}).get(replica)
+        if dsn is not None:
+            return dsn
+        server = record if replica is None else record["replicas"][replica]
+        dsn = extensions.make_dsn(
+            host=server["host"],
+            port=server["port"],
+            dbname=record["database"],
+            user=record["username"],
+            password=record["password"],
+        )
+        with self._lock:
+            # Only keep the DSN if the row was not changed meanwhile
+            if (self._records or {}).get(key) is record:
+                self._dsns.setdefault(key, {})[replica] = dsn
+        return dsn
+
+    # Write through a row that was just created or updated in SQLite
+    # An unloaded registry picks the change up when it is loaded
+    def put(self, connection):
+        record = connection_record(connection)
+        with self._lock:
+            self._writes += 1
+            if self._records is not None:
+                self._records[str(record["id"])] = record
+            self._dsns.pop(str(record["id"]), None)
+
+    def remove(self, connection_id):
+        with self._lock:
+            self._writes += 1
+            if self._records is not None:
+                self._records.pop(str(connection_id), None)
+            self._dsns.pop(str(connection_id), None)
+
+    # Forget everything; the next lookup reloads the registry
+    def clear(self):
+        with self._lock:
+            self._records = None
+            self._dsns = {}
+
+    def _fetch(self, connection_id):
+        session = SessionLocal()
+        try:
+            connection = (
+                session.query(DatabaseConnection)
+                .filter(DatabaseConnection.id == connection_id)
+                .first()
+            )
+            record = connection_record(connection) if connection else None
+        finally:
+            session.close()
+        if record is not None:
+            with self._lock:
+                if self._records is not None:
+                    self._records.setdefault(str(record["id"]), record)
+        return record
+
+
+connection_registry = ConnectionRegistry()
+# Pools dialed with a row's old details must not outlive it
+connection_registry.subscribe(pool_manager.invalidate)
+
+
+# Build the DSN for a registered connection, or one of its replicas, using its connection ID
+def get_connection_dsn(connection_id, replica=None):
+    return connection_registry.dsn(connection_id, replica)
 
-        # Create the connection string using the retrieved connection details
-        conn_str = f"postgresql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database}"
 
-        # Establish and return the PostgreSQL connection using psycopg2
-        return psycopg2.connect(conn_str, cursor_factory=RealDictCursor)
+# How far a server replays behind its primary, in seconds. 0 on a primary, and on a replica that is
+# streaming WAL and has replayed everything it received (the last replayed commit can be old on a
+# quiet primary). A replica that is not streaming may be arbitrarily far behind, so it is judged by
+# its last replayed commit, and NULL (never current) when it has none. Roles without
+# pg_read_all_stats cannot see the receiver status, and are always judged by the replayed commit
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+        AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END AS lag
+"""
+
+
+# Picks the replicas that serve a connection's reads: in turn, over those that are up and within
+# max_lag of the primary. Reads stay on the primary for max_lag seconds after a write, so clients
+# read their own writes
+class ReplicaRouter:
+    def __init__(
+        self,
+        max_lag=Config.REPLICA_MAX_LAG,
+        check_interval=Config.REPLICA_LAG_CHECK_INTERVAL,
+        retry_interval=Config.REPLICA_RETRY_INTERVAL,
+    ):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        # Round-robin position per connection id
+        self._next = {}
+        # Per (connection id, replica index): when it may be tried again, and its last lag check
+        self._down_until = {}
+        self._checks = {}
+        # Time of the last write per connection id
+        self._written = {}
+        self._lock = threading.Lock()
+
+    # Replica indexes to try for a read, in order; empty when the primary must serve it
+    def candidates(self, connection_id, count):
+        key = str(connection_id)
+        now = time.monotonic()
+        with self._lock:
+            if not count or now - self._written.get(key, float("-inf")) < self.max_lag:
+                return []
+            start = self._next.get(key, 0) % count
+            self._next[key] = start + 1
+            order = [(start + offset) % count for offset in range(count)]
+            return [index for index in order if self._down_until.get((key, index), 0) <= now]
+
+    # Whether a replica connection is within max_lag, querying its lag when the last check is stale
+    def within_lag(self, connection_id, replica, connection):
+        key = (str(connection_id), replica)
+        if not self.max_lag:
+            return True
+        with self._lock:
+            checked_at, lag = self._checks.get(key, (float("-inf"), None))
+        if time.monotonic() - checked_at >= self.check_interval:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(REPLICA_LAG_QUERY)
+                    row = cursor.fetchone()
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+            lag = row["lag"] if isinstance(row, dict) else row[0]
+            lag = None if lag is None else float(lag)
+            with self._lock:
+                self._checks[key] = (time.monotonic(), lag)
+        return lag is not None and lag <= self.max_lag
+
+    # Leave a replica that failed or lags out of candidates for retry_interval seconds
+    def mark_down(self, connection_id, replica):
+        key = (str(connection_id), replica)
+        with self._lock:
+            self._down_until[key] = time.monotonic() + self.retry_interval
+            self._checks.pop(key, None)
+
+    def record_write(self, connection_id):
+        with self._lock:
+            self._written[str(connection_id)] = time.monotonic()
+
+    # Forget the state of a connection whose registry row was changed or deleted
+    def forget(self, connection_id):
+        connection_id = str(connection_id)
+        with self._lock:
+            self._next.pop(connection_id, None)
+            self._written.pop(connection_id, None)
+            for state in (self._down_until, self._checks):
+                for key in [key for key in state if key[0] == connection_id]:
+                    del state[key]
+
+    # Last measured lag of each replica, and whether it is left out, for /metrics
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            keys = sorted(set(self._down_until) | set(self._checks))
+            return {
+                f"{connection_id}/{replica}": {
+                    "lag": self._checks.get((connection_id, replica), (None, None))[1],
+                    "down": self._down_until.get((connection_id, replica), 0) > now,
+                }
+                for connection_id, replica in keys
+            }
+
+
+replica_router = ReplicaRouter()
+connection_registry.subscribe(replica_router.forget)
+
+
+# Borrow a connection from the pool that should serve it: for a read, the next replica that can be
+# reached and is not lagging, otherwise the primary
+def borrow_connection(connection_id, readonly=False):
+    if readonly:
+        record = connection_registry.get(connection_id) or {}
+        for replica in replica_router.candidates(connection_id, len(record.get("replicas") or [])):
+            try:
+                pool = pool_manager.get_pool(connection_id, replica)
+                connection = pool.getconn()
+            except (psycopg2.Error, PoolError):
+                replica_router.mark_down(connection_id, replica)
+                continue
+            if replica_router.within_lag(connection_id, replica, connection):
+                return pool, connection
+            pool.putconn(connection)
+            replica_router.mark_down(connection_id, replica)
+    pool = pool_manager.get_pool(connection_id)
+    return pool, pool.getconn()
+
+
+# Borrow a pooled database connection using the connection ID; readonly work may be served by
+# a replica. Commits on success and rolls back on error, like a plain psycopg2 connection block
+@contextmanager
+def get_db_connection(connection_id, readonly=False):
+    pool_manager.evict_idle()
+    pool, connection = borrow_connection(connection_id, readonly)
+    discard = False
+    try:
+        yield connection
+        connection.commit()
+    except Exception:
+        try:
+            connection.rollback()
+        except psycopg2.Error:
+            discard = True
+        raise
     finally:
-        # Close the session to free up resources
-        session.close()
+        pool.putconn(connection, discard=discard)
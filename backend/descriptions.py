@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from config import Config
+from natlang import generate_details_async, table_fragment
+from sqlparser import parse_statement, split_statements
+
+
+# Rough token count for prompt text, at about four characters a token
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+# Order tables so that tables joined by foreign keys sit next to each other, walking each
+# connected group breadth first from its first table in schema order
+def neighbourhood_order(tables, schema):
+    neighbours = defaultdict(set)
+    for schema_name, schema_tables in schema.items():
+        for table, columns in schema_tables.items():
+            key = f"{schema_name}.{table}"
+            for column in columns:
+                for fk in column["foreign_keys"]:
+                    neighbours[key].add(fk["table"])
+                    neighbours[fk["table"]].add(key)
+    wanted = set(tables)
+    ordered, seen = [], set()
+    for table in tables:
+        if table in seen:
+            continue
+        seen.add(table)
+        pending = [table]
+        while pending:
+            current = pending.pop(0)
+            ordered.append(current)
+            for neighbour in sorted(neighbours[current] & (wanted - seen)):
+                seen.add(neighbour)
+                pending.append(neighbour)
+    return ordered, neighbours
+
+
+# The part of a schema holding the given tables, in schema order
+def sub_schema(schema, tables):
+    result = {}
+    for schema_name, schema_tables in schema.items():
+        kept = {
+            table: columns
+            for table, columns in schema_tables.items()
+            if f"{schema_name}.{table}" in tables
+        }
+        if kept:
+            result[schema_name] = kept
+    return result
+
+
+# Split the missing descriptions into chunks that each fit a prompt budget, keeping tables and
+# their foreign-key neighbours together. missing maps "schema.table" to
+# {"table": whether the table lacks a description, "columns": [columns that lack one]}
+# Each chunk carries its own schema context (its tables plus their direct neighbours) and an id
+# derived from its content, so the same work gets the same id on a later run
+def plan_chunks(
+    missing,
+    schema,
+    token_budget=Config.DESCRIPTION_CHUNK_TOKENS,
+    max_items=Config.DESCRIPTION_CHUNK_MAX_ITEMS,
+):
+    ordered, neighbours = neighbourhood_order(list(missing), schema)
+    columns_by_table = {
+        f"{schema_name}.{table}": columns
+        for schema_name, tables in schema.items()
+        for table, columns in tables.items()
+    }
+    chunks, current = [], []
+
+    def context_tables(tables):
+        return set(tables).union(*(neighbours[t] for t in tables)) & columns_by_table.keys()
+
+    def context(tables):
+        return sub_schema(schema, context_tables(tables))
+
+    # Prompt size of a chunk's schema context, from the memoized per-table prompt fragments
+    def context_tokens(tables):
+        return sum(
+            estimate_tokens(table_fragment(table, columns_by_table[table])[0])
+            for table in context_tables(tables)
+        )
+
+    def close():
+        if current:
+            part = {table: missing[table] for table in current}
+            chunk_id = hashlib.sha256(json.dumps(part, sort_keys=True).encode()).hexdigest()[:16]
+            chunks.append({"id": chunk_id, "missing": part, "schema": context(current)})
+
+    for table in ordered:
+        candidate = current + [table]
+        items = sum(missing[t]["table"] + len(missing[t]["columns"]) for t in candidate)
+        if current and (context_tokens(candidate) > token_budget or items > max_items):
+            close()
+            current = [table]
+        else:
+            current = candidate
+    close()
+    return chunks
+
+
+def normalize_name(name):
+    return name.replace('"', "").lower()
+
+
+# Keep only COMMENT statements on the tables of a chunk; anything else the model wrote is dropped
+def comment_statements(sql, tables):
+    allowed = set()
+    for table in tables:
+        allowed.add(normalize_name(table))
+        allowed.add(normalize_name(table.split(".", 1)[1]))
+    statements = []
+    for statement in split_statements(sql):
+        parsed = parse_statement(statement)
+        if parsed.type == "comment" and parsed.target and normalize_name(parsed.target) in allowed:
+            statements.append(statement)
+    return statements
+
+
+# Generation progress per connection; generated chunks are kept until they are applied, so a run
+# that stops part way resumes with only the chunks it had not finished
+class DescriptionJob:
+    def __init__(self):
+        self.generated = {}
+        self.status = "idle"
+        self.total = 0
+        self.failed = 0
+        self.applied = 0
+        self.skipped = 0
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def snapshot(self):
+        return {
+            "status": self.status,
+            "chunks": self.total,
+            "generated": len(self.generated),
+            "failed": self.failed,
+            "applied": self.applied,
+            "skipped": self.skipped,
+            "error": self.error,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+# Raised when a connection already has descriptions being generated
+class DescriptionJobRunning(Exception):
+    pass
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def job_status(connection_id):
+    with _jobs_lock:
+        job = _jobs.get(str(connection_id))
+    return job.snapshot() if job else None
+
+
+# Mark a connection's job as running, raising DescriptionJobRunning if it already is
+def claim_job(connection_id):
+    with _jobs_lock:
+        job = _jobs.setdefault(str(connection_id), DescriptionJob())
+        if job.status == "running":
+            raise DescriptionJobRunning(
+                "Descriptions are already being generated for this connection"
+            )
+        job.status = "running"
+        job.started_at = None
+    return job
+
+
+# Give back a claimed job that never got to run; a job that ran has already set its own status
+def release_job(job):
+    with _jobs_lock:
+        if job.status == "running" and job.started_at is None:
+            job.status = "idle"
+
+
+# Generate COMMENT statements for every chunk, at most `concurrency` at a time, then hand them to
+# apply(statements), which runs them in one transaction and returns the statements it skipped.
+# Yields progress events: a plan, one per chunk, and a final applied event
+# A job already taken with claim_job can be passed in; otherwise the connection's job is claimed
+async def run_description_job(
+    connection_id, chunks, apply, concurrency=Config.BATCH_CONCURRENCY, job=None
+):
+    if job is None:
+        job = claim_job(connection_id)
+    # Chunks from an earlier run that no longer match the missing set are stale
+    wanted = {chunk["id"] for chunk in chunks}
+    job.generated = {id: sql for id, sql in job.generated.items() if id in wanted}
+    job.total, job.failed, job.error = len(chunks), 0, None
+    job.applied = job.skipped = 0
+    job.started_at, job.finished_at = time.time(), None
+    resumed = len(job.generated)
+    tasks = []
+    try:
+        yield {"type": "plan", "chunks": len(chunks), "resumed": resumed}
+
+        slots = asyncio.Semaphore(concurrency)
+
+        async def generate(index, chunk):
+            async with slots:
+                started = time.perf_counter()
+                tables = list(chunk["missing"])
+                sql = await generate_details_async(chunk["missing"], chunk["schema"])
+                job.generated[chunk["id"]] = comment_statements(sql, tables)
+                return {
+                    "type": "chunk",
+                    "index": index,
+                    "tables": tables,
+                    "statements": len(job.generated[chunk["id"]]),
+                    "elapsedMs": round((time.perf_counter() - started) * 1000, 3),
+                }
+
+        tasks = [
+            asyncio.ensure_future(generate(index, chunk))
+            for index, chunk in enumerate(chunks)
+            if chunk["id"] not in job.generated
+        ]
+        for finished in asyncio.as_completed(tasks):
+            try:
+                event = await finished
+            except Exception as e:
+                job.failed += 1
+                event = {"type": "chunk", "error": str(e)}
+            yield {**event, "done": len(job.generated) + job.failed, "total": len(chunks)}
+
+        statements = [
+            statement
+            for chunk in chunks
+            for statement in job.generated.get(chunk["id"], [])
+        ]
+        skipped = await asyncio.to_thread(apply, statements) if statements else []
+        job.generated = {}
+        job.applied = len(statements) - len(skipped)
+        job.skipped = len(skipped)
+        job.status = "partial" if job.failed or skipped else "done"
+        yield {
+            "type": "applied",
+            "statements": job.applied,
+            "skipped": skipped,
+            "failedChunks": job.failed,
+        }
+    except BaseException as e:
+        # Chunks generated so far stay in the job for the next run
+        job.status = "failed"
+        job.error = str(e) or type(e).__name__
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        job.finished_at = time.time()
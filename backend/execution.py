@@ -0,0 +1,166 @@
+import json
+import threading
+import uuid
+from contextlib import contextmanager
+from config import Config
+from database import connection_registry
+from json_provider import default, orjson
+from sqlparser import parse_statement
+
+
+# Limits on running generated SQL: a server-side statement_timeout in milliseconds, and caps on the
+# rows and the (approximate JSON) bytes a statement may return. 0 means no limit
+class ExecutionBudget:
+    def __init__(self, timeout_ms=0, max_rows=0, max_bytes=0):
+        self.timeout_ms = timeout_ms
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+
+    # Budget for a registered connection: its own limits where set, the configured defaults otherwise
+    @classmethod
+    def for_connection(cls, connection_id):
+        record = connection_registry.get(connection_id) or {}
+
+        def limit(name, fallback):
+            value = record.get(name)
+            return fallback if value is None else value
+
+        return cls(
+            limit("statement_timeout_ms", Config.QUERY_STATEMENT_TIMEOUT_MS),
+            limit("max_rows", Config.QUERY_MAX_ROWS),
+            limit("max_bytes", Config.QUERY_MAX_BYTES),
+        )
+
+    # A copy with per-request limits applied; a request can tighten its budget but not lift it
+    def narrowed(self, timeout_ms=None, max_rows=None, max_bytes=None):
+        def tighter(current, requested):
+            if requested is None:
+                return current
+            return min(current, requested) if current else requested
+
+        return ExecutionBudget(
+            tighter(self.timeout_ms, timeout_ms),
+            tighter(self.max_rows, max_rows),
+            tighter(self.max_bytes, max_bytes),
+        )
+
+    @property
+    def caps_rows(self):
+        return bool(self.max_rows or self.max_bytes)
+
+
+# Limit every following statement of the current transaction to the budget's timeout
+def apply_timeout(cursor, budget):
+    if budget is not None and budget.timeout_ms:
+        cursor.execute("SET LOCAL statement_timeout = %s", (int(budget.timeout_ms),))
+
+
+# Size of rows as they would be sent in a JSON response
+def estimate_bytes(rows):
+    if orjson is not None:
+        return len(orjson.dumps(rows, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME))
+    return len(json.dumps(rows, default=default))
+
+
+# Reads a cursor in batches within a budget's row and byte caps. Once a cap is reached the last
+# batch is cut short, truncated says which cap ("maxRows" or "maxBytes") and reading stops
+class BatchReader:
+    def __init__(self, cursor, budget, batch_size=Config.STREAM_BATCH_SIZE):
+        self.cursor = cursor
+        self.budget = budget or ExecutionBudget()
+        self.batch_size = batch_size
+        self.rows = 0
+        self.bytes = 0
+        self.truncated = None
+        self.done = False
+
+    # The next batch of rows, or an empty list at the end
+    def next_batch(self):
+        if self.done:
+            return []
+        max_rows, max_bytes = self.budget.max_rows, self.budget.max_bytes
+        wanted = self.batch_size
+        if max_rows:
+            # One row past the cap tells a full result from a truncated one
+            wanted = min(wanted, max_rows + 1 - self.rows)
+        batch = self.cursor.fetchmany(wanted)
+        if not batch:
+            self.done = True
+            return []
+        if max_bytes:
+            size = estimate_bytes(batch)
+            if self.bytes + size > max_bytes:
+                # Keep the share of the batch that fits, assuming rows of similar size
+                batch = batch[: len(batch) * (max_bytes - self.bytes) // size]
+                self.truncated, self.done = "maxBytes", True
+            self.bytes += size
+        if max_rows and self.rows + len(batch) > max_rows:
+            batch = batch[: max_rows - self.rows]
+            self.truncated, self.done = "maxRows", True
+        self.rows += len(batch)
+        return batch
+
+    def __iter__(self):
+        batch = self.next_batch()
+        while batch:
+            yield batch
+            batch = self.next_batch()
+
+
+# Fetch a statement's rows within the budget, returning (rows, truncated)
+def fetch_rows(cursor, budget):
+    if budget is None or not budget.caps_rows:
+        return cursor.fetchall(), None
+    reader = BatchReader(cursor, budget)
+    rows = [row for batch in reader for row in batch]
+    return rows, reader.truncated
+
+
+# Run a SELECT and fetch its rows within the budget. Read-only statements run on a server-side
+# cursor, so rows past the cap are never produced or sent by the server
+def fetch_select(cursor, connection, query, budget):
+    if budget is None or not budget.caps_rows or not parse_statement(query).is_read_only:
+        cursor.execute(query)
+        return fetch_rows(cursor, budget)
+    with connection.cursor(name=f"capped_{uuid.uuid4().hex}") as named:
+        named.itersize = Config.STREAM_BATCH_SIZE
+        named.execute(query)
+        return fetch_rows(named, budget)
+
+
+# Connections running statements for each query id, so a client can cancel its query
+class RunningQueries:
+    def __init__(self):
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, query_id, connection):
+        with self._lock:
+            self._running.setdefault(query_id, []).append(connection)
+        try:
+            yield
+        finally:
+            with self._lock:
+                connections = self._running.get(query_id, [])
+                if connection in connections:
+                    connections.remove(connection)
+                if not connections:
+                    self._running.pop(query_id, None)
+
+    # Ask the server to cancel whatever the query's connections are running; False if none are.
+    # connection.cancel() sends the same request as pg_cancel_backend over its own socket, so it
+    # works even when every pooled connection is busy
+    def cancel(self, query_id):
+        with self._lock:
+            connections = list(self._running.get(query_id, []))
+        for connection in connections:
+            connection.cancel()
+        return bool(connections)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._running)
+
+
+running_queries = RunningQueries()
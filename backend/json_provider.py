@@ -0,0 +1,64 @@
+import uuid
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+# Render database values the JSON encoders do not handle the way results have always been shown:
+# timestamps as "YYYY-MM-DD HH:MM:SS", times without fractions, numerics as numbers
+def default(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, time):
+        return value.strftime("%H:%M:%S")
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, timedelta):
+        return str(value)
+    if hasattr(value, "__html__"):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Flask JSON provider for every jsonify call and streamed event, using orjson when it is installed
+# and the standard library otherwise; both produce the same values
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        return self._orjson_dumps(obj, **kwargs).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    # Build the response body from orjson's bytes directly, without a round trip through str
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = None if self.compact or (self.compact is None and not self._app.debug) else 2
+        return self._app.response_class(
+            self._orjson_dumps(obj, indent=indent) + b"\n", mimetype=self.mimetype
+        )
+
+    def _orjson_dumps(self, obj, sort_keys=None, indent=None, **kwargs):
+        # Dates and times go through default so both encoders format them the same way
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option)
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String
 from sqlalchemy.orm import declarative_base, sessionmaker
 from config import Config
 
@@ -15,6 +15,12 @@ class DatabaseConnection(Base):
     username = Column(String, nullable=False)
     password = Column(String, nullable=False)
     database = Column(String, nullable=False)
+    # Execution budget for generated SQL; NULL uses the Config default
+    statement_timeout_ms = Column(Integer, nullable=True)
+    max_rows = Column(Integer, nullable=True)
+    max_bytes = Column(Integer, nullable=True)
+    # Read replicas as comma-separated "host[:port]" entries, reached with the same credentials
+    replicas = Column(String, nullable=True)
 
 
 # Create SQLite database to store database connection details
@@ -24,4 +30,21 @@ engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base.metadata.create_all(bind=engine)
 
+
+# create_all only creates missing tables; add the columns a registry created by an older
+# version lacks (new columns are all nullable)
+def migrate(engine):
+    table = DatabaseConnection.__table__
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+
+
+migrate(engine)
+
 print(f"Using connection database URL: {engine.url}")
@@ -1,15 +1,245 @@
-from openai import OpenAI
+import asyncio
+import hashlib
+import json
+import logging
+import random
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from cache import SQLiteCache, TieredCache, TTLCache
 from config import Config
+from schema_index import prune_schema
 
 OpenAI.api_key = Config.OPENAI_API_KEY
 openai_client = OpenAI(api_key=OpenAI.api_key)
+logger = logging.getLogger(__name__)
 
+# Completions keyed by model, sampling settings and the full prompt, which embeds the formatted schema
+llm_cache = TieredCache(
+    TTLCache(maxsize=Config.LLM_CACHE_SIZE, ttl=Config.LLM_CACHE_TTL),
+    (
+        SQLiteCache(
+            Config.LLM_CACHE_PATH,
+            ttl=Config.LLM_CACHE_TTL,
+            maxsize=Config.LLM_CACHE_DISK_SIZE,
+        )
+        if Config.LLM_CACHE_PATH
+        else None
+    ),
+)
 
-def convert_query(prompt, schema):
-    schema_str = format_schema(schema)
-    print(schema_str)
+
+# Collapse runs of whitespace so trivially different spellings of a request share a cache entry
+def normalize_prompt(prompt):
+    return " ".join(prompt.split())
+
+
+# Cache key for a completion request; the response format only counts when one is requested
+def completion_cache_key(model, temperature, max_tokens, messages, response_format=None):
+    request = [model, temperature, max_tokens, messages]
+    if response_format is not None:
+        request.append(response_format)
+    payload = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# A new async client, to be used as `async with get_async_client() as client` so it is closed
+# afterwards: its connections are bound to the running event loop, and request handlers and
+# streams each run on a fresh loop, so a client kept between requests would leak its sockets
+def get_async_client():
+    return AsyncOpenAI(api_key=OpenAI.api_key)
+
+
+# Seconds to wait before retrying a rate-limited call: the server's retry-after-ms or retry-after
+# header when it sends one, otherwise exponential backoff with jitter
+def retry_delay(error, attempt, base=Config.LLM_RATE_LIMIT_BACKOFF):
+    headers = error.response.headers if error.response is not None else {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, ValueError):
+            pass
+    return min(base * 2**attempt, 60) * random.uniform(0.5, 1)
+
+
+# Await call(), retrying when the API answers with a rate limit error
+async def with_rate_limit_backoff(call, max_retries=Config.LLM_RATE_LIMIT_RETRIES):
+    attempt = 0
+    while True:
+        try:
+            return await call()
+        except RateLimitError as e:
+            if attempt >= max_retries:
+                raise
+            await asyncio.sleep(retry_delay(e, attempt))
+            attempt += 1
+
+
+# Run a chat completion, answering from llm_cache when the same request was made before
+# With use_cache off the API is always called, and the fresh answer replaces the cached one
+def complete(
+    messages,
+    max_tokens,
+    temperature,
+    model="gpt-4o-mini",
+    use_cache=True,
+    response_format=None,
+):
+    key = completion_cache_key(model, temperature, max_tokens, messages, response_format)
+    if use_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
     response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        **({"response_format": response_format} if response_format else {}),
+    )
+    content = response.choices[0].message.content.strip()
+    if content:
+        llm_cache.set(key, content)
+    return content
+
+
+# Same as complete, awaiting the API call so other requests can run in the meantime
+# Rate-limited calls are retried with backoff
+async def complete_async(
+    messages,
+    max_tokens,
+    temperature,
+    model="gpt-4o-mini",
+    use_cache=True,
+    response_format=None,
+):
+    key = completion_cache_key(model, temperature, max_tokens, messages, response_format)
+    if use_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+
+    async def create():
+        async with get_async_client() as client:
+            return await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **({"response_format": response_format} if response_format else {}),
+            )
+
+    response = await with_rate_limit_backoff(create)
+    content = response.choices[0].message.content.strip()
+    if content:
+        llm_cache.set(key, content)
+    return content
+
+
+# Same as complete_async, yielding the answer as text deltas while it is generated
+# A cached answer arrives as a single delta; the full answer is cached once the stream ends
+async def complete_stream(
+    messages, max_tokens, temperature, model="gpt-4o-mini", use_cache=True
+):
+    key = completion_cache_key(model, temperature, max_tokens, messages)
+    if use_cache:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    # The client stays open until the stream is read to the end or abandoned
+    async with get_async_client() as client:
+        stream = await with_rate_limit_backoff(
+            lambda: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+            )
+        )
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    content = "".join(parts).strip()
+    if content:
+        llm_cache.set(key, content)
+
+
+def convert_query(prompt, schema, use_cache=True):
+    return complete(**convert_request(prompt, schema), use_cache=use_cache)
+
+
+async def convert_query_async(prompt, schema, use_cache=True):
+    return await complete_async(**convert_request(prompt, schema), use_cache=use_cache)
+
+
+def convert_query_stream(prompt, schema, use_cache=True):
+    return complete_stream(**convert_request(prompt, schema), use_cache=use_cache)
+
+
+def analyze_query(query, schema, use_cache=True):
+    return complete(**analyze_request(query, schema), use_cache=use_cache)
+
+
+async def analyze_query_async(query, schema, use_cache=True):
+    return await complete_async(**analyze_request(query, schema), use_cache=use_cache)
+
+
+# Convert a request to SQL and name its result with two concurrent completions
+async def convert_and_analyze_async(prompt, schema, use_cache=True):
+    return await asyncio.gather(
+        convert_query_async(prompt, schema, use_cache),
+        analyze_query_async(prompt, schema, use_cache),
+    )
+
+
+# Convert a request to SQL and name its result in a single JSON-mode completion
+# Returns a dict with the SQL text, result name and description; raises ValueError on a malformed answer
+async def convert_and_describe_async(prompt, schema, use_cache=True):
+    content = await complete_async(
+        **convert_and_describe_request(prompt, schema), use_cache=use_cache
+    )
+    return parse_conversion(content)
+
+
+def parse_conversion(content):
+    try:
+        answer = json.loads(content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Completion is not valid JSON: {e}")
+    if not isinstance(answer, dict):
+        raise ValueError("Completion is not a JSON object")
+    sql = answer.get("sql")
+    # Some answers list the statements instead of joining them
+    if isinstance(sql, list):
+        sql = ";\n".join(str(statement).strip().rstrip(";") for statement in sql)
+    if not isinstance(sql, str) or not sql.strip():
+        raise ValueError("Completion has no SQL")
+    return {
+        "sql": sql.strip(),
+        "name": str(answer.get("name") or "").strip() or None,
+        "description": str(answer.get("description") or "").strip() or None,
+    }
+
+
+# Rules shared by the prompts that write SQL
+CONVERSION_RULES = (
+    "When converting the request, ensure the following:\n"
+    "1. Verify that all referenced columns exist in the schema.\n"
+    "2. Utilize foreign key relationships to join tables when necessary.\n"
+    "3. If a column does not exist in the specified table, check related tables through foreign keys.\n"
+    "4. Use schema-qualified table names to avoid ambiguity.\n"
+    "5. Decompose complex operations into smaller, logically ordered steps if needed.\n"
+)
+
+
+# Completion arguments for turning a natural language request into SQL
+def convert_request(prompt, schema):
+    schema_str = format_schema(prune_schema(schema, prompt))
+    logger.debug("Schema prompt:\n%s", schema_str)
+    return dict(
         messages=[
             {
                 "role": "system",
@@ -17,12 +247,7 @@ def convert_query(prompt, schema):
                     "You are an expert at converting natural language requests into technical SQL commands. "
                     "Provided is the available database schema you are working with:\n"
                     f"{schema_str}\n"
-                    "When converting the request, ensure the following:\n"
-                    "1. Verify that all referenced columns exist in the schema.\n"
-                    "2. Utilize foreign key relationships to join tables when necessary.\n"
-                    "3. If a column does not exist in the specified table, check related tables through foreign keys.\n"
-                    "4. Use schema-qualified table names to avoid ambiguity.\n"
-                    "5. Decompose complex operations into smaller, logically ordered steps if needed.\n"
+                    f"{CONVERSION_RULES}"
                     "The output should contain only valid SQL query text, no formatting, or markdown syntax such as '''sql.\n"
                     "You should not provide any additional comments or explanations in the output."
                 ),
@@ -31,19 +256,53 @@ def convert_query(prompt, schema):
                 "role": "user",
                 "content": (
                     f"Convert the following natural language request into SQL query(s):\n"
-                    f"{prompt}"
+                    f"{normalize_prompt(prompt)}"
                 ),
             },
         ],
         max_tokens=300,
         temperature=0.2,
     )
-    return response.choices[0].message.content.strip()
 
 
-def analyze_query(query, schema):
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
+# Completion arguments for writing the SQL and naming its result in one JSON answer
+def convert_and_describe_request(prompt, schema):
+    schema_str = format_schema(prune_schema(schema, prompt))
+    logger.debug("Schema prompt:\n%s", schema_str)
+    return dict(
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You are an expert at converting natural language requests into technical SQL commands. "
+                    "Provided is the available database schema you are working with:\n"
+                    f"{schema_str}\n"
+                    f"{CONVERSION_RULES}"
+                    "Also provide a name and description for the data the SQL returns. "
+                    "The name should be short, formatted like a book title with spaces between words. "
+                    "The description should be concise and informative, and fit on a single line.\n"
+                    "Answer with a JSON object with exactly these keys: "
+                    '"sql" (the SQL query text, statements separated by semicolons, no markdown), '
+                    '"name" and "description".'
+                ),
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"Convert the following natural language request into SQL query(s):\n"
+                    f"{normalize_prompt(prompt)}"
+                ),
+            },
+        ],
+        max_tokens=400,
+        temperature=0.2,
+        response_format={"type": "json_object"},
+    )
+
+
+# Completion arguments for naming and describing the result of a request
+def analyze_request(query, schema):
+    return dict(
         messages=[
             {
                 "role": "system",
@@ -61,30 +320,43 @@ def analyze_query(query, schema):
                 "role": "user",
                 "content": (
                     f"Get a table name and description natural language request: \n"
-                    f"{query}"
+                    f"{normalize_prompt(query)}"
                 ),
             },
         ],
         max_tokens=100,
         temperature=0.3,
     )
-    return response.choices[0].message.content.strip()
 
 
-def generate_details(missing_descriptions, schema):
-    response = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
+# Generate COMMENT statements for one chunk of tables and columns that lack descriptions
+# missing maps "schema.table" to {"table": bool, "columns": [...]}; schema holds the tables for context
+async def generate_details_async(missing_descriptions, schema, use_cache=True):
+    return await complete_async(
+        **details_request(missing_descriptions, schema), use_cache=use_cache
+    )
+
+
+def details_request(missing_descriptions, schema):
+    lines = []
+    for table, missing in missing_descriptions.items():
+        if missing["table"]:
+            lines.append(f"- table {table}")
+        lines.extend(f"- column {table}.{column}" for column in missing["columns"])
+    missing_str = "\n".join(lines)
+    return dict(
         messages=[
             {
                 "role": "system",
                 "content": (
                     "You are an expert at generating SQL table and column descriptions. "
                     "Generate SQL commands to put these descriptions in the database. "
-                    f"Provided is the table schema for the database you are working with:\n{schema}\n"
-                    f"Also provided are the tables and columns in the database that are missing descriptions:\n{missing_descriptions}\n"
+                    f"Provided is the table schema for the database you are working with:\n{format_schema(schema)}\n"
+                    f"Also provided are the tables and columns in the database that are missing descriptions:\n{missing_str}\n"
                     "The output should contain only valid SQL query text, no formatting, or markdown syntax such as '''sql. "
-                    "The descriptions should be concise and informative."
-                    "Only be provided for tables and columns that are missing descriptions. "
+                    "The descriptions should be concise and informative. "
+                    "Only use COMMENT ON TABLE and COMMENT ON COLUMN statements with schema-qualified names, "
+                    "and only for the tables and columns listed as missing descriptions. "
                     "You should not provide any additional comments or explanations in the output. "
                     "Ensure that any single quotes within the descriptions are properly escaped by doubling them (e.g., ' becomes '')."
                 ),
@@ -96,42 +368,73 @@ def generate_details(missing_descriptions, schema):
                 ),
             },
         ],
-        max_tokens=3000,
+        # Room for one COMMENT statement per item, so a chunk's answer is not cut off mid-statement
+        max_tokens=min(4096, 200 + len(lines) * Config.DESCRIPTION_TOKENS_PER_ITEM),
         temperature=0.3,
     )
-    return response.choices[0].message.content.strip()
+
+
+# Rendered prompt text for one table, keyed by id() of its column list and checked by identity;
+# fetch_db_schemas keeps the same list for a table until that table changes
+_table_fragments = TTLCache(maxsize=Config.SCHEMA_FRAGMENT_CACHE_SIZE)
+# Full rendered schemas, keyed the same way by the schema dict
+_rendered_schemas = TTLCache(maxsize=Config.SCHEMA_CACHE_SIZE)
+
+
+# Render one table as its prompt lines, returning the text and its longest line
+def render_table(table, columns):
+    lines = [f"  Table: {table}"]
+    for column in columns:
+        column_info = (
+            f"    - {column['name']} ({column['type']})"
+            f" [Nullable: {'YES' if column['nullable'] else 'NO'}]"
+            f" [Default: {column['default'] or 'None'}]"
+        )
+        if column["primary_key"]:
+            column_info += " [Primary Key]"
+        if column["foreign_keys"]:
+            fks = ", ".join(
+                [
+                    f"{fk['table']}.{fk['column']}"
+                    for fk in column["foreign_keys"]
+                ]
+            )
+            column_info += f" [Foreign Keys: {fks}]"
+        if column["description"]:
+            column_info += f" → {column['description']}"
+        lines.append(column_info)
+    lines.append("")
+    return "\n".join(lines), max(len(line) for line in lines)
+
+
+def table_fragment(table, columns):
+    key = (table, id(columns))
+    entry = _table_fragments.get(key, validate=lambda entry: entry[0] is columns)
+    if entry is None:
+        entry = (columns, *render_table(table, columns))
+        _table_fragments.set(key, entry)
+    return entry[1], entry[2]
 
 
 def format_schema(schema):
-    lines = []
+    entry = _rendered_schemas.get(id(schema), validate=lambda entry: entry[0] is schema)
+    if entry is not None:
+        return entry[1]
+
+    parts = []
+    max_length = 0
     for schema_name, tables in schema.items():
-        lines.append(f"Schema: {schema_name}")
+        line = f"Schema: {schema_name}"
+        parts.append(line)
+        max_length = max(max_length, len(line))
         for table, columns in tables.items():
-            lines.append(f"  Table: {table}")
-            for column in columns:
-                column_info = (
-                    f"    - {column['name']} ({column['type']})"
-                    f" [Nullable: {'YES' if column['nullable'] else 'NO'}]"
-                    f" [Default: {column['default'] or 'None'}]"
-                )
-                if column["primary_key"]:
-                    column_info += " [Primary Key]"
-                if column["foreign_keys"]:
-                    fks = ", ".join(
-                        [
-                            f"{fk['table']}.{fk['column']}"
-                            for fk in column["foreign_keys"]
-                        ]
-                    )
-                    column_info += f" [Foreign Keys: {fks}]"
-                if column["description"]:
-                    column_info += f" → {column['description']}"
-                lines.append(column_info)
-            lines.append("")
-
-    max_length = max(len(line) for line in lines)
+            text, length = table_fragment(table, columns)
+            parts.append(text)
+            max_length = max(max_length, length)
+
     header = "Available Database Schema:"
     centered_header = header.center(max_length)
 
-    schema_str = centered_header + "\n" + "\n".join(lines)
+    schema_str = centered_header + "\n" + "\n".join(parts)
+    _rendered_schemas.set(id(schema), (schema, schema_str))
     return schema_str
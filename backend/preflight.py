@@ -0,0 +1,71 @@
+from config import Config
+from database import get_db_connection
+from execution import apply_timeout
+from sqlparser import parse_statement
+
+# Statements EXPLAIN can plan without running them
+EXPLAINABLE = {"select", "insert", "update", "delete"}
+
+
+# Walk a plan tree depth first, yielding every node
+def plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+# Condense an EXPLAIN (FORMAT JSON) plan into its estimated cost and rows, plus the sequential
+# scans in it (with their filters, which are the candidates for new indexes)
+def summarize_plan(plan):
+    root = plan[0]["Plan"]
+    seq_scans = [
+        {
+            "relation": ".".join(filter(None, (node.get("Schema"), node.get("Relation Name")))),
+            "rows": node.get("Plan Rows"),
+            "filter": node.get("Filter"),
+        }
+        for node in plan_nodes(root)
+        if node.get("Node Type") == "Seq Scan"
+    ]
+    return {
+        "nodeType": root.get("Node Type"),
+        "startupCost": root.get("Startup Cost"),
+        "totalCost": root.get("Total Cost"),
+        "planRows": root.get("Plan Rows"),
+        "seqScans": seq_scans,
+    }
+
+
+# Which thresholds a plan summary goes over: "cost" and/or "rows". 0 disables a threshold
+def exceeded(summary, max_cost=Config.QUERY_MAX_COST, max_rows=Config.QUERY_MAX_PLAN_ROWS):
+    reasons = []
+    if max_cost and (summary["totalCost"] or 0) > max_cost:
+        reasons.append("cost")
+    if max_rows and (summary["planRows"] or 0) > max_rows:
+        reasons.append("rows")
+    return reasons
+
+
+# EXPLAIN each statement without running it, returning a plan summary per statement that has one
+def explain_queries(cursor, queries, budget=None):
+    plans = []
+    for query in queries:
+        if parse_statement(query).type not in EXPLAINABLE:
+            continue
+        apply_timeout(cursor, budget)
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+        row = cursor.fetchone()
+        plan = row["QUERY PLAN"] if isinstance(row, dict) else row[0]
+        summary = summarize_plan(plan)
+        plans.append({"Query": query, **summary, "exceeds": exceeded(summary)})
+    return plans
+
+
+# Plan generated statements on a pooled connection; nothing is executed, so a replica can plan
+# them and the transaction is rolled back afterwards
+def preflight_queries(connection_id, queries, budget=None):
+    with get_db_connection(connection_id, readonly=True) as connection, connection.cursor() as cursor:
+        try:
+            return explain_queries(cursor, queries, budget)
+        finally:
+            connection.rollback()
@@ -0,0 +1,90 @@
+from cache import TTLCache
+from config import Config
+from database import connection_registry
+from execution import estimate_bytes
+from sqlparser import normalize_sql, parse_statement
+
+# Cached reads of the system catalogs are invalidated by COMMENT, whatever table it names
+CATALOG = "<catalog>"
+
+
+# Bare, lower-case table names, so "Users", "public.users" and '"users"' invalidate each other
+def table_names(names):
+    tables = set()
+    for name in names:
+        qualified = name.lower()
+        tables.add(qualified.rpartition(".")[2])
+        if qualified.startswith(("pg_", "pg_catalog.", "information_schema.")):
+            tables.add(CATALOG)
+    return tables
+
+
+class CachedResult:
+    def __init__(self, rows, tables):
+        self.rows = rows
+        self.tables = tables
+        self.size = estimate_bytes(rows)
+
+
+# Results of read-only SELECTs keyed by connection id and normalized SQL, with a TTL and an LRU
+# bounded by the rows' estimated JSON size. Writes invalidate every entry that read a table they touch
+class ResultCache:
+    def __init__(
+        self,
+        ttl=Config.RESULT_CACHE_TTL,
+        maxbytes=Config.RESULT_CACHE_MAX_BYTES,
+        maxsize=Config.RESULT_CACHE_SIZE,
+    ):
+        self.enabled = bool(ttl)
+        self._cache = TTLCache(
+            maxsize=maxsize, ttl=ttl, maxbytes=maxbytes, sizeof=lambda result: result.size
+        )
+
+    @staticmethod
+    def key(connection_id, query):
+        return (str(connection_id), normalize_sql(query))
+
+    # The CachedResult for a statement and its age in seconds, or None
+    def get(self, connection_id, query):
+        if not self.enabled:
+            return None
+        key = self.key(connection_id, query)
+        result = self._cache.get(key)
+        if result is None:
+            return None
+        age = self._cache.age(key)
+        return result, (round(age, 3) if age is not None else 0.0)
+
+    def put(self, connection_id, query, rows):
+        if self.enabled:
+            tables = table_names(parse_statement(query).tables)
+            self._cache.set(self.key(connection_id, query), CachedResult(rows, tables))
+
+    # Drop entries that read any of the tables a write or COMMENT touched
+    def invalidate_statement(self, connection_id, query):
+        statement = parse_statement(query)
+        names = list(statement.tables)
+        if statement.target:
+            names.append(statement.target)
+        tables = table_names(names)
+        if statement.type == "comment":
+            tables.add(CATALOG)
+        connection_id = str(connection_id)
+        return self._cache.discard(
+            lambda key, result: key[0] == connection_id and not result.tables.isdisjoint(tables)
+        )
+
+    def invalidate_connection(self, connection_id):
+        connection_id = str(connection_id)
+        return self._cache.discard(lambda key, result: key[0] == connection_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+result_cache = ResultCache()
+# Rows cached from a connection's old database must not be served once it points elsewhere
+connection_registry.subscribe(result_cache.invalidate_connection)
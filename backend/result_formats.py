@@ -0,0 +1,144 @@
+import json
+import uuid
+from decimal import Decimal
+from execution import BatchReader
+from json_provider import default
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pyarrow = None
+
+COLUMNAR_MIMETYPE = "application/vnd.natlang.columnar+json"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+FORMATS = {"json", "columnar", "arrow"}
+
+
+# Column names once, then one array of values per column, in the same order
+def to_columnar(rows, columns=None):
+    if columns is None:
+        columns = list(rows[0]) if rows else []
+    return {"columns": columns, "data": [[row[column] for row in rows] for column in columns]}
+
+
+# Rewrite the row lists in /queries results as columnar tables; other results pass through
+def results_to_columnar(results):
+    converted = []
+    for result in results:
+        rows = result.get("Results")
+        if isinstance(rows, list) and all(isinstance(row, dict) for row in rows):
+            result = {**result, "Results": to_columnar(rows)}
+        converted.append(result)
+    return converted
+
+
+def arrow_available():
+    return pyarrow is not None
+
+
+# Values Arrow has no type for (UUIDs, JSON documents, ranges...) are sent as text
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=default)
+    return str(value)
+
+
+# Numerics are sent as doubles, as they are in JSON responses, so every batch shares one type
+def _numbers(values):
+    return [float(value) if isinstance(value, Decimal) else value for value in values]
+
+
+def _infer_array(values):
+    values = _numbers(values)
+    sample = next((value for value in values if value is not None), None)
+    if sample is None:
+        return pyarrow.array([None] * len(values), type=pyarrow.string())
+    if not isinstance(sample, (dict, list, uuid.UUID)):
+        try:
+            return pyarrow.array(values, from_pandas=False)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError):
+            pass
+    return pyarrow.array([_as_text(value) for value in values], type=pyarrow.string())
+
+
+def _typed_array(values, arrow_type):
+    if arrow_type == pyarrow.string():
+        return pyarrow.array([_as_text(value) for value in values], type=arrow_type)
+    return pyarrow.array(_numbers(values), type=arrow_type, from_pandas=False)
+
+
+# Arrow IPC stream writer fed with batches of dict rows; column types are inferred from the first
+# batch (columns that are all NULL there, and values Arrow cannot type, become strings).
+# metadata is attached to the stream schema, leaving out empty values
+class ArrowStreamEncoder:
+    # The encoder is its own write-only sink; pyarrow.PythonFile checks these
+    closed = False
+
+    def __init__(self, columns, metadata=None):
+        self.columns = columns
+        self.metadata = {
+            key: str(value) for key, value in (metadata or {}).items() if value is not None
+        }
+        self.schema = None
+        self._buffer = []
+        self._writer = None
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+
+    def flush(self):
+        pass
+
+    # Encode a batch of rows, returning the IPC bytes produced so far
+    def encode(self, rows):
+        values = [[row[column] for row in rows] for column in self.columns]
+        if self.schema is None:
+            arrays = [_infer_array(column_values) for column_values in values]
+            self.schema = pyarrow.schema(
+                [pyarrow.field(name, array.type) for name, array in zip(self.columns, arrays)],
+                metadata=self.metadata or None,
+            )
+            self._writer = pyarrow.ipc.new_stream(pyarrow.PythonFile(self, mode="w"), self.schema)
+        else:
+            arrays = [
+                _typed_array(column_values, field.type)
+                for column_values, field in zip(values, self.schema)
+            ]
+        self._writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        return self._drain()
+
+    # End the stream, returning the remaining bytes
+    def close(self):
+        data = self.encode([]) if self._writer is None else b""
+        self._writer.close()
+        return data + self._drain()
+
+    def _drain(self):
+        data = b"".join(self._buffer)
+        self._buffer = []
+        return data
+
+
+# Encode a list of rows as a complete Arrow IPC stream
+def rows_to_arrow(columns, rows, metadata=None):
+    encoder = ArrowStreamEncoder(columns, metadata)
+    return encoder.encode(rows) + encoder.close()
+
+
+# Run a SELECT on a named server-side cursor and yield it as an Arrow IPC stream, a record batch per
+# fetch; with a budget, rows past its caps are left out
+def stream_arrow(connection, query, batch_size, metadata=None, budget=None):
+    with connection.cursor(name=f"arrow_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query)
+        reader = BatchReader(cursor, budget, batch_size)
+        batch = reader.next_batch()
+        encoder = ArrowStreamEncoder(
+            [column.name for column in cursor.description], {"query": query, **(metadata or {})}
+        )
+        while batch:
+            yield encoder.encode(batch)
+            batch = reader.next_batch()
+        yield encoder.close()
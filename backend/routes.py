@@ -1,18 +1,73 @@
-from flask import request, jsonify
-from database import get_db_connection
-from natlang import convert_query, analyze_query, generate_details
-from collections import defaultdict
+from flask import Response, request, jsonify, make_response, stream_with_context
+from database import (
+    connection_registry,
+    format_replicas,
+    get_db_connection,
+    pool_manager,
+    replica_router,
+)
+from natlang import (
+    analyze_query_async,
+    convert_and_analyze_async,
+    convert_and_describe_async,
+    convert_query_async,
+    convert_query_stream,
+    llm_cache,
+)
 from models import DatabaseConnection, SessionLocal
+from config import Config
+from compression import compression_stats
+from streaming import generate_and_execute, ndjson, sse, stream_select
+from batch import iterate_sync, run_batch
+from descriptions import (
+    DescriptionJobRunning,
+    claim_job,
+    job_status,
+    plan_chunks,
+    release_job,
+    run_description_job,
+)
+from result_cache import result_cache
+from sqlparser import parse_statement, split_statements
+from execution import (
+    ExecutionBudget,
+    apply_timeout,
+    fetch_rows,
+    fetch_select,
+    running_queries,
+)
+from preflight import preflight_queries
+from result_formats import (
+    ARROW_MIMETYPE,
+    COLUMNAR_MIMETYPE,
+    FORMATS,
+    arrow_available,
+    results_to_columnar,
+    rows_to_arrow,
+    stream_arrow,
+    to_columnar,
+)
 import psycopg2
 from psycopg2 import OperationalError
 from utils import (
     fetch_table_list,
     fetch_db_schemas,
-    get_table_name,
-    get_where_clause,
-    get_new_rows,
+    add_returning,
+    build_update_capture,
+    get_statement_type,
     fetch_table_details,
+    PageCursorMismatch,
+    decode_page_cursor,
+    invalidate_schema_cache,
+    fetch_missing_descriptions,
+    apply_statements,
+    schema_cache,
 )
+import asyncio
+import functools
+import json
+import itertools
+import time
 import uuid
 
 
@@ -41,9 +96,12 @@ def setup_routes(app):
                     jsonify({"error": "Database does not exist or cannot be reached"}),
                     400,
                 )
+            if "replicas" in data:
+                data["replicas"] = format_replicas(data["replicas"])
             new_connection = DatabaseConnection(**data)
             session.add(new_connection)
             session.commit()
+            connection_registry.put(new_connection)
             return jsonify({"message": "Connection created successfully", "id": new_connection.id}), 201
         except Exception as e:
             session.rollback()
@@ -51,31 +109,13 @@ def setup_routes(app):
         finally:
             session.close()
 
-    # READ all database connections and list them
+    # READ all database connections and list them, from the in-memory registry
     @app.route("/connections", methods=["GET"])
     def get_connections():
-        session = SessionLocal()
         try:
-            connections = session.query(DatabaseConnection).all()
-            connections_list = [
-                {
-                    "id": conn.id,
-                    "name": conn.name,
-                    "host": conn.host,
-                    "port": conn.port,
-                    "database": conn.database,
-                    "username": conn.username,
-                    "password": conn.password,
-                }
-                for conn in connections
-            ]
-            for conn in connections_list:
-                conn.pop("_sa_instance_state", None)  # Remove the internal state
-            return jsonify(connections_list), 200
+            return jsonify(connection_registry.all()), 200
         except Exception as e:
             return jsonify({"error": str(e)}), 500
-        finally:
-            session.close()
 
     # Retrieve a specific database connection and UPDATE it
     @app.route("/connections/<int:id>", methods=["PUT"])
@@ -90,9 +130,17 @@ def setup_routes(app):
             )
             if not connection:
                 return jsonify({"error": "Connection not found"}), 404
+            if "replicas" in data:
+                data["replicas"] = format_replicas(data["replicas"])
             for key, value in data.items():
                 setattr(connection, key, value)
             session.commit()
+            connection_registry.put(connection)
+            # Connections pooled against the old details must not be reused
+            pool_manager.invalidate(id)
+            replica_router.forget(id)
+            invalidate_schema_cache(id)
+            result_cache.invalidate_connection(id)
             return jsonify({"message": "Connection updated successfully"}), 200
         except Exception as e:
             session.rollback()
@@ -114,6 +162,11 @@ def setup_routes(app):
                 return jsonify({"error": "Connection not found"}), 404
             session.delete(connection)
             session.commit()
+            connection_registry.remove(id)
+            pool_manager.invalidate(id)
+            replica_router.forget(id)
+            invalidate_schema_cache(id)
+            result_cache.invalidate_connection(id)
             return jsonify({"message": "Connection deleted successfully"}), 200
         except Exception as e:
             session.rollback()
@@ -128,7 +181,7 @@ def setup_routes(app):
             return jsonify({"error": "connection_id is required"}), 400
         try:
             with get_db_connection(
-                connection_id
+                connection_id, readonly=True
             ) as connection, connection.cursor() as cursor:
                 cursor.execute("SELECT current_database()")
                 database_name = cursor.fetchone()["current_database"]
@@ -142,81 +195,94 @@ def setup_routes(app):
         connection_id = request.args.get("connection_id")
         if not connection_id:
             return jsonify({"error": "connection_id is required"}), 400
-        schema_info = fetch_db_schemas(connection_id)
+        schema_info = fetch_db_schemas(connection_id, refresh=request_flag("refresh"))
         if not schema_info:
             return jsonify({"error": "Failed to fetch schema information"}), 500
         return jsonify({"schema": schema_info}), 200
 
     # Generate table names and descriptions in the database, if they are missing
+    # The missing set is split into chunks generated concurrently, and the COMMENTs are applied in
+    # one transaction; chunks generated by a run that stopped part way are reused by the next one
     @app.route("/generate-descriptions", methods=["POST"])
-    def generate_descriptions():
+    async def generate_descriptions():
         connection_id = request.args.get("connection_id")
         if not connection_id:
             return jsonify({"error": "connection_id is required"}), 400
-        schema = fetch_db_schemas(connection_id)
+        schema = await asyncio.to_thread(fetch_db_schemas, connection_id)
         if not schema:
             return jsonify({"error": "Failed to fetch table schema"}), 500
+        # Claimed up front, so a concurrent run gets a 409 on the streamed path too
         try:
-            with get_db_connection(
-                connection_id
-            ) as connection, connection.cursor() as cursor:
-                # Query for tables without descriptions
-                cursor.execute(
-                    """
-                    SELECT table_name
-                    FROM information_schema.tables
-                    WHERE table_schema = 'public'
-                    AND obj_description((table_schema || '.' || table_name)::regclass, 'pg_class') IS NULL;
-                """
-                )
-                tables_without_descriptions = cursor.fetchall()
-
-                # Query for columns without descriptions
-                cursor.execute(
-                    """
-                    SELECT table_name, column_name
-                    FROM information_schema.columns
-                    WHERE table_schema = 'public'
-                    AND pg_catalog.col_description(format('%s.%s', table_schema, table_name)::regclass, ordinal_position) IS NULL;
-                """
-                )
-                columns_without_descriptions = cursor.fetchall()
-
-                # Tables and columns without descriptions
-                missing_descriptions = {
-                    "tables_without_description": [
-                        table["table_name"] for table in tables_without_descriptions
-                    ],
-                    "columns_without_description": defaultdict(list),
-                }
+            job = claim_job(connection_id)
+        except DescriptionJobRunning as e:
+            return jsonify({"error": str(e)}), 409
+        try:
+            missing = await asyncio.to_thread(fetch_missing_descriptions, connection_id)
+            events = run_description_job(
+                connection_id,
+                plan_chunks(missing, schema),
+                functools.partial(apply_statements, connection_id),
+                job=job,
+            )
 
-                # Fill data for columns without descriptions
-                for row in columns_without_descriptions:
-                    table_name = row["table_name"]
-                    column_name = row["column_name"]
-                    missing_descriptions["columns_without_description"][
-                        table_name
-                    ].append(column_name)
-                missing_descriptions["columns_without_description"] = dict(
-                    missing_descriptions["columns_without_description"]
-                )
+            # Report progress as NDJSON, one event per generated chunk, when the client asks for it
+            if wants_stream():
 
-                commands = generate_details(missing_descriptions, schema)
-                if not commands:
-                    return jsonify({"error": "Failed to generate SQL commands"}), 500
+                def generate():
+                    try:
+                        for event in iterate_sync(events):
+                            yield event
+                    except Exception as e:
+                        yield {"type": "error", "error": str(e)}
+                    finally:
+                        # The new COMMENTs change the descriptions in the cached schema
+                        invalidate_schema_cache(connection_id)
 
-                # Filter out empty commands, split into a list of commands, and execute each command
-                commands = [c.strip() for c in commands.split(";") if c.strip()]
-                for command in commands:
-                    print(f"Executing command: {command}")  # Log the command
-                    cursor.execute(command)
-                connection.commit()
+                response = Response(
+                    stream_with_context(ndjson(generate())),
+                    mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"},
+                )
+                # A client that goes away before the stream starts must not leave the job claimed
+                response.call_on_close(lambda: release_job(job))
+                return response
 
-                return jsonify({"success": "Commands executed successfully"}), 200
+            try:
+                summary = [event async for event in events][-1]
+            finally:
+                invalidate_schema_cache(connection_id)
+            if summary["failedChunks"] and not summary["statements"]:
+                return jsonify({"error": "Failed to generate SQL commands"}), 500
+            return jsonify({"success": "Commands executed successfully", **summary}), 200
 
         except Exception as e:
+            release_job(job)
             return jsonify({"error": str(e)}), 500
 
+    # Progress of the latest description generation for a connection
+    @app.route("/generate-descriptions/status", methods=["GET"])
+    def get_description_status():
+        connection_id = request.args.get("connection_id")
+        if not connection_id:
+            return jsonify({"error": "connection_id is required"}), 400
+        return jsonify(job_status(connection_id) or {"status": "idle"}), 200
+
+    # Report hit/miss counters for the in-process caches
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        return (
+            jsonify(
+                {
+                    "schemaCache": schema_cache.stats(),
+                    "llmCache": llm_cache.stats(),
+                    "compression": compression_stats.stats(),
+                    "resultCache": result_cache.stats(),
+                    "replicas": replica_router.stats(),
+                }
+            ),
+            200,
+        )
+
     # List all tables in the database for user information
     @app.route("/tables", methods=["GET"])
     def get_tables():
@@ -228,7 +294,9 @@ def setup_routes(app):
             return jsonify({"error": "Failed to fetch table list"}), 500
         return jsonify({"tables": tables}), 200
 
-    # Retrieve details of a specific table in the database
+    # Retrieve details and one page of rows of a specific table in the database
+    # Query parameters: page_size, after (cursor from a previous page's nextCursor), count=estimate,
+    # format=columnar|arrow (see result_format)
     @app.route("/table-details/<table_name>", methods=["GET"])
     def get_table_details(table_name):
         connection_id = request.args.get("connection_id")
@@ -238,9 +306,49 @@ def setup_routes(app):
         if not connection_id:
             return jsonify({"error": "connection_id is required"}), 400
         try:
-            columns, row_count, data, description = fetch_table_details(
-                connection_id, table_name, schema_name
+            result_shape = result_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            page_size = int(request.args.get("page_size", Config.TABLE_PAGE_SIZE))
+            if page_size < 1:
+                raise ValueError
+        except ValueError:
+            return jsonify({"error": "page_size must be a positive integer"}), 400
+        page_size = min(page_size, Config.TABLE_MAX_PAGE_SIZE)
+        after = request.args.get("after")
+        try:
+            after = decode_page_cursor(after) if after else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        estimate_count = request.args.get("count") == "estimate"
+        try:
+            columns, row_count, data, description, next_cursor = fetch_table_details(
+                connection_id,
+                table_name,
+                schema_name,
+                page_size=page_size,
+                after=after,
+                estimate_count=estimate_count,
             )
+            names = [column["name"] for column in columns]
+            if result_shape == "arrow":
+                # Table details travel in the stream's schema metadata
+                body = rows_to_arrow(
+                    names,
+                    data,
+                    {
+                        "name": table_name,
+                        "schema": schema_name,
+                        "rowCount": row_count,
+                        "description": description,
+                        "pageSize": page_size,
+                        "nextCursor": next_cursor,
+                    },
+                )
+                return Response(body, mimetype=ARROW_MIMETYPE)
+            if result_shape == "columnar":
+                data = to_columnar(data, names)
             return (
                 jsonify(
                     {
@@ -250,17 +358,21 @@ def setup_routes(app):
                         "rowCount": row_count,
                         "data": data,
                         "description": description,
+                        "pageSize": page_size,
+                        "nextCursor": next_cursor,
                     }
                 ),
                 200,
             )
+        except PageCursorMismatch as e:
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
             print(f"Error in route: {str(e)}")
             return jsonify({"error": f"Internal Server Error: {str(e)}"}), 500
 
     # Accept a natural language query and analyze it to return table name and description
     @app.route("/analyze", methods=["POST"])
-    def analyze_natural_language():
+    async def analyze_natural_language():
         data = request.get_json()
         natlang_query = data.get("query", "")
         if not natlang_query:
@@ -268,13 +380,15 @@ def setup_routes(app):
         connection_id = request.args.get("connection_id")
         if not connection_id:
             return jsonify({"error": "connection_id is required"}), 400
-        schema = fetch_db_schemas(connection_id)
+        schema = await asyncio.to_thread(fetch_db_schemas, connection_id)
         if not schema:
             return jsonify({"error": "Failed to fetch table schema"}), 500
 
         try:
-            response = analyze_query(natlang_query, schema)
-            table_name, table_description = response.split("|")
+            response = await analyze_query_async(
+                natlang_query, schema, use_cache=not bypass_cache()
+            )
+            table_name, table_description = parse_analysis(response)
             return jsonify({"name": table_name, "description": table_description}), 200
         except ValueError:
             return jsonify({"error": "Invalid response format from analyze_query"}), 500
@@ -282,8 +396,16 @@ def setup_routes(app):
             return jsonify({"error": str(e)}), 500
 
     # Accept a natural language query and execute it on the loaded database
+    # With ?analyze=1 the result name and description are generated alongside the SQL
+    # With ?stream=sse the SQL is streamed as Server-Sent Events while it is generated, and
+    # ?early=1 starts running leading read-only statements before generation finishes
+    # ?format=columnar|arrow changes the shape of the results (see result_format)
+    # ?timeout_ms=, ?max_rows= and ?max_bytes= tighten the connection's execution budget, and an
+    # X-Query-Id header names the query for /queries/<id>/cancel
+    # ?preflight=1 checks the EXPLAIN estimates first (see respond_with_results); ?confirm=1 runs
+    # statements over the thresholds anyway
     @app.route("/queries", methods=["POST"])
-    def create_query():
+    async def create_query():
         data = request.get_json()
         natlang_query = data.get("query", "")
         if not natlang_query:
@@ -291,110 +413,667 @@ def setup_routes(app):
         connection_id = request.args.get("connection_id")
         if not connection_id:
             return jsonify({"error": "connection_id is required"}), 400
-        schema = fetch_db_schemas(connection_id)
+        try:
+            result_shape = result_format()
+            budget = request_budget(connection_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        query_id = request_query_id()
+        schema = await asyncio.to_thread(fetch_db_schemas, connection_id)
         if not schema:
             return jsonify({"error": "Failed to fetch table schema"}), 500
 
+        if wants_sse():
+            deltas = convert_query_stream(
+                natlang_query, schema, use_cache=not bypass_cache()
+            )
+            events = generate_and_execute(
+                deltas,
+                functools.partial(
+                    execute_queries_iter,
+                    connection_id,
+                    budget=budget,
+                    query_id=query_id,
+                    use_cache=not bypass_cache(),
+                ),
+                early=request_flag("early"),
+            )
+            return Response(
+                stream_with_context(sse(iterate_sync(events))),
+                mimetype="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                    "X-Query-Id": query_id,
+                },
+            )
+
         try:
-            with get_db_connection(
-                connection_id
-            ) as connection, connection.cursor() as cursor:
-                queries = convert_query(natlang_query, schema)
-                if not queries:
-                    return (
-                        jsonify(
-                            {
-                                "error": "Failed to generate SQL command(s) from the query"
-                            }
-                        ),
-                        500,
-                    )
-                queries = [q.strip() for q in queries.split(";") if q.strip()]
+            analysis = None
+            if request_flag("analyze"):
+                queries, response = await convert_and_analyze_async(
+                    natlang_query, schema, use_cache=not bypass_cache()
+                )
+                # A malformed name does not fail the query; the fields are just left empty
+                try:
+                    name, description = parse_analysis(response)
+                except ValueError:
+                    name, description = None, None
+                analysis = {"name": name, "description": description}
+            else:
+                queries = await convert_query_async(
+                    natlang_query, schema, use_cache=not bypass_cache()
+                )
+            if not queries:
+                return (
+                    jsonify(
+                        {"error": "Failed to generate SQL command(s) from the query"}
+                    ),
+                    500,
+                )
+            response = await respond_with_results(
+                connection_id,
+                split_statements(queries),
+                analysis,
+                result_shape,
+                budget,
+                query_id,
+            )
+            return with_query_id(response, query_id)
 
-                res, in_transaction = [], False
-                for query in queries:
-                    try:
-                        if query.lower() == "begin":
-                            cursor.execute(query)
-                            in_transaction = True
-                        elif query.lower() == "commit":
-                            if in_transaction:
-                                connection.commit()
-                                in_transaction = False
-                            else:
-                                raise ValueError(
-                                    "COMMIT issued without active transaction"
-                                )
-                        else:
-                            query_result = execute_query(
-                                cursor, connection, query, in_transaction
-                            )
-                            query_result["id"] = str(uuid.uuid4())
-                            res.append(query_result)
-                    except Exception as sql_error:
-                        if in_transaction:
-                            connection.rollback()
-                        return (
-                            jsonify(
-                                {
-                                    "error": f"SQL Execution Error: {str(sql_error)}",
-                                    "query": query,
-                                }
-                            ),
-                            500,
-                        )
-
-            return jsonify({"results": res}), 200
+        except Exception as e:
+            return jsonify({"error": f"Internal Server Error: {str(e)}"}), 500
 
+    # Accept a natural language query, then generate its SQL, result name and description in one
+    # completion and execute the SQL; responds like /queries?analyze=1
+    @app.route("/ask", methods=["POST"])
+    async def ask():
+        data = request.get_json()
+        natlang_query = data.get("query", "")
+        if not natlang_query:
+            return jsonify({"error": "No query provided"}), 400
+        connection_id = request.args.get("connection_id")
+        if not connection_id:
+            return jsonify({"error": "connection_id is required"}), 400
+        try:
+            result_shape = result_format()
+            budget = request_budget(connection_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        query_id = request_query_id()
+        schema = await asyncio.to_thread(fetch_db_schemas, connection_id)
+        if not schema:
+            return jsonify({"error": "Failed to fetch table schema"}), 500
+
+        try:
+            try:
+                answer = await convert_and_describe_async(
+                    natlang_query, schema, use_cache=not bypass_cache()
+                )
+            except ValueError as e:
+                return jsonify({"error": f"Invalid response format from convert_and_describe: {e}"}), 500
+            response = await respond_with_results(
+                connection_id,
+                split_statements(answer["sql"]),
+                {"name": answer["name"], "description": answer["description"]},
+                result_shape,
+                budget,
+                query_id,
+            )
+            return with_query_id(response, query_id)
         except Exception as e:
             return jsonify({"error": f"Internal Server Error: {str(e)}"}), 500
 
+    # Convert and execute a list of natural language queries against one connection
+    # The schema is fetched once; items run concurrently and are returned in request order,
+    # or streamed as NDJSON in completion order. "analyze": true also names each result
+    @app.route("/queries/batch", methods=["POST"])
+    async def create_query_batch():
+        data = request.get_json()
+        prompts = data.get("queries")
+        if not prompts or not isinstance(prompts, list):
+            return jsonify({"error": "No queries provided"}), 400
+        if not all(isinstance(prompt, str) and prompt for prompt in prompts):
+            return jsonify({"error": "Each query must be a non-empty string"}), 400
+        if len(prompts) > Config.BATCH_MAX_SIZE:
+            return (
+                jsonify({"error": f"At most {Config.BATCH_MAX_SIZE} queries per batch"}),
+                400,
+            )
+        connection_id = request.args.get("connection_id")
+        if not connection_id:
+            return jsonify({"error": "connection_id is required"}), 400
+        try:
+            budget = request_budget(connection_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # One id covers every item, so cancelling it stops the whole batch
+        query_id = request_query_id()
+        schema = await asyncio.to_thread(fetch_db_schemas, connection_id)
+        if not schema:
+            return jsonify({"error": "Failed to fetch table schema"}), 500
+
+        started = time.perf_counter()
+        items = run_batch(
+            prompts,
+            schema,
+            functools.partial(
+                execute_queries,
+                connection_id,
+                budget=budget,
+                query_id=query_id,
+                use_cache=not bypass_cache(),
+            ),
+            analyze=bool(data.get("analyze")),
+            use_cache=not bypass_cache(),
+        )
+
+        if wants_stream():
+
+            def generate():
+                failed = 0
+                for item in iterate_sync(items):
+                    failed += "error" in item
+                    yield {"type": "item", **item}
+                yield {
+                    "type": "summary",
+                    "count": len(prompts),
+                    "failed": failed,
+                    "elapsedMs": round((time.perf_counter() - started) * 1000, 3),
+                }
+
+            return Response(
+                stream_with_context(ndjson(generate())),
+                mimetype="application/x-ndjson",
+                headers={"X-Accel-Buffering": "no", "X-Query-Id": query_id},
+            )
+
+        try:
+            results = sorted([item async for item in items], key=lambda item: item["index"])
+            return (
+                jsonify(
+                    {
+                        "items": results,
+                        "failed": sum("error" in item for item in results),
+                        "elapsedMs": round((time.perf_counter() - started) * 1000, 3),
+                    }
+                ),
+                200,
+                {"X-Query-Id": query_id},
+            )
+        except Exception as e:
+            return jsonify({"error": f"Internal Server Error: {str(e)}"}), 500
+
+    # Cancel the statements running for a query id given in the X-Query-Id header of /queries,
+    # /ask or /queries/batch; the cancelled statement fails with a "canceling statement" error
+    @app.route("/queries/<query_id>/cancel", methods=["POST"])
+    def cancel_query(query_id):
+        if not running_queries.cancel(query_id):
+            return jsonify({"error": "No running query with that id"}), 404
+        return jsonify({"message": "Cancellation requested", "id": query_id}), 200
+
+
+# Execute generated statements and build the /queries response, merging any result name and
+# description into it; rows are streamed as NDJSON instead of buffered when the client asks for it.
+# result_shape is one of result_format's shapes; arrow takes exactly one read-only statement.
+# The statements run within budget and can be cancelled through query_id.
+# With preflight on, the statements are EXPLAINed first: any over the cost or row thresholds gets a
+# 409 with the plans unless ?confirm=1 is set, and the plan summaries are returned with the results
+async def respond_with_results(
+    connection_id, queries, analysis=None, result_shape="json", budget=None, query_id=None
+):
+    # Arrow streams through a named cursor, which cannot hold data-modifying CTEs
+    if result_shape == "arrow" and (len(queries) != 1 or not read_only(queries)):
+        return (
+            jsonify(
+                {
+                    "error": "The arrow format needs the query to be a single read-only SELECT",
+                    "queries": queries,
+                }
+            ),
+            400,
+        )
+
+    plans = None
+    if wants_preflight():
+        try:
+            plans = await asyncio.to_thread(preflight_queries, connection_id, queries, budget)
+        except Exception as e:
+            return jsonify({"error": f"Preflight Error: {str(e)}", "queries": queries}), 500
+        if any(plan["exceeds"] for plan in plans) and not request_flag("confirm"):
+            return (
+                jsonify(
+                    {
+                        "error": "Estimated cost is over the preflight threshold; "
+                        "repeat the request with confirm=1 to run it",
+                        "queries": queries,
+                        "plans": plans,
+                        **(analysis or {}),
+                    }
+                ),
+                409,
+            )
+
+    if result_shape == "arrow":
+        metadata = dict(analysis or {})
+        if plans is not None:
+            metadata["plans"] = json.dumps(plans)
+        return await respond_with_arrow(connection_id, queries[0], metadata, budget, query_id)
+
+    if wants_stream():
+
+        def generate():
+            if analysis is not None:
+                yield {"type": "analysis", **analysis}
+            if plans is not None:
+                yield {"type": "plans", "plans": plans}
+            with get_db_connection(
+                connection_id, readonly=read_only(queries)
+            ) as connection, connection.cursor() as cursor, running_queries.track(
+                query_id, connection
+            ):
+                try:
+                    for event in run_queries(
+                        connection,
+                        cursor,
+                        queries,
+                        stream=True,
+                        budget=budget,
+                        connection_id=connection_id,
+                    ):
+                        if result_shape == "columnar":
+                            event = columnar_event(event)
+                        yield event if "type" in event else {"type": "result", **event}
+                except SQLExecutionError as sql_error:
+                    yield {
+                        "type": "error",
+                        "error": f"SQL Execution Error: {str(sql_error.error)}",
+                        "query": sql_error.query,
+                    }
+
+        return Response(
+            stream_with_context(ndjson(generate())),
+            mimetype="application/x-ndjson",
+            headers={"X-Accel-Buffering": "no"},
+        )
+
+    try:
+        res = await asyncio.to_thread(
+            execute_queries,
+            connection_id,
+            queries,
+            budget=budget,
+            query_id=query_id,
+            use_cache=not bypass_cache(),
+        )
+    except SQLExecutionError as sql_error:
+        return (
+            jsonify(
+                {
+                    "error": f"SQL Execution Error: {str(sql_error.error)}",
+                    "query": sql_error.query,
+                }
+            ),
+            500,
+        )
+    if result_shape == "columnar":
+        res = results_to_columnar(res)
+    response = {"results": res, **(analysis or {})}
+    if plans is not None:
+        response["plans"] = plans
+    return jsonify(response), 200
+
+
+# Stream a single SELECT as an Arrow IPC stream, with the statement and any result name and
+# description in the schema metadata. The first batch is fetched before responding, so a failing
+# statement still gets a JSON error
+async def respond_with_arrow(connection_id, query, analysis=None, budget=None, query_id=None):
+    def generate():
+        with get_db_connection(
+            connection_id, readonly=read_only([query])
+        ) as connection, running_queries.track(query_id, connection):
+            with connection.cursor() as cursor:
+                apply_timeout(cursor, budget)
+            yield from stream_arrow(
+                connection, query, Config.STREAM_BATCH_SIZE, analysis, budget
+            )
+
+    body = generate()
+    try:
+        first = await asyncio.to_thread(next, body)
+    except Exception as e:
+        return (
+            jsonify({"error": f"SQL Execution Error: {str(e)}", "query": query}),
+            500,
+        )
+    return Response(
+        stream_with_context(itertools.chain([first], body)),
+        mimetype=ARROW_MIMETYPE,
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
+# Streamed rows events carry per-column arrays (in header column order) instead of row objects
+def columnar_event(event):
+    if event.get("type") == "rows":
+        return {"type": "rows", "id": event["id"], "data": to_columnar(event["rows"])["data"]}
+    if "type" in event:
+        return event
+    return results_to_columnar([event])[0]
+
+
+# Result shape requested with ?format=json|columnar|arrow, or an Accept header of
+# application/vnd.natlang.columnar+json or application/vnd.apache.arrow.stream;
+# raises ValueError for anything else, or for arrow when pyarrow is not installed
+def result_format():
+    requested = request.args.get("format")
+    if not requested:
+        best = request.accept_mimetypes.best_match(
+            ["application/json", COLUMNAR_MIMETYPE, ARROW_MIMETYPE]
+        )
+        requested = {COLUMNAR_MIMETYPE: "columnar", ARROW_MIMETYPE: "arrow"}.get(best, "json")
+    requested = requested.lower()
+    if requested not in FORMATS:
+        raise ValueError(
+            f"Unsupported format '{requested}', expected one of: {', '.join(sorted(FORMATS))}"
+        )
+    if requested == "arrow" and not arrow_available():
+        raise ValueError("The arrow format requires pyarrow to be installed")
+    return requested
+
+
+# Execution budget for this request: the connection's, tightened by ?timeout_ms=, ?max_rows= and
+# ?max_bytes=; raises ValueError for values that are not positive integers
+def request_budget(connection_id):
+    limits = {}
+    for name in ("timeout_ms", "max_rows", "max_bytes"):
+        value = request.args.get(name)
+        if value is None:
+            continue
+        try:
+            limits[name] = int(value)
+        except ValueError:
+            limits[name] = 0
+        if limits[name] < 1:
+            raise ValueError(f"{name} must be a positive integer")
+    return ExecutionBudget.for_connection(connection_id).narrowed(**limits)
+
+
+# Preflight runs when ?preflight=1 is given, or by default with QUERY_PREFLIGHT set (?preflight=0 skips it)
+def wants_preflight():
+    if request.args.get("preflight") is None:
+        return Config.QUERY_PREFLIGHT
+    return request_flag("preflight")
+
+
+# The client's X-Query-Id for cancelling this request's statements, or a new one
+def request_query_id():
+    return request.headers.get("X-Query-Id") or str(uuid.uuid4())
 
-# Unified function to execute various types of queries
-def execute_query(cursor, connection, query, in_transaction=False):
-    table_name = get_table_name(query)
 
-    if query.lower().startswith("select"):
-        cursor.execute(query)
-        return {"Query": query, "Results": cursor.fetchall()}
+# Echo the query id on a view's response, whatever form the view returned it in
+def with_query_id(response, query_id):
+    response = make_response(response)
+    response.headers["X-Query-Id"] = query_id
+    return response
 
-    elif query.lower().startswith("insert"):
-        cursor.execute(f"SELECT * FROM {table_name}")
-        pre_insertion = cursor.fetchall()
 
-        cursor.execute(query)
-        if not in_transaction:
-            connection.commit()
-        rows_affected = cursor.rowcount
+# Read a boolean query string flag such as ?refresh=1
+def request_flag(name):
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
 
-        cursor.execute(f"SELECT * FROM {table_name}")
-        post_insertion = cursor.fetchall()
 
-        new_rows = get_new_rows(pre_insertion, post_insertion)
+# Cached LLM answers are skipped with an X-Cache-Bypass: 1 or Cache-Control: no-cache header
+def bypass_cache():
+    return request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true") or (
+        "no-cache" in request.headers.get("Cache-Control", "").lower()
+    )
 
-        return {
+
+# Server-Sent Events are requested with ?stream=sse or an Accept: text/event-stream header
+def wants_sse():
+    return request.args.get("stream", "").lower() == "sse" or (
+        request.accept_mimetypes.best == "text/event-stream"
+    )
+
+
+# Streaming is requested with ?stream=1 or an Accept: application/x-ndjson header
+def wants_stream():
+    return request_flag("stream") or (
+        request.accept_mimetypes.best == "application/x-ndjson"
+    )
+
+
+# Split an analyze_query answer of the form 'name|description'; raises ValueError otherwise
+def parse_analysis(response):
+    table_name, table_description = response.split("|")
+    return table_name, table_description
+
+
+# Raised when a generated statement fails, carrying the statement that failed
+class SQLExecutionError(Exception):
+    def __init__(self, query, error):
+        super().__init__(str(error))
+        self.query = query
+        self.error = error
+
+
+# Execute generated statements in order, yielding one result per statement
+# BEGIN/COMMIT are honoured; with stream set, SELECTs yield header/rows/trailer events instead
+# Each statement runs under the budget's statement_timeout, and returns rows within its caps
+# Writes invalidate the result cache of connection_id; with use_cache set, read-only SELECTs
+# outside a transaction are also answered from it and stored in it
+def run_queries(
+    connection, cursor, queries, stream=False, budget=None, connection_id=None, use_cache=False
+):
+    in_transaction = False
+    written = []
+    for query in queries:
+        try:
+            statement = parse_statement(query)
+            statement_type = statement.type
+            # Data-modifying CTEs are typed as SELECTs but still write
+            writes = (
+                statement_type not in ("begin", "commit")
+                and not statement.is_read_only
+                and connection_id is not None
+            )
+            if statement_type == "begin":
+                cursor.execute(query)
+                in_transaction = True
+            elif statement_type == "commit":
+                if in_transaction:
+                    connection.commit()
+                    in_transaction = False
+                    # Other requests may have cached the old rows while the transaction was open
+                    for write in written:
+                        record_write(connection_id, write)
+                    written = []
+                else:
+                    raise ValueError("COMMIT issued without active transaction")
+            elif stream and statement.is_read_only:
+                # Streamed through a named cursor (DECLARE), which rejects data-modifying CTEs;
+                # those and other writes run through execute_query below
+                # SET LOCAL ends with the transaction, and statements may commit as they go
+                apply_timeout(cursor, budget)
+                yield from stream_select(
+                    connection, query, str(uuid.uuid4()), budget=budget
+                )
+            else:
+                cacheable = (
+                    use_cache
+                    and connection_id is not None
+                    and not in_transaction
+                    and statement.is_cacheable
+                )
+                query_result = cached_result(connection_id, query, budget) if cacheable else None
+                if query_result is None:
+                    apply_timeout(cursor, budget)
+                    query_result = execute_query(
+                        cursor, connection, query, in_transaction, budget
+                    )
+                    if cacheable:
+                        query_result["Cached"] = False
+                        if "Truncated" not in query_result:
+                            result_cache.put(connection_id, query, query_result["Results"])
+                if writes:
+                    record_write(connection_id, query)
+                    if in_transaction:
+                        written.append(query)
+                query_result["id"] = str(uuid.uuid4())
+                yield query_result
+        except Exception as sql_error:
+            if in_transaction:
+                connection.rollback()
+            raise SQLExecutionError(query, sql_error)
+
+
+# Drop the cached results a write made stale, and keep the connection's reads on the primary
+# while replicas catch up
+def record_write(connection_id, query):
+    result_cache.invalidate_statement(connection_id, query)
+    replica_router.record_write(connection_id)
+
+
+# Run generated statements on a pooled connection and collect their results
+def execute_queries(connection_id, queries, budget=None, query_id=None, use_cache=True):
+    return list(execute_queries_iter(connection_id, queries, budget, query_id, use_cache))
+
+
+# Run statements on a pooled connection as they are taken from an iterable, yielding each result
+# Without a budget the connection's own applies; query_id lets the client cancel the statements
+def execute_queries_iter(connection_id, queries, budget=None, query_id=None, use_cache=True):
+    if budget is None:
+        budget = ExecutionBudget.for_connection(connection_id)
+    with get_db_connection(
+        connection_id, readonly=read_only(queries)
+    ) as connection, connection.cursor() as cursor:
+        with running_queries.track(query_id or str(uuid.uuid4()), connection):
+            yield from run_queries(
+                connection,
+                cursor,
+                queries,
+                budget=budget,
+                connection_id=connection_id,
+                use_cache=use_cache,
+            )
+
+
+# Whether every statement is known up front to be read-only, so a replica can run them
+# Statements still arriving from an iterator may include writes
+def read_only(queries):
+    return isinstance(queries, (list, tuple)) and all(
+        parse_statement(query).is_read_only for query in queries
+    )
+
+
+# A cached result for a read-only SELECT, marked with its age, unless the budget is tighter
+# than the cached rows
+def cached_result(connection_id, query, budget):
+    hit = result_cache.get(connection_id, query)
+    if hit is None:
+        return None
+    cached, age = hit
+    if budget is not None and (
+        (budget.max_rows and len(cached.rows) > budget.max_rows)
+        or (budget.max_bytes and cached.size > budget.max_bytes)
+    ):
+        return None
+    return {"Query": query, "Results": cached.rows, "Cached": True, "CacheAge": age}
+
+
+# Rows a statement returned, marked when the budget's row or byte cap cut them short
+def with_rows(result, key, rows, truncated):
+    result[key] = rows
+    if truncated:
+        result["Truncated"] = truncated
+    return result
+
+
+# Run a SELECT (including WITH ... SELECT and VALUES) and return its rows
+def execute_select(cursor, connection, query, in_transaction=False, budget=None):
+    rows, truncated = fetch_select(cursor, connection, query, budget)
+    return with_rows({"Query": query}, "Results", rows, truncated)
+
+
+# The affected rows come back with the statement itself through RETURNING
+def execute_insert(cursor, connection, query, in_transaction=False, budget=None):
+    cursor.execute(add_returning(query))
+    new_rows, truncated = fetch_rows(cursor, budget) if cursor.description else ([], None)
+    rows_affected = cursor.rowcount
+    if not in_transaction:
+        connection.commit()
+
+    return with_rows(
+        {
             "Query": query,
             "Message": f"{rows_affected} rows affected",
-            "NewRows": new_rows,
             "Action": "insert",
-        }
-
-    elif query.lower().startswith("delete"):
-        table_name = get_table_name(query)
-        deleted_rows = f"SELECT * FROM {table_name} WHERE {get_where_clause(query)}"
-        cursor.execute(deleted_rows)
-        rows_to_delete = cursor.fetchall()
-        cursor.execute(query)
-        if not in_transaction:
-            connection.commit()
-        rows_affected = cursor.rowcount
-        return {
+        },
+        "NewRows",
+        new_rows,
+        truncated,
+    )
+
+
+# Capture each updated row before and after the change in the same round trip
+# Statements the rewrite cannot handle still return the new rows, without the old ones
+def execute_update(cursor, connection, query, in_transaction=False, budget=None):
+    capture = build_update_capture(query)
+    if capture:
+        cursor.execute(capture)
+        updated_rows, truncated = fetch_rows(cursor, budget)
+    else:
+        cursor.execute(add_returning(query))
+        rows, truncated = fetch_rows(cursor, budget) if cursor.description else ([], None)
+        updated_rows = [{"before": None, "after": row} for row in rows]
+    rows_affected = cursor.rowcount
+    if not in_transaction:
+        connection.commit()
+
+    return with_rows(
+        {
+            "Query": query,
+            "Message": f"{rows_affected} rows affected",
+            "Action": "update",
+        },
+        "UpdatedRows",
+        updated_rows,
+        truncated,
+    )
+
+
+def execute_delete(cursor, connection, query, in_transaction=False, budget=None):
+    cursor.execute(add_returning(query))
+    deleted_rows, truncated = fetch_rows(cursor, budget) if cursor.description else ([], None)
+    rows_affected = cursor.rowcount
+    if not in_transaction:
+        connection.commit()
+    return with_rows(
+        {
             "Query": query,
             "Message": f"{rows_affected} rows affected",
-            "DeletedRows": rows_to_delete,
             "Action": "delete",
-        }
+        },
+        "DeletedRows",
+        deleted_rows,
+        truncated,
+    )
 
+
+# Handlers for each supported statement type, keyed by the statement's main verb
+STATEMENT_HANDLERS = {
+    "select": execute_select,
+    "insert": execute_insert,
+    "update": execute_update,
+    "delete": execute_delete,
+}
+
+
+# Unified function to execute various types of queries
+def execute_query(cursor, connection, query, in_transaction=False, budget=None):
+    handler = STATEMENT_HANDLERS.get(get_statement_type(query))
     # Handle unsupported query types
-    else:
+    if handler is None:
         raise ValueError(f"Unsupported query type for: {query}")
+    return handler(cursor, connection, query, in_transaction, budget)
@@ -0,0 +1,131 @@
+import math
+import re
+from collections import Counter, defaultdict
+from cache import TTLCache
+from config import Config
+
+# BM25 term-frequency saturation and document-length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORDS = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+
+# Split text into lowercase terms, breaking snake_case and camelCase names apart
+# Plural terms also yield their singular form so "orders" matches an "order" table
+def terms(text):
+    result = []
+    for word in _WORDS.findall(text or ""):
+        word = word.lower()
+        result.append(word)
+        if len(word) > 3 and word.endswith("ies"):
+            result.append(word[:-3] + "y")
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            result.append(word[:-1])
+    return result
+
+
+# BM25 index over the tables of a schema, built from table and column names, descriptions
+# and the names of the tables each table references through foreign keys
+class SchemaIndex:
+    def __init__(self, schema):
+        self.tables = []
+        self.references = defaultdict(set)
+        self._postings = defaultdict(list)
+        lengths = []
+        for schema_name, tables in schema.items():
+            for table, columns in tables.items():
+                key = f"{schema_name}.{table}"
+                # Table names count twice, since a request usually names the entity it is about
+                document = terms(table) * 2 + terms(schema_name)
+                for column in columns:
+                    document += terms(column["name"]) + terms(column["description"])
+                    for fk in column["foreign_keys"]:
+                        self.references[key].add(fk["table"])
+                        document += terms(fk["table"].split(".")[-1])
+                for term, frequency in Counter(document).items():
+                    self._postings[term].append((len(self.tables), frequency))
+                self.tables.append(key)
+                lengths.append(len(document))
+        self._lengths = lengths
+        self._average_length = sum(lengths) / len(lengths) if lengths else 0
+
+    # Rank tables against a request, returning (table, score) pairs with a positive score
+    def search(self, prompt, limit=None):
+        scores = defaultdict(float)
+        count = len(self.tables)
+        for term in set(terms(prompt)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, frequency in postings:
+                norm = 1 - BM25_B + BM25_B * self._lengths[doc] / self._average_length
+                scores[doc] += idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(self.tables[doc], score) for doc, score in ranked[:limit]]
+
+    # The top_k tables for a request plus the tables they reach within depth foreign-key hops
+    def select_tables(self, prompt, top_k, depth=Config.SCHEMA_PRUNE_FK_DEPTH):
+        frontier = {table for table, _ in self.search(prompt, top_k)}
+        selected = set(frontier)
+        for _ in range(depth):
+            frontier = {
+                target
+                for table in frontier
+                for target in self.references.get(table, ())
+                if target not in selected
+            }
+            if not frontier:
+                break
+            selected |= frontier
+        return selected
+
+
+# Indexes keyed by id() of the schema dict they were built from; fetch_db_schemas hands out
+# the same dict while the catalog is unchanged, and each entry keeps its schema alive so ids stay valid
+_index_cache = TTLCache(maxsize=Config.SCHEMA_CACHE_SIZE)
+
+
+# Pruned schemas by source schema and selected tables, so a repeated selection yields the
+# same dict and its rendered prompt text can be reused
+_pruned_cache = TTLCache(maxsize=Config.SCHEMA_CACHE_SIZE * 16)
+
+
+def get_schema_index(schema):
+    entry = _index_cache.get(id(schema), validate=lambda entry: entry[0] is schema)
+    if entry is None:
+        entry = (schema, SchemaIndex(schema))
+        _index_cache.set(id(schema), entry)
+    return entry[1]
+
+
+# Reduce a schema to the tables relevant to a request, keeping the original order
+# Small schemas, and requests that match nothing, are returned unchanged
+def prune_schema(
+    schema,
+    prompt,
+    top_k=Config.SCHEMA_PRUNE_TOP_K,
+    min_tables=Config.SCHEMA_PRUNE_MIN_TABLES,
+):
+    table_count = sum(len(tables) for tables in schema.values())
+    if top_k <= 0 or table_count <= max(top_k, min_tables):
+        return schema
+    selected = get_schema_index(schema).select_tables(prompt, top_k)
+    if not selected:
+        return schema
+    key = (id(schema), frozenset(selected))
+    cached = _pruned_cache.get(key, validate=lambda entry: entry[0] is schema)
+    if cached is not None:
+        return cached[1]
+    pruned = {}
+    for schema_name, tables in schema.items():
+        kept = {
+            table: columns
+            for table, columns in tables.items()
+            if f"{schema_name}.{table}" in selected
+        }
+        if kept:
+            pruned[schema_name] = kept
+    _pruned_cache.set(key, (schema, pruned))
+    return pruned
@@ -0,0 +1,514 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Token kinds produced by the lexer
+WORD = "word"
+QUOTED_IDENT = "quoted_ident"
+STRING = "string"
+NUMBER = "number"
+PARAM = "param"
+OPERATOR = "operator"
+PUNCT = "punct"
+COMMENT = "comment"
+WHITESPACE = "whitespace"
+
+# A lexed token; value is the exact source text, so joining every token's value rebuilds the input
+Token = namedtuple("Token", ["kind", "value", "start"])
+
+# Each pattern is anchored at the scan position and has no nested quantifiers, so matching is linear
+_WHITESPACE = re.compile(r"\s+")
+_WORD = re.compile(r"[^\W\d]\w*(?:\$\w*)*")
+_NUMBER = re.compile(r"(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_PARAM = re.compile(r"\$\d+")
+_DOLLAR_TAG = re.compile(r"\$(?:[^\W\d]\w*)?\$")
+# An operator never contains the start of a comment
+_OPERATOR = re.compile(r"(?:[+*<>=~!@#%^&|`?:]|-(?!-)|/(?!\*))+")
+
+_PUNCT = "(),;[]."
+
+# Words after which a name is a table reference
+_TABLE_INTRODUCERS = {"from", "join", "into", "update", "table", "truncate"}
+# Words that can start a query inside parentheses
+_QUERY_STARTS = {"select", "with", "values", "insert", "update", "delete", "table"}
+# Words that end a WHERE clause at the same nesting level
+_WHERE_TERMINATORS = {
+    "group", "order", "limit", "offset", "returning", "having", "window",
+    "for", "union", "intersect", "except", "fetch", "on",
+}
+# Words that cannot be a table alias
+_NOT_ALIASES = {
+    "where", "join", "inner", "left", "right", "full", "cross", "natural", "on",
+    "using", "group", "order", "limit", "offset", "having", "window", "union",
+    "intersect", "except", "returning", "set", "values", "select", "default",
+    "for", "fetch", "lateral", "tablesample", "as", "with", "do", "overriding",
+}
+_DATA_MODIFYING = {"insert", "update", "delete", "merge"}
+# Built-in functions that change data or server state, or fail in a read-only transaction
+# Functions defined in the database itself cannot be told apart and are taken at their word
+_SIDE_EFFECT_FUNCTIONS = {
+    "nextval", "setval", "setseed", "set_config", "txid_current", "pg_current_xact_id",
+    "pg_notify", "pg_terminate_backend", "pg_cancel_backend", "pg_reload_conf",
+    "pg_rotate_logfile", "pg_switch_wal", "pg_create_restore_point", "pg_promote",
+    "pg_logical_emit_message", "pg_import_system_collations", "dblink_exec",
+}
+_SIDE_EFFECT_PREFIXES = (
+    "pg_advisory_", "pg_try_advisory_", "lo_", "pg_stat_reset", "pg_create_", "pg_drop_",
+    "pg_replication_", "pg_backup_", "pg_start_backup", "pg_stop_backup",
+)
+# Functions and keywords whose value changes from one run to the next
+_VOLATILE = {
+    "random", "random_normal", "gen_random_uuid", "uuid_generate_v1", "uuid_generate_v4",
+    "now", "clock_timestamp", "statement_timestamp", "transaction_timestamp", "timeofday",
+    "current_timestamp", "current_time", "current_date", "localtime", "localtimestamp",
+    "pg_sleep", "currval", "lastval",
+}
+
+
+# Find the end of a quoted token starting at pos, where a doubled quote character is an escape
+# With backslashes set, a backslash escapes the next character (E'...' strings)
+# Returns None when the closing quote may still arrive and final is not set
+def _scan_quoted(text, pos, quote, final, backslashes=False):
+    i = pos + 1
+    length = len(text)
+    while True:
+        end = text.find(quote, i)
+        if backslashes:
+            slash = text.find("\\", i)
+            if slash != -1 and (end == -1 or slash < end):
+                i = slash + 2
+                if i > length:
+                    return length if final else None
+                continue
+        if end == -1:
+            return length if final else None
+        if end + 1 < length:
+            if text[end + 1] == quote:
+                i = end + 2
+                continue
+            return end + 1
+        # The quote is the last character; it could be the first half of an escape
+        return end + 1 if final else None
+
+
+# Find the end of a possibly nested /* */ comment starting at pos
+def _scan_block_comment(text, pos, final):
+    depth, i = 1, pos + 2
+    while depth:
+        close = text.find("*/", i)
+        if close == -1:
+            return len(text) if final else None
+        opening = text.find("/*", i, close)
+        if opening != -1:
+            depth, i = depth + 1, opening + 2
+        else:
+            depth, i = depth - 1, close + 2
+    return i
+
+
+# Scan the token starting at pos, returning (kind, end)
+# Returns None when the token could extend past the end of text and more input may follow
+def _scan(text, pos, final):
+    char = text[pos]
+    length = len(text)
+    # Characters that may change meaning depending on what follows need one more character of input
+    if not final and pos + 1 == length and char in "-/$eE.":
+        return None
+
+    if char.isspace():
+        return WHITESPACE, _WHITESPACE.match(text, pos).end()
+    if char == "-" and text.startswith("--", pos):
+        end = text.find("\n", pos)
+        if end == -1:
+            return (COMMENT, length) if final else None
+        return COMMENT, end
+    if char == "/" and text.startswith("/*", pos):
+        end = _scan_block_comment(text, pos, final)
+        return None if end is None else (COMMENT, end)
+    if char == "'":
+        end = _scan_quoted(text, pos, "'", final)
+        return None if end is None else (STRING, end)
+    if char in "eE" and text[pos + 1: pos + 2] == "'":
+        end = _scan_quoted(text, pos + 1, "'", final, backslashes=True)
+        return None if end is None else (STRING, end)
+    if char == '"':
+        end = _scan_quoted(text, pos, '"', final)
+        return None if end is None else (QUOTED_IDENT, end)
+    if char == "$":
+        match = _PARAM.match(text, pos)
+        if match:
+            end = match.end()
+            return None if end == length and not final else (PARAM, end)
+        match = _DOLLAR_TAG.match(text, pos)
+        if match:
+            tag = match.group()
+            close = text.find(tag, match.end())
+            if close == -1:
+                return (STRING, length) if final else None
+            return STRING, close + len(tag)
+        # A tag that has not been closed yet, such as "$bod"
+        if not final and re.fullmatch(r"\$(?:[^\W\d]\w*)?", text[pos:]):
+            return None
+        return OPERATOR, pos + 1
+    if char.isdigit() or (char == "." and text[pos + 1: pos + 2].isdigit()):
+        end = _NUMBER.match(text, pos).end()
+        # An exponent such as "e+5" may still be arriving
+        return None if length - end < 3 and not final else (NUMBER, end)
+    match = _WORD.match(text, pos)
+    if match:
+        end = match.end()
+        return None if end == length and not final else (WORD, end)
+    if char in _PUNCT:
+        return PUNCT, pos + 1
+    match = _OPERATOR.match(text, pos)
+    if match:
+        end = match.end()
+        return None if end == length and not final else (OPERATOR, end)
+    return OPERATOR, pos + 1
+
+
+# Lex SQL text into tokens in a single left-to-right pass
+def tokenize(text):
+    pos, length = 0, len(text)
+    while pos < length:
+        kind, end = _scan(text, pos, True)
+        yield Token(kind, text[pos:end], pos)
+        pos = end
+
+
+# Incrementally split SQL text into statements as it arrives, for example from a streamed completion
+# Semicolons inside strings, quoted identifiers, dollar-quoted bodies, comments and parentheses are ignored
+class StatementSplitter:
+    def __init__(self):
+        # Unfinished text, starting at the beginning of the current statement
+        self._buffer = ""
+        # Where scanning resumes, always on a token boundary
+        self._pos = 0
+        self._depth = 0
+        # Whether the current statement has anything besides whitespace and comments
+        self._content = False
+
+    # Add more text and return the statements it completed
+    def feed(self, text):
+        self._buffer += text
+        return self._split(final=False)
+
+    # Return the trailing statement that was not terminated by a semicolon, if any
+    def finish(self):
+        statements = self._split(final=True)
+        if self._content:
+            statements.append(self._buffer.strip())
+        self._buffer, self._pos, self._depth, self._content = "", 0, 0, False
+        return statements
+
+    def _split(self, final):
+        statements = []
+        buffer, pos, start = self._buffer, self._pos, 0
+        while pos < len(buffer):
+            scanned = _scan(buffer, pos, final)
+            if scanned is None:
+                break
+            kind, end = scanned
+            if kind == PUNCT and buffer[pos] == ";" and self._depth == 0:
+                if self._content:
+                    statements.append(buffer[start:pos].strip())
+                start, self._content = end, False
+            elif kind not in (WHITESPACE, COMMENT):
+                self._content = True
+                if kind == PUNCT and buffer[pos] == "(":
+                    self._depth += 1
+                elif kind == PUNCT and buffer[pos] == ")":
+                    self._depth = max(self._depth - 1, 0)
+            pos = end
+        # Drop the completed statements once per call, so splitting stays linear in the input size
+        self._buffer, self._pos = buffer[start:], pos - start
+        return statements
+
+
+# Split a complete SQL script into its statements
+def split_statements(text):
+    splitter = StatementSplitter()
+    return splitter.feed(text) + splitter.finish()
+
+
+# Normalize an identifier the way PostgreSQL does: fold unquoted names to lower case
+def _identifier(token):
+    if token.kind == QUOTED_IDENT:
+        return token.value[1:-1].replace('""', '"')
+    return token.value.lower()
+
+
+# Lightweight syntax tree for one statement: its type, the tables it reads and writes, and its WHERE clause
+class Statement:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = [t for t in tokenize(text) if t.kind not in (WHITESPACE, COMMENT)]
+        self._match_parens()
+        self.ctes = {}
+        self.main = self._skip_ctes(0)
+        self.type = self._word(self.main)
+        if self.type in ("values", "table"):
+            self.type = "select"
+        elif self.type == "start":
+            self.type = "begin"
+        elif self.type == "end":
+            self.type = "commit"
+        self.tables = self._find_tables()
+        self.target = self._find_target()
+        self.where = self._find_where()
+
+    # Whether running the statement cannot change data, so it is safe to retry or route to a replica
+    @property
+    def is_read_only(self):
+        if self.type != "select":
+            return False
+        if any(cte_type in _DATA_MODIFYING for cte_type in self.ctes.values()):
+            return False
+        for index in self.top_level():
+            word = self._word(index)
+            # SELECT ... INTO creates a table, and FOR UPDATE/SHARE takes row locks
+            if word == "into" or (word == "for" and self._word(index + 1) in ("update", "share", "no", "key")):
+                return False
+        return not any(
+            name in _SIDE_EFFECT_FUNCTIONS or name.startswith(_SIDE_EFFECT_PREFIXES)
+            for name in self.functions()
+        )
+
+    # Whether the statement is read-only and returns the same rows each time while the data is
+    # unchanged, so its result can be cached
+    @property
+    def is_cacheable(self):
+        if not self.is_read_only:
+            return False
+        words = {_identifier(t) for t in self.tokens if t.kind in (WORD, QUOTED_IDENT)}
+        return words.isdisjoint(_VOLATILE)
+
+    # Names of the functions called anywhere in the statement, without their schema
+    def functions(self):
+        return {
+            _identifier(token)
+            for token, following in zip(self.tokens, self.tokens[1:])
+            if token.kind in (WORD, QUOTED_IDENT) and following.value == "("
+        }
+
+    # Whether the main statement has a clause introduced by the given keyword outside parentheses
+    def has_clause(self, keyword):
+        return any(self._word(index) == keyword for index in self.top_level())
+
+    # Split a plain UPDATE into the text of its target, alias, SET, FROM and WHERE clauses, and
+    # whether it is UPDATE ONLY. Returns None for other statements and for ones with WITH or RETURNING
+    def update_parts(self):
+        if self.type != "update" or self.main != 0:
+            return None
+        only = self._word(1) == "only"
+        index = 2 if only else 1
+        name, end = self._read_name(index)
+        if not name:
+            return None
+        target = self.slice(index, end)
+        index, alias = end, None
+        if self._word(index) == "as":
+            index += 1
+        if self._word(index) != "set" and index < len(self.tokens):
+            alias = self.tokens[index].value
+            index += 1
+        if self._word(index) != "set":
+            return None
+
+        clauses = {}
+        for position in self.top_level():
+            word = self._word(position)
+            if position > index and word in ("from", "where", "returning"):
+                clauses.setdefault(word, position)
+        if "returning" in clauses:
+            return None
+        set_end = clauses.get("from", clauses.get("where"))
+        return {
+            "target": target,
+            "only": only,
+            "alias": alias,
+            "set": self.slice(index + 1, set_end),
+            "from": self.slice(clauses["from"] + 1, clauses.get("where")) if "from" in clauses else None,
+            "where": self.slice(clauses["where"] + 1) if "where" in clauses else None,
+        }
+
+    # Indexes of the main statement's tokens that are not nested inside parentheses
+    def top_level(self):
+        index = self.main
+        while index < len(self.tokens):
+            yield index
+            if self.tokens[index].value == "(" and self._close[index] is not None:
+                index = self._close[index]
+            else:
+                index += 1
+
+    # The source text between two token indexes
+    def slice(self, start, end=None):
+        stop = self.tokens[end].start if end is not None and end < len(self.tokens) else len(self.text)
+        return self.text[self.tokens[start].start:stop].strip() if start < len(self.tokens) else ""
+
+    def _word(self, index):
+        if 0 <= index < len(self.tokens) and self.tokens[index].kind == WORD:
+            return self.tokens[index].value.lower()
+        return None
+
+    def _is(self, index, value):
+        return 0 <= index < len(self.tokens) and self.tokens[index].kind == PUNCT and self.tokens[index].value == value
+
+    # Pair each opening parenthesis with its closing one, and record each token's nesting depth
+    def _match_parens(self):
+        self._close = [None] * len(self.tokens)
+        self._depth = [0] * len(self.tokens)
+        stack = []
+        for index, token in enumerate(self.tokens):
+            if token.kind == PUNCT and token.value == ")" and stack:
+                self._close[stack.pop()] = index
+            self._depth[index] = len(stack)
+            if token.kind == PUNCT and token.value == "(":
+                stack.append(index)
+
+    # Walk a WITH list starting at index, recording each CTE's name and statement type
+    # Returns the index of the statement the CTEs belong to
+    def _skip_ctes(self, index):
+        if self._word(index) != "with":
+            return index
+        index += 1
+        if self._word(index) == "recursive":
+            index += 1
+        while index < len(self.tokens):
+            name = _identifier(self.tokens[index])
+            index += 1
+            if self._is(index, "(") and self._close[index] is not None:
+                index = self._close[index] + 1  # Column list
+            if self._word(index) == "as":
+                index += 1
+            while self._word(index) in ("not", "materialized"):
+                index += 1
+            if not self._is(index, "(") or self._close[index] is None:
+                return index
+            body = self._skip_ctes(index + 1)
+            self.ctes[name] = self._word(body)
+            index = self._close[index] + 1
+            if not self._is(index, ","):
+                return index
+            index += 1
+        return index
+
+    # Whether the parentheses opened at index hold a query rather than an expression or list
+    def _is_subquery(self, index):
+        return self._word(index + 1) in _QUERY_STARTS
+
+    # Read a possibly schema-qualified name at index, returning (name, next_index)
+    def _read_name(self, index):
+        parts = []
+        while index < len(self.tokens) and self.tokens[index].kind in (WORD, QUOTED_IDENT):
+            parts.append(_identifier(self.tokens[index]))
+            index += 1
+            if not self._is(index, "."):
+                break
+            index += 1
+        return ".".join(parts), index
+
+    # Skip an optional alias after a table name
+    def _skip_alias(self, index):
+        if self._word(index) == "as":
+            index += 1
+        token = self.tokens[index] if index < len(self.tokens) else None
+        if token is not None and (token.kind == QUOTED_IDENT or (token.kind == WORD and token.value.lower() not in _NOT_ALIASES)):
+            index += 1
+            if self._is(index, "(") and self._close[index] is not None:
+                index = self._close[index] + 1  # Column aliases
+        return index
+
+    # Collect every table referenced anywhere in the statement, excluding CTE names
+    def _find_tables(self):
+        tables = []
+        # Track which open parentheses hold queries; FROM inside EXTRACT(... FROM ...) is not a table
+        query_context = [True]
+        index = 0
+        while index < len(self.tokens):
+            token = self.tokens[index]
+            if token.kind == PUNCT and token.value == "(":
+                query_context.append(self._is_subquery(index))
+            elif token.kind == PUNCT and token.value == ")":
+                if len(query_context) > 1:
+                    query_context.pop()
+            elif token.kind == WORD and query_context[-1]:
+                word = token.value.lower()
+                if word in _TABLE_INTRODUCERS:
+                    index = self._read_table_list(index + 1, tables, word)
+                    continue
+            index += 1
+        return tables
+
+    # Read the table (or comma-separated tables, after FROM) following an introducing keyword
+    def _read_table_list(self, index, tables, introducer):
+        previous = self._word(index - 2)
+        # FOR UPDATE, ON CONFLICT DO UPDATE and IS DISTINCT FROM do not name a table
+        if introducer == "update" and previous in ("for", "key", "no", "do", "then"):
+            return index
+        if introducer == "from" and previous == "distinct":
+            return index
+        if introducer == "table" and self._word(index) == "if":
+            index += 2 if self._word(index + 1) == "exists" else 3
+        while True:
+            if self._word(index) in ("only", "lateral"):
+                index += 1
+            name, end = self._read_name(index)
+            if not name or (self._is(end, "(") and introducer not in ("into", "table")):
+                # A subquery or a set-returning function call, not a table
+                return index
+            if name not in self.ctes and name not in tables:
+                tables.append(name)
+            index = end
+            if introducer != "from":
+                return index
+            index = self._skip_alias(index)
+            if not self._is(index, ","):
+                return index
+            index += 1
+
+    # The table written by the main INSERT, UPDATE, DELETE or COMMENT, or None for other statements
+    def _find_target(self):
+        index = self.main + 1
+        if self.type == "insert" and self._word(index) == "into":
+            index += 1
+        elif self.type == "delete" and self._word(index) == "from":
+            index += 1
+        elif self.type == "comment" and self._word(index) == "on":
+            # COMMENT ON TABLE schema.table or COMMENT ON COLUMN schema.table.column
+            kind = self._word(index + 1)
+            name, _ = self._read_name(index + 2)
+            if kind == "column":
+                return name.rpartition(".")[0] or None
+            return name if kind == "table" else None
+        elif self.type != "update":
+            return None
+        if self._word(index) == "only":
+            index += 1
+        name, _ = self._read_name(index)
+        return name or None
+
+    # The main statement's WHERE clause, without the WHERE keyword
+    def _find_where(self):
+        start = None
+        for index in self.top_level():
+            word = self._word(index)
+            if start is None and word == "where":
+                start = index + 1
+            elif start is not None and word in _WHERE_TERMINATORS:
+                return self.slice(start, index)
+        return self.slice(start) if start is not None else ""
+
+
+# Statement text without comments or redundant whitespace, with unquoted words lower-cased, so
+# spellings of a query that differ only in layout or keyword case compare equal
+def normalize_sql(text):
+    tokens = [t for t in tokenize(text.strip().rstrip(";")) if t.kind not in (WHITESPACE, COMMENT)]
+    return " ".join(t.value.lower() if t.kind == WORD else t.value for t in tokens)
+
+
+# Parse one statement; results are cached since a statement is usually inspected several times
+@lru_cache(maxsize=1024)
+def parse_statement(text):
+    return Statement(text.strip().rstrip(";"))
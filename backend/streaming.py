@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+import queue
+import time
+import uuid
+from flask import current_app
+from psycopg2 import extensions
+from config import Config
+from execution import BatchReader
+from sqlparser import StatementSplitter, parse_statement
+
+
+# Describe result columns by name and the psycopg2 type they are decoded as
+def describe_columns(description):
+    columns = []
+    for column in description or []:
+        caster = extensions.string_types.get(column.type_code)
+        columns.append(
+            {
+                "name": column.name,
+                "type": caster.name.lower() if caster else None,
+                "typeOid": column.type_code,
+            }
+        )
+    return columns
+
+
+# Run a SELECT on a named server-side cursor and yield its rows in batches, within the budget's caps
+# Emits a header event with column metadata, rows events, and a trailer with the row count, timing
+# and the cap that cut the result short, if any
+def stream_select(connection, query, query_id, batch_size=Config.STREAM_BATCH_SIZE, budget=None):
+    started = time.perf_counter()
+    with connection.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query)
+        reader = BatchReader(cursor, budget, batch_size)
+        # A named cursor only has a description once the first batch has been fetched
+        batch = reader.next_batch()
+        first_row_ms = (time.perf_counter() - started) * 1000
+        yield {
+            "type": "header",
+            "id": query_id,
+            "Query": query,
+            "columns": describe_columns(cursor.description),
+        }
+        row_count = 0
+        while batch:
+            row_count += len(batch)
+            yield {"type": "rows", "id": query_id, "rows": batch}
+            batch = reader.next_batch()
+    yield {
+        "type": "trailer",
+        "id": query_id,
+        "rowCount": row_count,
+        "truncated": reader.truncated,
+        "firstRowMs": round(first_row_ms, 3),
+        "elapsedMs": round((time.perf_counter() - started) * 1000, 3),
+    }
+
+
+# Serialize events as newline-delimited JSON, keeping row keys in column order
+def ndjson(events):
+    for event in events:
+        yield current_app.json.dumps(event, sort_keys=False) + "\n"
+
+
+# Serialize events as Server-Sent Events, using each event's type as the SSE event name
+def sse(events):
+    for event in events:
+        event = dict(event)
+        name = event.pop("type")
+        yield f"event: {name}\ndata: {current_app.json.dumps(event, sort_keys=False)}\n\n"
+
+
+# Consume a streamed completion, emitting token and statement events as SQL arrives, and execute
+# the statements in order. execute(statements) runs an iterator of statements on one connection,
+# yielding a result per statement, and is driven from a worker thread.
+# With early set, leading read-only statements start running while the rest is still generated;
+# everything from the first statement that might write waits until generation has finished.
+async def generate_and_execute(deltas, execute, early=False):
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    statements = queue.Queue()
+    done = object()
+
+    def emit(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    def run_statements():
+        first = statements.get()
+        if first is None:
+            return
+        try:
+            for result in execute(itertools.chain([first], iter(statements.get, None))):
+                emit({"type": "result", **result})
+        except Exception as e:
+            emit(
+                {
+                    "type": "error",
+                    "error": f"SQL Execution Error: {e}" if getattr(e, "query", None) else str(e),
+                    "query": getattr(e, "query", None),
+                }
+            )
+            # Drain what is still queued so the generator side never blocks
+            while statements.get() is not None:
+                pass
+
+    async def generate():
+        splitter = StatementSplitter()
+        found, held = [], []
+        read_only = True
+        started = time.perf_counter()
+
+        def add(statement):
+            nonlocal read_only
+            read_only = read_only and parse_statement(statement).is_read_only
+            events.put_nowait({"type": "statement", "index": len(found), "query": statement})
+            found.append(statement)
+            if early and read_only:
+                statements.put(statement)
+            else:
+                held.append(statement)
+
+        try:
+            async for delta in deltas:
+                events.put_nowait({"type": "token", "text": delta})
+                for statement in splitter.feed(delta):
+                    add(statement)
+            for statement in splitter.finish():
+                add(statement)
+            events.put_nowait(
+                {
+                    "type": "generated",
+                    "statementCount": len(found),
+                    "elapsedMs": round((time.perf_counter() - started) * 1000, 3),
+                }
+            )
+            for statement in held:
+                statements.put(statement)
+        except Exception as e:
+            events.put_nowait({"type": "error", "error": str(e), "query": None})
+        finally:
+            statements.put(None)
+
+    executor = asyncio.ensure_future(asyncio.to_thread(run_statements))
+    generator = asyncio.ensure_future(generate())
+    executor.add_done_callback(lambda _: events.put_nowait(done))
+    try:
+        while True:
+            event = await events.get()
+            if event is done:
+                break
+            yield event
+        await generator
+    finally:
+        generator.cancel()
+        # The worker stops once it sees the end marker, after any statement it is running
+        statements.put(None)
+        await asyncio.gather(generator, executor, return_exceptions=True)
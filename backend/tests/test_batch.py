@@ -0,0 +1,47 @@
+import asyncio
+from unittest.mock import patch
+from batch import iterate_sync, run_batch
+
+
+class StatementError(Exception):
+    def __init__(self, query):
+        super().__init__("boom")
+        self.query = query
+
+
+def collect(items):
+    return list(iterate_sync(items))
+
+
+def test_run_batch_bounds_concurrency():
+    in_flight = {"now": 0, "max": 0}
+
+    async def convert(prompt, schema, use_cache):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        return f"SELECT {prompt}"
+
+    with patch("batch.convert_query_async", side_effect=convert):
+        items = collect(run_batch([str(i) for i in range(10)], {}, lambda queries: queries, concurrency=3))
+    assert in_flight["max"] == 3
+    assert sorted(item["index"] for item in items) == list(range(10))
+    item = next(item for item in items if item["index"] == 4)
+    assert item["results"] == ["SELECT 4"]
+    assert set(item["timings"]) == {"queuedMs", "llmMs", "executeMs", "totalMs"}
+
+
+def test_run_batch_reports_item_errors():
+    async def convert(prompt, schema, use_cache):
+        return "" if prompt == "empty" else "SELECT 1"
+
+    def execute(queries):
+        raise StatementError(queries[0])
+
+    with patch("batch.convert_query_async", side_effect=convert):
+        items = sorted(collect(run_batch(["empty", "fails"], {}, execute)), key=lambda item: item["index"])
+    assert items[0]["error"] == "Failed to generate SQL command(s) from the query"
+    assert items[1]["error"] == "SQL Execution Error: boom"
+    assert items[1]["query"] == "SELECT 1"
+    assert "results" not in items[1]
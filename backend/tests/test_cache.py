@@ -0,0 +1,61 @@
+from unittest.mock import patch
+from cache import TTLCache
+
+
+def test_cache_hit_and_miss():
+    cache = TTLCache(maxsize=2)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.peek("b") is None
+    assert cache.peek("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_ttl_expiry():
+    cache = TTLCache(ttl=10)
+    with patch("cache.time.monotonic", return_value=100):
+        cache.set("a", 1)
+    with patch("cache.time.monotonic", return_value=105):
+        assert cache.get("a") == 1
+    with patch("cache.time.monotonic", return_value=111):
+        assert cache.get("a") is None
+
+
+def test_cache_validate_rejects_entry():
+    cache = TTLCache()
+    cache.set("a", ("v1", {}))
+    assert cache.get("a", validate=lambda entry: entry[0] == "v2") is None
+    assert cache.peek("a") is None
+
+
+def test_cache_evicts_to_fit_maxbytes():
+    cache = TTLCache(maxsize=10, maxbytes=10, sizeof=len)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    cache.set("c", "cccc")
+    assert cache.peek("a") is None
+    assert cache.stats()["bytes"] == 8
+    # A value larger than the whole budget is not stored, and evicts nothing
+    cache.set("d", "d" * 11)
+    assert cache.peek("d") is None
+    assert len(cache) == 2
+
+
+def test_cache_discard():
+    cache = TTLCache(maxbytes=100, sizeof=len)
+    cache.set(("1", "a"), "x")
+    cache.set(("2", "b"), "yy")
+    assert cache.discard(lambda key, value: key[0] == "1") == 1
+    assert cache.peek(("1", "a")) is None
+    assert cache.stats()["bytes"] == 2
@@ -0,0 +1,104 @@
+import gzip
+import json
+import zlib
+import pytest
+from flask import Flask, Response, jsonify
+from werkzeug.datastructures import Accept
+from compression import choose_encoding, compression_stats, init_compression
+from json_provider import JSONProvider
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+    init_compression(app)
+
+    @app.route("/small")
+    def small():
+        return jsonify({"ok": True})
+
+    @app.route("/large")
+    def large():
+        return jsonify({"rows": [{"id": i, "name": f"row {i}"} for i in range(2000)]})
+
+    @app.route("/stream")
+    def stream():
+        def generate():
+            for i in range(3):
+                yield json.dumps({"id": i}) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    compression_stats.clear()
+    yield app.test_client()
+    compression_stats.clear()
+
+
+def test_choose_encoding():
+    accept = Accept([("gzip", 1), ("br", 1), ("zstd", 0.5)])
+    # Ties go to the configured order
+    assert choose_encoding(accept, ["gzip", "br"]) == "gzip"
+    assert choose_encoding(accept, ["zstd", "gzip"]) == "gzip"
+    assert choose_encoding(Accept([("gzip", 0)]), ["gzip"]) is None
+    assert choose_encoding(Accept([]), ["gzip"]) is None
+    # Encodings the server does not know are ignored
+    assert choose_encoding(Accept([("compress", 1)]), ["compress", "gzip"]) is None
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert compression_stats.stats() == {}
+
+
+def test_large_responses_are_gzipped(client):
+    plain = client.get("/large")
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in plain.headers
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == plain.data
+    stats = compression_stats.stats()["/large"]
+    assert stats["responses"] == 1
+    assert stats["bytesIn"] == len(plain.data)
+    assert stats["bytesOut"] == len(response.data)
+    assert stats["ratio"] > 1
+    assert stats["encodings"] == {"gzip": 1}
+
+
+def test_brotli_and_zstd():
+    pytest.importorskip("brotli")
+    pytest.importorskip("zstandard")
+    import brotli
+    import zstandard
+
+    app = Flask(__name__)
+    init_compression(app)
+    app.route("/large")(lambda: {"rows": list(range(5000))})
+    client = app.test_client()
+    plain = client.get("/large").data
+
+    response = client.get("/large", headers={"Accept-Encoding": "gzip, br, zstd"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(response.data) == plain
+
+    response = client.get("/large", headers={"Accept-Encoding": "zstd"})
+    assert response.headers["Content-Encoding"] == "zstd"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(response.data) == plain
+
+
+def test_streamed_responses_flush_each_chunk(client):
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"}, buffered=False)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = response.iter_encoded()
+    # Each chunk decodes on its own, so NDJSON lines reach the client as they are produced
+    assert decoder.decompress(next(chunks)) == b'{"id": 0}\n'
+    rest = b"".join(decoder.decompress(chunk) for chunk in chunks)
+    response.close()
+    assert rest == b'{"id": 1}\n{"id": 2}\n'
+    assert compression_stats.stats()["/stream"]["bytesIn"] == 30
@@ -0,0 +1,255 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from database import (
+    ConnectionPool,
+    ConnectionRegistry,
+    PoolManager,
+    REPLICA_LAG_QUERY,
+    ReplicaRouter,
+    borrow_connection,
+    format_replicas,
+)
+from models import Base, DatabaseConnection
+
+
+def make_connection():
+    connection = MagicMock()
+    connection.closed = 0
+    connection.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+    return connection
+
+
+@pytest.fixture
+def mock_connect():
+    with patch("database.psycopg2.connect") as mock_connect:
+        mock_connect.side_effect = lambda *args, **kwargs: make_connection()
+        yield mock_connect
+
+
+def test_pool_reuses_idle_connection(mock_connect):
+    pool = ConnectionPool("dbname=test", minconn=1, maxconn=2)
+    first = pool.getconn()
+    pool.putconn(first)
+    second = pool.getconn()
+    assert second is first
+    assert mock_connect.call_count == 1
+
+
+def test_pool_exhausted(mock_connect):
+    pool = ConnectionPool("dbname=test", minconn=1, maxconn=1)
+    pool.getconn()
+    with pytest.raises(PoolError):
+        pool.getconn(timeout=0.01)
+
+
+def test_pool_replaces_unhealthy_connection(mock_connect):
+    pool = ConnectionPool("dbname=test", minconn=1, maxconn=1)
+    first = pool.getconn()
+    pool.putconn(first)
+    first.closed = 1
+    second = pool.getconn()
+    assert second is not first
+    assert mock_connect.call_count == 2
+
+
+def test_pool_evicts_idle_connections(mock_connect):
+    pool = ConnectionPool("dbname=test", minconn=1, maxconn=3, idle_timeout=0)
+    connections = [pool.getconn() for _ in range(3)]
+    for connection in connections:
+        pool.putconn(connection)
+    pool.evict_idle()
+    assert sum(c.close.called for c in connections) == 2
+
+
+def test_pool_manager_invalidate(mock_connect):
+    with patch("database.get_connection_dsn", return_value="dbname=test"):
+        manager = PoolManager()
+        pool = manager.get_pool(1)
+        assert manager.get_pool("1") is pool
+        connection = pool.getconn()
+        pool.putconn(connection)
+        manager.invalidate(1)
+        assert connection.close.called
+        assert manager.get_pool(1) is not pool
+
+
+@pytest.fixture
+def registry_sessions():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    Base.metadata.create_all(engine)
+    sessions = MagicMock(side_effect=sessionmaker(bind=engine))
+    with patch("database.SessionLocal", sessions):
+        yield sessions
+
+
+def add_connection(sessions, **fields):
+    session = sessions()
+    connection = DatabaseConnection(
+        **{
+            "name": "main",
+            "host": "localhost",
+            "port": 5432,
+            "username": "user",
+            "password": "secret",
+            "database": "app",
+            **fields,
+        }
+    )
+    session.add(connection)
+    session.commit()
+    return session, connection
+
+
+def test_registry_serves_lookups_from_memory(registry_sessions):
+    add_connection(registry_sessions)[0].close()
+    registry = ConnectionRegistry()
+    registry_sessions.reset_mock()
+
+    assert [record["name"] for record in registry.all()] == ["main"]
+    dsn = registry.dsn(1)
+    assert "dbname=app" in dsn and "password=secret" in dsn
+    assert registry.dsn("1") is dsn
+    assert registry.get(1)["host"] == "localhost"
+    # One query loaded the whole registry
+    assert registry_sessions.call_count == 1
+
+
+def test_registry_write_through(registry_sessions):
+    registry = ConnectionRegistry()
+    assert registry.all() == []
+
+    session, connection = add_connection(registry_sessions)
+    registry.put(connection)
+    assert registry.dsn(connection.id).startswith("host=localhost")
+
+    connection.host = "replica"
+    session.commit()
+    registry.put(connection)
+    assert "host=replica" in registry.dsn(connection.id)
+
+    connection_id = connection.id
+    session.delete(connection)
+    session.commit()
+    session.close()
+    registry_sessions.reset_mock()
+    registry.remove(connection_id)
+    with pytest.raises(Exception, match="Connection not found"):
+        registry.dsn(connection_id)
+    # Unknown ids are looked up once more in case another process registered them
+    assert registry_sessions.call_count == 1
+
+
+def test_registry_finds_rows_added_elsewhere(registry_sessions):
+    registry = ConnectionRegistry()
+    assert registry.all() == []
+    add_connection(registry_sessions, name="other")[0].close()
+    assert registry.get(1)["name"] == "other"
+    assert [record["name"] for record in registry.all()] == ["other"]
+
+
+def test_registry_reloads_rows_changed_elsewhere(registry_sessions):
+    session, connection = add_connection(registry_sessions)
+    changed = []
+    registry = ConnectionRegistry(ttl=5)
+    registry.subscribe(changed.append)
+    with patch("database.time.monotonic", return_value=100):
+        assert "host=localhost" in registry.dsn(1)
+
+    # Another process updates the row, and deletes a second one it added
+    connection.host = "moved"
+    session.commit()
+    session.close()
+    with patch("database.time.monotonic", return_value=104):
+        assert "host=localhost" in registry.dsn(1)
+    with patch("database.time.monotonic", return_value=106):
+        assert "host=moved" in registry.dsn(1)
+    assert changed == ["1"]
+
+    # A write through during a reload wins over the rows it read
+    session, connection = add_connection(registry_sessions, name="other")
+    with patch("database.time.monotonic", return_value=200), patch.object(
+        registry, "_load", side_effect=lambda: registry.put(connection) or {}
+    ):
+        assert registry.get(2)["name"] == "other"
+    session.close()
+    # The rows read before the write were discarded rather than reported as deletions
+    assert changed == ["1"]
+
+
+def test_registry_replica_dsns(registry_sessions):
+    replicas = format_replicas([{"host": "r1", "port": 6432}, "r2", " "])
+    assert replicas == "r1:6432,r2"
+    add_connection(registry_sessions, replicas=replicas)[0].close()
+    registry = ConnectionRegistry()
+
+    assert registry.get(1)["replicas"] == [
+        {"host": "r1", "port": 6432},
+        {"host": "r2", "port": 5432},
+    ]
+    assert "host=r1 port=6432" in registry.dsn(1, 0)
+    assert "dbname=app" in registry.dsn(1, 1) and "host=r2" in registry.dsn(1, 1)
+    assert "host=localhost" in registry.dsn(1)
+
+
+def lag_connection(lag):
+    connection = make_connection()
+    connection.cursor.return_value.__enter__.return_value.fetchone.return_value = {"lag": lag}
+    return connection
+
+
+def test_replica_router_round_robin_and_writes():
+    router = ReplicaRouter(max_lag=5, check_interval=10, retry_interval=30)
+    assert router.candidates(1, 0) == []
+    assert router.candidates(1, 2) == [0, 1]
+    assert router.candidates(1, 2) == [1, 0]
+    router.mark_down(1, 0)
+    assert router.candidates(1, 2) == [1]
+    # Reads right after a write go to the primary
+    router.record_write(1)
+    assert router.candidates(1, 2) == []
+    assert router.candidates(2, 2) == [0, 1]
+    router.forget(1)
+    assert router.candidates(1, 2) == [0, 1]
+
+
+def test_replica_router_checks_lag():
+    router = ReplicaRouter(max_lag=5, check_interval=10, retry_interval=30)
+    assert router.within_lag(1, 0, lag_connection(1.5))
+    # Lag is not queried again within the check interval
+    stale = lag_connection(60)
+    assert router.within_lag(1, 0, stale)
+    stale.cursor.assert_not_called()
+    assert not router.within_lag(1, 1, lag_connection(60))
+    assert router.stats()["1/1"] == {"lag": 60.0, "down": False}
+    # A replica that is not streaming and has replayed no commit is never current
+    assert not router.within_lag(1, 2, lag_connection(None))
+    assert "pg_stat_wal_receiver WHERE status = 'streaming'" in REPLICA_LAG_QUERY
+
+
+def test_borrow_connection_falls_back_to_primary():
+    primary, replica = MagicMock(), MagicMock()
+    primary.getconn.return_value = "primary"
+    replica.getconn.return_value = lag_connection(60)
+    router = ReplicaRouter(max_lag=5, check_interval=10, retry_interval=30)
+    record = {"replicas": [{"host": "r1", "port": 5432}]}
+    with patch("database.connection_registry.get", return_value=record), patch(
+        "database.pool_manager.get_pool",
+        side_effect=lambda connection_id, replica_index=None: primary if replica_index is None else replica,
+    ), patch("database.replica_router", router):
+        assert borrow_connection(1) == (primary, "primary")
+        # The lagging replica is handed back and left out
+        assert borrow_connection(1, readonly=True) == (primary, "primary")
+        replica.putconn.assert_called_once()
+        assert router.candidates(1, 1) == []
+
+        router.forget(1)
+        replica.getconn.return_value = lag_connection(0)
+        pool, connection = borrow_connection(1, readonly=True)
+        assert pool is replica
@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+from descriptions import (
+    DescriptionJobRunning,
+    _jobs,
+    claim_job,
+    comment_statements,
+    job_status,
+    plan_chunks,
+    release_job,
+    run_description_job,
+)
+
+
+def column(name, references=None):
+    return {
+        "name": name,
+        "type": "integer",
+        "nullable": True,
+        "default": None,
+        "primary_key": name == "id",
+        "foreign_keys": [{"table": references, "column": "id"}] if references else [],
+        "description": None,
+    }
+
+
+SCHEMA = {
+    "public": {
+        "users": [column("id")],
+        "tags": [column("id")],
+        "orders": [column("id"), column("user_id", "public.users")],
+    }
+}
+
+MISSING = {
+    "public.users": {"table": True, "columns": ["id"]},
+    "public.tags": {"table": True, "columns": ["id"]},
+    "public.orders": {"table": True, "columns": ["id", "user_id"]},
+}
+
+
+@pytest.fixture(autouse=True)
+def clear_jobs():
+    _jobs.clear()
+    yield
+    _jobs.clear()
+
+
+def test_plan_chunks_groups_foreign_key_neighbours():
+    chunks = plan_chunks(MISSING, SCHEMA, token_budget=10000, max_items=5)
+    assert [list(chunk["missing"]) for chunk in chunks] == [["public.users", "public.orders"], ["public.tags"]]
+    # The chunk's schema context holds its tables and their neighbours
+    assert set(chunks[1]["schema"]["public"]) == {"tags"}
+    assert plan_chunks(MISSING, SCHEMA, token_budget=10000, max_items=5)[0]["id"] == chunks[0]["id"]
+
+
+def test_plan_chunks_respects_token_budget():
+    chunks = plan_chunks(MISSING, SCHEMA, token_budget=1, max_items=100)
+    assert len(chunks) == 3
+
+
+def test_comment_statements_keeps_comments_on_chunk_tables():
+    sql = (
+        "COMMENT ON TABLE public.users IS 'People; who log in';"
+        "COMMENT ON COLUMN users.id IS 'Identifier';"
+        "COMMENT ON TABLE public.tags IS 'Not in this chunk';"
+        "DROP TABLE public.users"
+    )
+    assert comment_statements(sql, ["public.users"]) == [
+        "COMMENT ON TABLE public.users IS 'People; who log in'",
+        "COMMENT ON COLUMN users.id IS 'Identifier'",
+    ]
+
+
+def run(events):
+    async def collect():
+        return [event async for event in events]
+
+    return asyncio.run(collect())
+
+
+def test_run_description_job_resumes_generated_chunks():
+    chunks = plan_chunks(MISSING, SCHEMA, token_budget=10000, max_items=5)
+    applied = []
+
+    async def generate(missing, schema):
+        if "public.tags" in missing:
+            raise RuntimeError("rate limited")
+        return "COMMENT ON TABLE public.users IS 'People'"
+
+    with patch("descriptions.generate_details_async", side_effect=generate):
+        events = run(run_description_job(1, chunks, lambda statements: []))
+    assert events[-1] == {"type": "applied", "statements": 1, "skipped": [], "failedChunks": 1}
+    assert job_status(1)["status"] == "partial"
+
+    # A run interrupted after its first chunk keeps that chunk for the next run
+    async def interrupted():
+        events = run_description_job(2, chunks, applied.append)
+        async for event in events:
+            if event["type"] == "chunk" and "error" not in event:
+                await events.aclose()
+                return
+
+    async def generate_all(missing, schema):
+        if "public.tags" in missing:
+            await asyncio.sleep(0.05)
+        return f"COMMENT ON TABLE {next(iter(missing))} IS 'Described'"
+
+    with patch("descriptions.generate_details_async", side_effect=generate_all) as mock_generate:
+        asyncio.run(interrupted())
+        assert job_status(2)["status"] == "failed"
+        assert job_status(2)["generated"] == 1
+        events = run(run_description_job(2, chunks, lambda statements: applied.append(statements) or []))
+    assert events[0] == {"type": "plan", "chunks": 2, "resumed": 1}
+    # Only the unfinished chunk was generated again
+    assert mock_generate.call_count == 3
+    assert applied == [
+        [
+            "COMMENT ON TABLE public.users IS 'Described'",
+            "COMMENT ON TABLE public.tags IS 'Described'",
+        ]
+    ]
+    assert job_status(2)["status"] == "done"
+
+
+def test_run_description_job_rejects_concurrent_runs():
+    _jobs["1"] = type("Job", (), {"status": "running"})()
+    with pytest.raises(DescriptionJobRunning):
+        run(run_description_job(1, [], lambda statements: []))
+
+
+def test_claim_and_release_job():
+    job = claim_job(3)
+    with pytest.raises(DescriptionJobRunning):
+        claim_job(3)
+    release_job(job)
+    assert job_status(3)["status"] == "idle"
+
+    # A claimed job runs without being claimed again, and is not released once it has run
+    job = claim_job(3)
+    events = run(run_description_job(3, [], lambda statements: [], job=job))
+    release_job(job)
+    assert events[-1]["type"] == "applied"
+    assert job_status(3)["status"] == "done"
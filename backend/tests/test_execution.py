@@ -0,0 +1,111 @@
+import threading
+from unittest.mock import MagicMock, patch
+from execution import (
+    BatchReader,
+    ExecutionBudget,
+    RunningQueries,
+    apply_timeout,
+    estimate_bytes,
+    fetch_rows,
+    fetch_select,
+)
+
+
+def make_cursor(rows):
+    cursor = MagicMock()
+    remaining = list(rows)
+
+    def fetchmany(size):
+        batch = remaining[:size]
+        del remaining[:size]
+        return batch
+
+    cursor.fetchmany.side_effect = fetchmany
+    cursor.fetchall.side_effect = lambda: fetchmany(len(remaining))
+    return cursor
+
+
+def test_budget_for_connection_and_narrowing():
+    record = {"statement_timeout_ms": 5000, "max_rows": None, "max_bytes": 0}
+    with patch("execution.connection_registry.get", return_value=record), patch(
+        "execution.Config.QUERY_MAX_ROWS", 100
+    ):
+        budget = ExecutionBudget.for_connection(1)
+    # The connection's own limits win, including 0 for "no limit"; NULL falls back to Config
+    assert (budget.timeout_ms, budget.max_rows, budget.max_bytes) == (5000, 100, 0)
+
+    narrowed = budget.narrowed(timeout_ms=60000, max_rows=10, max_bytes=2048)
+    assert (narrowed.timeout_ms, narrowed.max_rows, narrowed.max_bytes) == (5000, 10, 2048)
+
+
+def test_apply_timeout():
+    cursor = MagicMock()
+    apply_timeout(cursor, ExecutionBudget())
+    cursor.execute.assert_not_called()
+    apply_timeout(cursor, ExecutionBudget(timeout_ms=1500))
+    cursor.execute.assert_called_once_with("SET LOCAL statement_timeout = %s", (1500,))
+
+
+def test_fetch_rows_caps_rows():
+    rows = [{"id": i} for i in range(10)]
+    assert fetch_rows(make_cursor(rows), None) == (rows, None)
+    assert fetch_rows(make_cursor(rows), ExecutionBudget(max_rows=10)) == (rows, None)
+    assert fetch_rows(make_cursor(rows), ExecutionBudget(max_rows=4)) == (rows[:4], "maxRows")
+
+
+def test_fetch_rows_caps_bytes():
+    rows = [{"id": i, "name": "x" * 20} for i in range(100)]
+    row_size = estimate_bytes(rows[:1])
+    budget = ExecutionBudget(max_bytes=row_size * 30)
+    reader = BatchReader(make_cursor(rows), budget, batch_size=8)
+    fetched = [row for batch in reader for row in batch]
+    assert reader.truncated == "maxBytes"
+    assert 24 <= len(fetched) <= 30
+    assert fetched == rows[: len(fetched)]
+
+
+def test_fetch_select_uses_server_side_cursor_for_reads():
+    connection = MagicMock()
+    named = make_cursor([{"n": 1}, {"n": 2}, {"n": 3}])
+    connection.cursor.return_value.__enter__.return_value = named
+    cursor = make_cursor([])
+
+    rows, truncated = fetch_select(cursor, connection, "SELECT n FROM t", ExecutionBudget(max_rows=2))
+    assert (rows, truncated) == ([{"n": 1}, {"n": 2}], "maxRows")
+    assert connection.cursor.call_args.kwargs["name"].startswith("capped_")
+    named.execute.assert_called_once_with("SELECT n FROM t")
+
+    connection.reset_mock()
+    fetch_select(cursor, connection, "SELECT n FROM t FOR UPDATE", ExecutionBudget(max_rows=2))
+    connection.cursor.assert_not_called()
+    cursor.execute.assert_called_once_with("SELECT n FROM t FOR UPDATE")
+
+
+def test_running_queries_cancel():
+    running = RunningQueries()
+    connection = MagicMock()
+    assert running.cancel("q1") is False
+    with running.track("q1", connection):
+        assert len(running) == 1
+        assert running.cancel("q1") is True
+    connection.cancel.assert_called_once()
+    assert len(running) == 0
+
+
+def test_running_queries_cancel_from_another_thread():
+    running = RunningQueries()
+    connection = MagicMock()
+    started, cancelled = threading.Event(), threading.Event()
+    connection.cancel.side_effect = cancelled.set
+
+    def run():
+        with running.track("q1", connection):
+            started.set()
+            cancelled.wait(5)
+
+    worker = threading.Thread(target=run)
+    worker.start()
+    started.wait(5)
+    assert running.cancel("q1")
+    worker.join(5)
+    assert not worker.is_alive()
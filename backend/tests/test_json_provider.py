@@ -0,0 +1,55 @@
+import json
+import uuid
+import pytest
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from unittest.mock import patch
+from flask import Flask
+from json_provider import JSONProvider
+
+ROW = {
+    "b_id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    "a_placed": datetime(2024, 5, 1, 12, 30, 15),
+    "day": date(2024, 5, 1),
+    "at": time(9, 15, 30, 250),
+    "total": Decimal("12.50"),
+    "duration": timedelta(hours=1, minutes=5),
+    "note": "café",
+}
+
+EXPECTED = {
+    "b_id": "12345678-1234-5678-1234-567812345678",
+    "a_placed": "2024-05-01 12:30:15",
+    "day": "2024-05-01",
+    "at": "09:15:30",
+    "total": 12.5,
+    "duration": "1:05:00",
+    "note": "café",
+}
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def app(request):
+    app = Flask(__name__)
+    app.json = JSONProvider(app)
+    if request.param == "stdlib":
+        with patch("json_provider.orjson", None):
+            yield app
+    else:
+        yield app
+
+
+def test_dumps_database_values(app):
+    assert json.loads(app.json.dumps([ROW])) == [EXPECTED]
+
+
+def test_dumps_key_order(app):
+    assert list(json.loads(app.json.dumps(ROW, sort_keys=False))) == list(ROW)
+    assert list(json.loads(app.json.dumps(ROW))) == sorted(ROW)
+
+
+def test_response(app):
+    with app.app_context():
+        response = app.json.response({"results": [ROW]})
+    assert response.mimetype == "application/json"
+    assert app.json.loads(response.data) == {"results": [EXPECTED]}
@@ -0,0 +1,172 @@
+import asyncio
+import gc
+import weakref
+import pytest
+from unittest.mock import AsyncMock, patch, MagicMock
+from openai import RateLimitError
+import natlang
+from cache import SQLiteCache, TieredCache, TTLCache
+from natlang import (
+    analyze_query,
+    complete_stream,
+    convert_query,
+    convert_query_async,
+    format_schema,
+    llm_cache,
+    retry_delay,
+    with_rate_limit_backoff,
+)
+
+SCHEMA = {
+    "public": {
+        "users": [
+            {
+                "name": "id",
+                "type": "integer",
+                "nullable": False,
+                "default": None,
+                "primary_key": True,
+                "foreign_keys": [],
+                "description": None,
+            }
+        ]
+    }
+}
+
+
+def completion(content):
+    response = MagicMock()
+    response.choices[0].message.content = content
+    return response
+
+
+@pytest.fixture
+def mock_openai():
+    llm_cache.clear()
+    with patch("natlang.openai_client") as mock_client:
+        mock_create = mock_client.chat.completions.create
+        mock_create.return_value = completion("SELECT * FROM public.users")
+        yield mock_create
+    llm_cache.clear()
+
+
+def test_convert_query_is_cached(mock_openai):
+    assert convert_query("list users", SCHEMA) == "SELECT * FROM public.users"
+    # Whitespace differences share the cached answer
+    assert convert_query("  list   users ", SCHEMA) == "SELECT * FROM public.users"
+    assert mock_openai.call_count == 1
+
+
+def test_cache_key_includes_schema_and_task(mock_openai):
+    convert_query("list users", SCHEMA)
+    convert_query("list users", {"public": {}})
+    analyze_query("list users", SCHEMA)
+    assert mock_openai.call_count == 3
+
+
+def test_cache_bypass_refreshes_entry(mock_openai):
+    convert_query("list users", SCHEMA)
+    mock_openai.return_value = completion("SELECT id FROM public.users")
+    assert convert_query("list users", SCHEMA, use_cache=False) == "SELECT id FROM public.users"
+    assert convert_query("list users", SCHEMA) == "SELECT id FROM public.users"
+    assert mock_openai.call_count == 2
+
+
+def test_format_schema():
+    column_line = "    - id (integer) [Nullable: NO] [Default: None] [Primary Key]"
+    assert format_schema(SCHEMA) == (
+        "Available Database Schema:".center(len(column_line)) + "\n"
+        "Schema: public\n"
+        "  Table: users\n"
+        f"{column_line}\n"
+    )
+
+
+def test_format_schema_rerenders_only_changed_tables():
+    orders = [dict(SCHEMA["public"]["users"][0], name="order_id")]
+    schema = {"public": {"users": SCHEMA["public"]["users"], "orders": orders}}
+    natlang._table_fragments.clear()
+    with patch("natlang.render_table", wraps=natlang.render_table) as mock_render:
+        first = format_schema(schema)
+        assert format_schema(schema) is first
+        changed = {"public": {"users": SCHEMA["public"]["users"], "orders": list(orders)}}
+        assert format_schema(changed) == first
+    # The users fragment was rendered once and reused for the changed schema
+    assert [call.args[0] for call in mock_render.call_args_list] == ["users", "orders", "orders"]
+
+
+def test_tiered_cache_promotes_disk_hits(tmp_path):
+    path = str(tmp_path / "llm.db")
+    TieredCache(TTLCache(), SQLiteCache(path)).set("key", "value")
+
+    # A fresh memory tier, as after a restart, is filled from disk
+    cache = TieredCache(TTLCache(), SQLiteCache(path))
+    assert cache.get("key") == "value"
+    assert cache.memory.peek("key") == "value"
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 0
+
+
+def rate_limit_error(headers):
+    response = MagicMock(status_code=429, headers=headers)
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+
+def test_retry_delay_honours_retry_after():
+    assert retry_delay(rate_limit_error({"retry-after-ms": "250"}), 0) == 0.25
+    assert retry_delay(rate_limit_error({"retry-after": "2"}), 0) == 2
+    assert 2 <= retry_delay(rate_limit_error({}), 2, base=1) <= 4
+
+
+def test_with_rate_limit_backoff_retries():
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise rate_limit_error({"retry-after-ms": "1"})
+        return "ok"
+
+    assert asyncio.run(with_rate_limit_backoff(call, max_retries=5)) == "ok"
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(RateLimitError):
+        asyncio.run(with_rate_limit_backoff(call, max_retries=1))
+
+
+# Stand-in for AsyncOpenAI that records whether it was closed
+class FakeAsyncClient:
+    def __init__(self, **kwargs):
+        self.closed = False
+        self.chat = MagicMock()
+        self.chat.completions.create = AsyncMock(return_value=completion("SELECT 1"))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+
+
+def test_async_clients_are_closed_after_each_request():
+    clients = []
+
+    def make_client(**kwargs):
+        client = FakeAsyncClient()
+        clients.append(weakref.ref(client))
+        return client
+
+    async def stream():
+        return [delta async for delta in complete_stream([], 10, 0, use_cache=False)]
+
+    with patch("natlang.AsyncOpenAI", side_effect=make_client):
+        # Each request runs on its own event loop, as Flask async views and iterate_sync do
+        for _ in range(5):
+            asyncio.run(convert_query_async("list users", SCHEMA, use_cache=False))
+        asyncio.run(stream())
+        assert len(clients) == 6
+        assert all(ref().closed for ref in clients if ref() is not None)
+
+    gc.collect()
+    assert all(ref() is None for ref in clients)
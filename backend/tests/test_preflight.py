@@ -0,0 +1,70 @@
+from unittest.mock import MagicMock
+from execution import ExecutionBudget
+from preflight import exceeded, explain_queries, summarize_plan
+
+PLAN = [
+    {
+        "Plan": {
+            "Node Type": "Hash Join",
+            "Startup Cost": 10.5,
+            "Total Cost": 25000.0,
+            "Plan Rows": 120000,
+            "Plans": [
+                {
+                    "Node Type": "Seq Scan",
+                    "Schema": "sales",
+                    "Relation Name": "salesorderdetail",
+                    "Plan Rows": 120000,
+                    "Filter": "(unitprice > 100)",
+                },
+                {
+                    "Node Type": "Hash",
+                    "Plans": [
+                        {
+                            "Node Type": "Index Scan",
+                            "Relation Name": "product",
+                            "Plan Rows": 500,
+                        }
+                    ],
+                },
+            ],
+        }
+    }
+]
+
+
+def test_summarize_plan():
+    assert summarize_plan(PLAN) == {
+        "nodeType": "Hash Join",
+        "startupCost": 10.5,
+        "totalCost": 25000.0,
+        "planRows": 120000,
+        "seqScans": [
+            {"relation": "sales.salesorderdetail", "rows": 120000, "filter": "(unitprice > 100)"}
+        ],
+    }
+
+
+def test_exceeded():
+    summary = summarize_plan(PLAN)
+    assert exceeded(summary, max_cost=30000, max_rows=200000) == []
+    assert exceeded(summary, max_cost=20000, max_rows=100000) == ["cost", "rows"]
+    assert exceeded(summary, max_cost=0, max_rows=0) == []
+
+
+def test_explain_queries_skips_transaction_control():
+    cursor = MagicMock()
+    cursor.fetchone.return_value = {"QUERY PLAN": PLAN}
+
+    plans = explain_queries(
+        cursor, ["BEGIN", "DELETE FROM t WHERE id = 1", "COMMIT"], ExecutionBudget(timeout_ms=500)
+    )
+
+    executed = [call.args[0] for call in cursor.execute.call_args_list]
+    assert executed == [
+        "SET LOCAL statement_timeout = %s",
+        "EXPLAIN (FORMAT JSON) DELETE FROM t WHERE id = 1",
+    ]
+    assert len(plans) == 1
+    assert plans[0]["Query"] == "DELETE FROM t WHERE id = 1"
+    assert plans[0]["totalCost"] == 25000.0
@@ -0,0 +1,36 @@
+from result_cache import ResultCache
+
+
+def test_result_cache_hit_ignores_layout():
+    cache = ResultCache(ttl=60)
+    cache.put(1, "SELECT * FROM users", [{"id": 1}])
+    result, age = cache.get("1", "select *\n  from USERS;")
+    assert result.rows == [{"id": 1}]
+    assert age >= 0
+    assert cache.get(2, "SELECT * FROM users") is None
+
+
+def test_result_cache_invalidates_tables_written():
+    cache = ResultCache(ttl=60)
+    cache.put(1, "SELECT * FROM users u JOIN orders o ON o.user_id = u.id", [])
+    cache.put(1, "SELECT * FROM products", [])
+    cache.put(2, "SELECT * FROM orders", [])
+
+    assert cache.invalidate_statement(1, "UPDATE public.Orders SET total = 0") == 1
+    assert cache.get(1, "SELECT * FROM products") is not None
+    assert cache.get(2, "SELECT * FROM orders") is not None
+
+
+def test_result_cache_comment_invalidates_catalog_reads():
+    cache = ResultCache(ttl=60)
+    cache.put(1, "SELECT * FROM information_schema.columns", [])
+    cache.put(1, "SELECT * FROM users", [])
+    cache.invalidate_statement(1, "COMMENT ON TABLE orders IS 'Orders'")
+    assert cache.get(1, "SELECT * FROM information_schema.columns") is None
+    assert cache.get(1, "SELECT * FROM users") is not None
+
+
+def test_result_cache_disabled():
+    cache = ResultCache(ttl=0)
+    cache.put(1, "SELECT 1", [])
+    assert cache.get(1, "SELECT 1") is None
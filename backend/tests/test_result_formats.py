@@ -0,0 +1,93 @@
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+from unittest.mock import MagicMock
+import pytest
+from result_formats import (
+    ArrowStreamEncoder,
+    results_to_columnar,
+    rows_to_arrow,
+    stream_arrow,
+    to_columnar,
+)
+
+pyarrow = pytest.importorskip("pyarrow")
+
+Column = namedtuple("Column", ["name", "type_code"])
+
+
+def read_arrow(data):
+    return pyarrow.ipc.open_stream(data).read_all()
+
+
+def test_to_columnar():
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+    assert to_columnar(rows) == {"columns": ["id", "name"], "data": [[1, 2], ["a", "b"]]}
+    assert to_columnar([], ["id"]) == {"columns": ["id"], "data": [[]]}
+
+
+def test_results_to_columnar_keeps_other_results():
+    results = [
+        {"Query": "SELECT 1", "Results": [{"x": 1}]},
+        {"Query": "COMMENT ON TABLE t IS 'x'", "Results": "Comment added"},
+    ]
+    assert results_to_columnar(results) == [
+        {"Query": "SELECT 1", "Results": {"columns": ["x"], "data": [[1]]}},
+        results[1],
+    ]
+
+
+def test_rows_to_arrow_round_trip():
+    key = uuid.uuid4()
+    rows = [
+        {
+            "id": 1,
+            "key": key,
+            "payload": {"a": 1},
+            "total": Decimal("1.50"),
+            "placed": datetime(2024, 5, 1, 12, 30),
+            "note": None,
+        }
+    ]
+    table = read_arrow(rows_to_arrow(list(rows[0]), rows, {"name": "Orders", "nextCursor": None}))
+
+    assert table.schema.field("id").type == pyarrow.int64()
+    assert table.schema.field("total").type == pyarrow.float64()
+    assert table.schema.metadata == {b"name": b"Orders"}
+    assert table.to_pylist() == [
+        {
+            "id": 1,
+            "key": str(key),
+            "payload": '{"a": 1}',
+            "total": 1.5,
+            "placed": datetime(2024, 5, 1, 12, 30),
+            "note": None,
+        }
+    ]
+
+
+def test_encoder_keeps_first_batch_types():
+    encoder = ArrowStreamEncoder(["id", "note"])
+    data = encoder.encode([{"id": 1, "note": None}])
+    data += encoder.encode([{"id": 2, "note": 5}])
+    data += encoder.close()
+
+    table = read_arrow(data)
+    assert table.schema.field("note").type == pyarrow.string()
+    assert table.to_pylist() == [{"id": 1, "note": None}, {"id": 2, "note": "5"}]
+
+
+def test_stream_arrow_batches():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.description = [Column("id", 23)]
+    cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], [{"id": 3}], []]
+
+    chunks = list(stream_arrow(connection, "SELECT id FROM t", batch_size=2))
+
+    # One chunk per batch (the first also carries the schema), then the end of stream
+    assert len(chunks) == 3
+    table = read_arrow(b"".join(chunks))
+    assert table.column("id").to_pylist() == [1, 2, 3]
+    assert table.schema.metadata == {b"query": b"SELECT id FROM t"}
@@ -1,7 +1,18 @@
 # test_routes.py
+import asyncio
+import json
 import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
 from app import create_app
+from config import Config
 from models import Base, engine
+from natlang import llm_cache
+from execution import ExecutionBudget, running_queries
+from result_cache import result_cache
+from database import replica_router
+from descriptions import _jobs, claim_job
+from routes import execute_query, read_only, run_queries
+from utils import PageCursorMismatch, encode_page_cursor
 
 
 @pytest.fixture(scope="module")
@@ -101,3 +112,390 @@ def test_delete_connection(test_client):
     response = test_client.delete("/connections/1")
     assert response.status_code == 200
     assert response.json["message"] == "Connection deleted successfully"
+
+
+def test_execute_query_insert_uses_returning():
+    cursor, connection = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [{"id": 3, "name": "Carol"}]
+    cursor.rowcount = 1
+    result = execute_query(cursor, connection, "INSERT INTO users (name) VALUES ('Carol')")
+    cursor.execute.assert_called_once_with(
+        "INSERT INTO users (name) VALUES ('Carol')\nRETURNING *"
+    )
+    assert result["NewRows"] == [{"id": 3, "name": "Carol"}]
+    assert result["Message"] == "1 rows affected"
+    connection.commit.assert_called_once()
+
+
+def test_execute_query_delete_in_transaction():
+    cursor, connection = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [{"id": 1}]
+    cursor.rowcount = 1
+    result = execute_query(
+        cursor, connection, "DELETE FROM users WHERE id = 1", in_transaction=True
+    )
+    assert result["DeletedRows"] == [{"id": 1}]
+    connection.commit.assert_not_called()
+
+
+def test_execute_query_update_captures_before_and_after():
+    cursor, connection = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [
+        {"before": {"id": 1, "name": "Al"}, "after": {"id": 1, "name": "Alice"}}
+    ]
+    cursor.rowcount = 1
+    result = execute_query(
+        cursor, connection, "UPDATE users SET name = 'Alice' WHERE id = 1"
+    )
+    executed = cursor.execute.call_args[0][0]
+    assert executed.startswith("WITH __old AS (")
+    assert "FOR UPDATE OF users" in executed
+    assert result["Action"] == "update"
+    assert result["UpdatedRows"][0]["before"]["name"] == "Al"
+
+    # A trailing comment stays on the line of the clause it ends
+    execute_query(cursor, connection, "UPDATE users SET name = 'Alice' WHERE id = 1 -- fix name")
+    executed = cursor.execute.call_args[0][0]
+    assert "WHERE id = 1 -- fix name\nFOR UPDATE OF users" in executed
+
+
+def test_execute_query_cte_select():
+    cursor, connection = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [{"n": 1}]
+    result = execute_query(cursor, connection, "WITH a AS (SELECT 1 AS n) SELECT n FROM a")
+    assert result["Results"] == [{"n": 1}]
+
+
+def test_execute_query_unsupported():
+    with pytest.raises(ValueError):
+        execute_query(MagicMock(), MagicMock(), "DROP TABLE users")
+
+
+def test_create_query_runs_convert_and_analyze_concurrently(test_client):
+    in_flight = {"now": 0, "max": 0}
+
+    async def create(messages, **kwargs):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.05)
+        in_flight["now"] -= 1
+        response = MagicMock()
+        if "SQL query" in messages[1]["content"]:
+            response.choices[0].message.content = "SELECT 1"
+        else:
+            response.choices[0].message.content = "One|A single row"
+        return response
+
+    llm_cache.clear()
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.execute_queries", return_value=[{"Query": "SELECT 1"}]
+    ) as mock_execute, patch("natlang.get_async_client") as mock_client:
+        mock_client.return_value.__aenter__.return_value = mock_client.return_value
+        mock_client.return_value.chat.completions.create = create
+        response = test_client.post(
+            "/queries?connection_id=1&analyze=1", json={"query": "one row"}
+        )
+    llm_cache.clear()
+    assert response.status_code == 200
+    assert response.json == {
+        "results": [{"Query": "SELECT 1"}],
+        "name": "One",
+        "description": "A single row",
+    }
+    # The second completion started before the first one finished
+    assert in_flight["max"] == 2
+    mock_execute.assert_called_once()
+    assert mock_execute.call_args.args == ("1", ["SELECT 1"])
+
+
+def test_ask_makes_one_completion(test_client):
+    llm_cache.clear()
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.execute_queries", return_value=[{"Query": "SELECT 1"}]
+    ) as mock_execute, patch("natlang.get_async_client") as mock_client:
+        mock_client.return_value.__aenter__.return_value = mock_client.return_value
+        create = mock_client.return_value.chat.completions.create = AsyncMock()
+        create.return_value.choices[0].message.content = (
+            '{"sql": ["SELECT 1;"], "name": "One", "description": "A single row"}'
+        )
+        response = test_client.post("/ask?connection_id=1", json={"query": "one row"})
+        assert create.call_count == 1
+        assert create.call_args.kwargs["response_format"] == {"type": "json_object"}
+
+        create.return_value.choices[0].message.content = '{"name": "No SQL"}'
+        invalid = test_client.post("/ask?connection_id=1", json={"query": "nothing"})
+    llm_cache.clear()
+    assert response.status_code == 200
+    assert response.json == {
+        "results": [{"Query": "SELECT 1"}],
+        "name": "One",
+        "description": "A single row",
+    }
+    mock_execute.assert_called_once()
+    assert mock_execute.call_args.args == ("1", ["SELECT 1"])
+    assert invalid.status_code == 500
+
+
+def test_query_batch(test_client):
+    async def convert(prompt, schema, use_cache):
+        return f"SELECT {prompt}"
+
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}) as mock_schema, patch(
+        "routes.execute_queries", side_effect=lambda connection_id, queries, **kwargs: queries
+    ), patch("batch.convert_query_async", side_effect=convert):
+        response = test_client.post("/queries/batch?connection_id=1", json={"queries": ["1", "2", "3"]})
+        streamed = test_client.post(
+            "/queries/batch?connection_id=1&stream=1", json={"queries": ["1", "2"]}
+        )
+        too_many = test_client.post(
+            "/queries/batch?connection_id=1", json={"queries": ["1"] * (Config.BATCH_MAX_SIZE + 1)}
+        )
+    assert response.status_code == 200
+    assert [item["results"] for item in response.json["items"]] == [["SELECT 1"], ["SELECT 2"], ["SELECT 3"]]
+    assert response.json["failed"] == 0
+    assert mock_schema.call_count == 2
+
+    events = [json.loads(line) for line in streamed.data.decode().splitlines()]
+    assert sorted(event["index"] for event in events if event["type"] == "item") == [0, 1]
+    assert events[-1]["type"] == "summary" and events[-1]["count"] == 2
+    assert too_many.status_code == 400
+
+
+def test_create_query_streams_sse(test_client):
+    async def chunks():
+        for text in ["SELECT 1", ";"]:
+            chunk = MagicMock()
+            chunk.choices[0].delta.content = text
+            yield chunk
+
+    def execute(connection_id, queries, **kwargs):
+        for query in queries:
+            yield {"Query": query}
+
+    llm_cache.clear()
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.execute_queries_iter", side_effect=execute
+    ), patch("natlang.get_async_client") as mock_client:
+        mock_client.return_value.__aenter__.return_value = mock_client.return_value
+        mock_client.return_value.chat.completions.create = AsyncMock(return_value=chunks())
+        response = test_client.post(
+            "/queries?connection_id=1&stream=sse&early=1", json={"query": "one"}
+        )
+        body = response.data.decode()
+    llm_cache.clear()
+    assert response.mimetype == "text/event-stream"
+    names = [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+    assert names[:3] == ["token", "token", "statement"]
+    # The early result may arrive before or after the end of generation
+    assert sorted(names[3:]) == ["generated", "result"]
+    data = [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+    assert {"Query": "SELECT 1"} in data
+
+
+def test_create_query_result_formats(test_client):
+    llm_cache.clear()
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.execute_queries", return_value=[{"Query": "SELECT * FROM t", "Results": rows}]
+    ), patch("routes.get_db_connection"), patch(
+        "routes.stream_arrow", return_value=iter([b"arrow", b"-stream"])
+    ) as mock_arrow, patch("natlang.get_async_client") as mock_client:
+        mock_client.return_value.__aenter__.return_value = mock_client.return_value
+        create = mock_client.return_value.chat.completions.create = AsyncMock()
+        create.return_value.choices[0].message.content = "SELECT * FROM t"
+        columnar = test_client.post("/queries?connection_id=1&format=columnar", json={"query": "t"})
+        arrow = test_client.post(
+            "/queries?connection_id=1",
+            json={"query": "t"},
+            headers={"Accept": "application/vnd.apache.arrow.stream"},
+        )
+        create.return_value.choices[0].message.content = "SELECT 1; SELECT 2"
+        two_statements = test_client.post("/queries?connection_id=1&format=arrow", json={"query": "x"})
+        create.return_value.choices[0].message.content = (
+            "WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d"
+        )
+        writing = test_client.post("/queries?connection_id=1&format=arrow", json={"query": "w"})
+        unknown = test_client.post("/queries?connection_id=1&format=xml", json={"query": "t"})
+    llm_cache.clear()
+    assert columnar.json == {
+        "results": [
+            {"Query": "SELECT * FROM t", "Results": {"columns": ["id", "name"], "data": [[1, 2], ["a", "b"]]}}
+        ]
+    }
+    assert arrow.mimetype == "application/vnd.apache.arrow.stream"
+    assert arrow.data == b"arrow-stream"
+    assert mock_arrow.call_args.args[1] == "SELECT * FROM t"
+    assert two_statements.status_code == 400
+    assert writing.status_code == 400
+    assert unknown.status_code == 400
+
+
+def test_table_details_result_formats(test_client):
+    columns = [{"name": "id", "type": "integer"}, {"name": "name", "type": "text"}]
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+    details = (columns, 2, rows, "Test table", None)
+    with patch("routes.fetch_table_details", return_value=details):
+        plain = test_client.get("/table-details/t?connection_id=1")
+        columnar = test_client.get("/table-details/t?connection_id=1&format=columnar")
+        arrow = test_client.get("/table-details/t?connection_id=1&format=arrow")
+
+    assert plain.status_code == 200
+    assert plain.json["columns"] == columns
+    assert plain.json["data"] == rows
+    assert columnar.json["data"] == {"columns": ["id", "name"], "data": [[1, 2], ["a", "b"]]}
+    pyarrow = pytest.importorskip("pyarrow")
+    assert arrow.mimetype == "application/vnd.apache.arrow.stream"
+    table = pyarrow.ipc.open_stream(arrow.data).read_all()
+    assert table.column_names == ["id", "name"]
+    assert table.schema.metadata[b"rowCount"] == b"2"
+
+
+def test_generate_descriptions_rejects_concurrent_runs(test_client):
+    _jobs.clear()
+    job = claim_job(1)
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}):
+        streamed = test_client.post("/generate-descriptions?connection_id=1&stream=1")
+        plain = test_client.post("/generate-descriptions?connection_id=1")
+    assert streamed.status_code == 409
+    assert plain.status_code == 409
+    assert job.status == "running"
+
+    # A run that fails before it starts gives the job back
+    _jobs.clear()
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.fetch_missing_descriptions", side_effect=Exception("boom")
+    ):
+        failed = test_client.post("/generate-descriptions?connection_id=1&stream=1")
+    assert failed.status_code == 500
+    assert _jobs["1"].status == "idle"
+    _jobs.clear()
+
+
+def test_table_details_rejects_mismatched_cursor(test_client):
+    cursor = encode_page_cursor({"ctid": "(0,5)"})
+    with patch("routes.fetch_table_details", side_effect=PageCursorMismatch("mismatch")):
+        response = test_client.get(f"/table-details/t?connection_id=1&after={cursor}")
+    assert response.status_code == 400
+    negative = encode_page_cursor({"offset": -1})
+    response = test_client.get(f"/table-details/t?connection_id=1&after={negative}")
+    assert response.status_code == 400
+
+
+def test_run_queries_applies_budget():
+    connection, cursor = MagicMock(), MagicMock()
+    cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}, {"id": 3}], []]
+    cursor.rowcount = 3
+    budget = ExecutionBudget(timeout_ms=1000, max_rows=2)
+
+    results = list(
+        run_queries(connection, cursor, ["BEGIN", "DELETE FROM users", "COMMIT"], budget=budget)
+    )
+
+    executed = [call.args for call in cursor.execute.call_args_list]
+    assert executed == [
+        ("BEGIN",),
+        ("SET LOCAL statement_timeout = %s", (1000,)),
+        ("DELETE FROM users\nRETURNING *",),
+    ]
+    assert results[0]["DeletedRows"] == [{"id": 1}, {"id": 2}]
+    assert results[0]["Truncated"] == "maxRows"
+
+
+def test_run_queries_result_cache():
+    result_cache.clear()
+    connection, cursor = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [{"id": 1}]
+    cursor.rowcount = 1
+    select = "SELECT * FROM users"
+
+    first = list(run_queries(connection, cursor, [select], connection_id=1, use_cache=True))
+    second = list(run_queries(connection, cursor, [select], connection_id=1, use_cache=True))
+    assert first[0]["Cached"] is False
+    assert second[0]["Cached"] is True
+    assert second[0]["Results"] == [{"id": 1}]
+    assert cursor.execute.call_count == 1
+
+    # A write to the table drops the cached rows, even when the cache is bypassed
+    list(run_queries(connection, cursor, ["DELETE FROM users"], connection_id=1))
+    third = list(run_queries(connection, cursor, [select], connection_id=1, use_cache=True))
+    assert third[0]["Cached"] is False
+
+    # So does a data-modifying CTE, even though it is typed as a SELECT
+    list(run_queries(connection, cursor, [select], connection_id=1, use_cache=True))
+    write = "WITH d AS (DELETE FROM users WHERE id = 1 RETURNING *) SELECT * FROM d"
+    list(run_queries(connection, cursor, [write], connection_id=1, use_cache=True))
+    assert result_cache.get(1, select) is None
+
+    # Statements with side effects or changing values are always run
+    for query in ("SELECT nextval('users_id_seq')", "SELECT now()"):
+        list(run_queries(connection, cursor, [query], connection_id=1, use_cache=True))
+        assert result_cache.get(1, query) is None
+    result_cache.clear()
+
+
+def test_run_queries_streams_only_read_only_selects():
+    connection, cursor = MagicMock(), MagicMock()
+    cursor.fetchall.return_value = [{"id": 1}]
+    cursor.rowcount = 1
+    write = "WITH d AS (DELETE FROM queue RETURNING *) SELECT * FROM d"
+    with patch("routes.stream_select", return_value=iter([{"type": "rows"}])) as mock_stream:
+        events = list(
+            run_queries(connection, cursor, [write, "SELECT * FROM queue"], stream=True)
+        )
+    # DECLARE rejects data-modifying CTEs, so the write runs as a plain statement
+    assert events[0]["Results"] == [{"id": 1}]
+    assert events[1] == {"type": "rows"}
+    assert mock_stream.call_args.args[1] == "SELECT * FROM queue"
+
+
+def test_replica_routing_of_writes():
+    # Only statement lists that cannot write may run on a replica
+    assert read_only(["SELECT * FROM users", "SELECT count(*) FROM orders"])
+    assert not read_only(["SELECT nextval('users_id_seq')"])
+    assert not read_only(["WITH d AS (DELETE FROM queue RETURNING *) SELECT * FROM d"])
+    assert not read_only(iter(["SELECT 1"]))
+
+    # A write keeps the connection's reads on the primary, even as a data-modifying CTE
+    replica_router.forget(7)
+    connection, cursor = MagicMock(), MagicMock()
+    write = "WITH d AS (DELETE FROM queue RETURNING *) SELECT * FROM d"
+    list(run_queries(connection, cursor, [write], connection_id=7))
+    assert replica_router.candidates(7, 2) == []
+    replica_router.forget(7)
+
+
+def test_query_budget_and_cancel_routes(test_client):
+    invalid = test_client.post("/queries?connection_id=1&max_rows=0", json={"query": "x"})
+    assert invalid.status_code == 400
+    assert test_client.post("/queries/unknown/cancel").status_code == 404
+
+    connection = MagicMock()
+    with running_queries.track("q1", connection):
+        response = test_client.post("/queries/q1/cancel")
+    assert response.status_code == 200
+    connection.cancel.assert_called_once()
+
+
+def test_create_query_preflight(test_client):
+    plan = {"Query": "SELECT * FROM big", "totalCost": 5e6, "planRows": 10, "seqScans": [], "exceeds": ["cost"]}
+    llm_cache.clear()
+    with patch("routes.fetch_db_schemas", return_value={"public": {}}), patch(
+        "routes.preflight_queries", return_value=[plan]
+    ), patch(
+        "routes.execute_queries", return_value=[{"Query": "SELECT * FROM big", "Results": []}]
+    ) as mock_execute, patch("natlang.get_async_client") as mock_client:
+        mock_client.return_value.__aenter__.return_value = mock_client.return_value
+        create = mock_client.return_value.chat.completions.create = AsyncMock()
+        create.return_value.choices[0].message.content = "SELECT * FROM big"
+        gated = test_client.post("/queries?connection_id=1&preflight=1", json={"query": "big"})
+        assert not mock_execute.called
+        confirmed = test_client.post(
+            "/queries?connection_id=1&preflight=1&confirm=1", json={"query": "big"}
+        )
+    llm_cache.clear()
+    assert gated.status_code == 409
+    assert gated.json["plans"] == [plan]
+    assert gated.json["queries"] == ["SELECT * FROM big"]
+    assert confirmed.status_code == 200
+    assert confirmed.json["plans"] == [plan]
+    assert confirmed.json["results"] == [{"Query": "SELECT * FROM big", "Results": []}]
@@ -0,0 +1,76 @@
+import pytest
+from schema_index import SchemaIndex, get_schema_index, prune_schema, terms
+
+
+def column(name, references=None, description=None):
+    return {
+        "name": name,
+        "type": "integer",
+        "nullable": True,
+        "default": None,
+        "primary_key": name == "id",
+        "foreign_keys": [{"table": references, "column": "id"}] if references else [],
+        "description": description,
+    }
+
+
+@pytest.fixture
+def schema():
+    return {
+        "sales": {
+            "customers": [column("id"), column("full_name"), column("region_id", "geo.regions")],
+            "orders": [column("id"), column("customer_id", "sales.customers"), column("placedAt")],
+            "invoices": [column("id"), column("order_id", "sales.orders")],
+        },
+        "geo": {
+            "regions": [column("id"), column("country_id", "geo.countries")],
+            "countries": [column("id"), column("iso_code", description="ISO country code")],
+        },
+        "hr": {
+            "employees": [column("id"), column("salary", description="Yearly pay")],
+        },
+    }
+
+
+def test_terms_split_identifiers():
+    assert terms("placedAt order_items") == ["placed", "at", "order", "items", "item"]
+    assert "category" in terms("categories")
+
+
+def test_search_ranks_matching_table_first(schema):
+    results = SchemaIndex(schema).search("how much salary does each employee get")
+    assert results[0][0] == "hr.employees"
+
+
+def test_select_tables_follows_foreign_keys(schema):
+    index = SchemaIndex(schema)
+    assert index.select_tables("total invoices", top_k=1, depth=1) == {"sales.invoices", "sales.orders"}
+    assert index.select_tables("total invoices", top_k=1, depth=2) == {
+        "sales.invoices",
+        "sales.orders",
+        "sales.customers",
+    }
+
+
+def test_prune_schema_keeps_relevant_tables(schema):
+    pruned = prune_schema(schema, "when were orders placed", top_k=1, min_tables=0)
+    assert list(pruned) == ["sales", "geo"]
+    assert list(pruned["sales"]) == ["customers", "orders"]
+    assert list(pruned["geo"]) == ["regions"]
+    assert pruned["sales"]["orders"] is schema["sales"]["orders"]
+
+
+def test_prune_schema_leaves_small_or_unmatched_schemas(schema):
+    assert prune_schema(schema, "orders per customer", top_k=2, min_tables=30) is schema
+    assert prune_schema(schema, "orders per customer", top_k=0, min_tables=0) is schema
+    assert prune_schema(schema, "weather tomorrow", top_k=2, min_tables=0) is schema
+
+
+def test_schema_index_is_reused_per_schema(schema):
+    assert get_schema_index(schema) is get_schema_index(schema)
+    assert get_schema_index(dict(schema)) is not get_schema_index(schema)
+
+
+def test_prune_schema_returns_same_dict_for_same_selection(schema):
+    first = prune_schema(schema, "when were orders placed", top_k=1, min_tables=0)
+    assert prune_schema(schema, "orders placed when?", top_k=1, min_tables=0) is first
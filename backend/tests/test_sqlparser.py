@@ -0,0 +1,139 @@
+import random
+import time
+import pytest
+from sqlparser import (
+    StatementSplitter,
+    normalize_sql,
+    parse_statement,
+    split_statements,
+    tokenize,
+)
+
+SCRIPT = (
+    "SELECT ';' AS a;\n"
+    "-- a comment; with a semicolon\n"
+    "CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql;\n"
+    "SELECT $body$ ; $$ ; $body$;\n"
+    "SELECT E'it\\'s; fine', 'it''s; fine';\n"
+    "/* outer /* nested; */ still comment; */ SELECT \"semi;colon\" FROM t;\n"
+    "INSERT INTO t VALUES (1, ';')"
+)
+
+# Fragments used to build random scripts for the fuzz tests
+FRAGMENTS = [
+    "SELECT 1", "'a;b'", "'it''s'", "E'\\';'", '"q;id"', "$$x;y$$", "$t$ $$ ; $t$",
+    "-- c;\n", "/* c; */", "/* a /* b; */ c; */", "(1; 2)", "x::text", "$1", "a.b",
+    "1.5e3", ".5", "<>", "-", "/", "$", "e", "E", "\n", " ",
+]
+
+
+def test_split_statements_ignores_quoted_semicolons():
+    assert split_statements(SCRIPT) == [
+        "SELECT ';' AS a",
+        "-- a comment; with a semicolon\n"
+        "CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql",
+        "SELECT $body$ ; $$ ; $body$",
+        "SELECT E'it\\'s; fine', 'it''s; fine'",
+        "/* outer /* nested; */ still comment; */ SELECT \"semi;colon\" FROM t",
+        "INSERT INTO t VALUES (1, ';')",
+    ]
+
+
+def test_split_statements_skips_empty_statements():
+    assert split_statements(";; -- only a comment\n; SELECT 1;  ") == ["SELECT 1"]
+
+
+def test_splitter_matches_for_any_chunking():
+    expected = split_statements(SCRIPT)
+    rng = random.Random(0)
+    for _ in range(200):
+        splitter, statements, pos = StatementSplitter(), [], 0
+        while pos < len(SCRIPT):
+            size = rng.randint(1, 8)
+            statements += splitter.feed(SCRIPT[pos: pos + size])
+            pos += size
+        assert statements + splitter.finish() == expected
+
+
+def test_fuzz_tokenize_round_trips():
+    rng = random.Random(1)
+    alphabet = "ab1 ;'\"$-/*eE.()\\\n:"
+    for _ in range(500):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+        assert "".join(token.value for token in tokenize(text)) == text
+
+
+def test_fuzz_split_random_scripts():
+    rng = random.Random(2)
+    for _ in range(300):
+        text = "".join(rng.choice(FRAGMENTS + [";"]) for _ in range(rng.randint(0, 30)))
+        whole = split_statements(text)
+        splitter, chunked, pos = StatementSplitter(), [], 0
+        while pos < len(text):
+            size = rng.randint(1, 5)
+            chunked += splitter.feed(text[pos: pos + size])
+            pos += size
+        assert chunked + splitter.finish() == whole
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["'" * 100000, "$" * 100000, "/*" * 50000, "-" * 100000, "$a" * 50000, "E'\\" * 30000, "(" * 100000],
+)
+def test_pathological_input_is_linear(text):
+    start = time.perf_counter()
+    split_statements(text)
+    list(tokenize(text))
+    assert time.perf_counter() - start < 5
+
+
+def test_parse_statement_tables():
+    statement = parse_statement(
+        'SELECT u.name FROM public.users u JOIN "Orders" o ON o.user_id = u.id '
+        "WHERE u.id IN (SELECT user_id FROM vip) AND extract(year FROM o.placed) = 2024 "
+        "ORDER BY 1"
+    )
+    assert statement.type == "select"
+    assert statement.tables == ["public.users", "Orders", "vip"]
+    assert statement.where == (
+        "u.id IN (SELECT user_id FROM vip) AND extract(year FROM o.placed) = 2024"
+    )
+    assert statement.is_read_only
+
+
+def test_parse_statement_ctes():
+    statement = parse_statement(
+        "WITH moved AS (DELETE FROM queue WHERE done RETURNING *) "
+        "INSERT INTO archive SELECT * FROM moved"
+    )
+    assert statement.type == "insert"
+    assert statement.target == "archive"
+    assert statement.tables == ["queue", "archive"]
+    assert not parse_statement("WITH m AS (DELETE FROM q RETURNING *) SELECT * FROM m").is_read_only
+
+
+def test_parse_statement_targets():
+    assert parse_statement("UPDATE ONLY sales.orders SET total = 0").target == "sales.orders"
+    assert parse_statement("COMMENT ON COLUMN public.users.name IS 'x'").target == "public.users"
+    assert parse_statement("begin").type == "begin"
+    assert not parse_statement("SELECT * FROM t FOR UPDATE").is_read_only
+
+
+def test_normalize_sql():
+    assert normalize_sql("select *\n  FROM Users -- all\n;") == "select * from users"
+    assert normalize_sql("SELECT * FROM users") == normalize_sql("select  *  from USERS;")
+    # Quoted names and literals keep their case
+    assert normalize_sql("SELECT 'A' FROM \"Users\"") == "select 'A' from \"Users\""
+
+
+def test_parse_statement_side_effects_and_volatility():
+    assert not parse_statement("SELECT nextval('orders_id_seq')").is_read_only
+    assert not parse_statement("SELECT pg_catalog.setval('s', 1)").is_read_only
+    assert not parse_statement("SELECT pg_advisory_lock(1)").is_read_only
+    assert not parse_statement("SELECT * FROM t WHERE pg_terminate_backend(pid)").is_read_only
+    # Volatile but read-only: may go to a replica, but not be cached
+    now = parse_statement("SELECT id, now() FROM t")
+    assert now.is_read_only and not now.is_cacheable
+    assert not parse_statement("SELECT current_timestamp").is_cacheable
+    assert parse_statement("SELECT count(*) FROM t WHERE id IN (1, 2)").is_cacheable
+    assert not parse_statement("WITH d AS (DELETE FROM q RETURNING *) SELECT * FROM d").is_cacheable
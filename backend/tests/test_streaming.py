@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+from collections import namedtuple
+from unittest.mock import MagicMock
+from flask import Flask
+from batch import iterate_sync
+from execution import ExecutionBudget
+from streaming import describe_columns, generate_and_execute, ndjson, sse, stream_select
+
+Column = namedtuple("Column", ["name", "type_code"])
+
+
+def test_describe_columns():
+    assert describe_columns([Column("id", 23), Column("payload", 0)]) == [
+        {"name": "id", "type": "integer", "typeOid": 23},
+        {"name": "payload", "type": None, "typeOid": 0},
+    ]
+
+
+def test_stream_select_batches():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.description = [Column("id", 23)]
+    cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], [{"id": 3}], []]
+
+    events = list(stream_select(connection, "SELECT id FROM t", "q1", batch_size=2))
+
+    assert [event["type"] for event in events] == ["header", "rows", "rows", "trailer"]
+    assert events[0]["columns"] == [{"name": "id", "type": "integer", "typeOid": 23}]
+    assert events[2]["rows"] == [{"id": 3}]
+    assert events[3]["truncated"] is None
+
+
+def test_stream_select_stops_at_row_cap():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.description = [Column("id", 23)]
+    cursor.fetchmany.side_effect = [[{"id": 1}, {"id": 2}], [{"id": 3}, {"id": 4}]]
+
+    events = list(
+        stream_select(connection, "SELECT id FROM t", "q1", batch_size=2, budget=ExecutionBudget(max_rows=3))
+    )
+
+    assert [event["type"] for event in events] == ["header", "rows", "rows", "trailer"]
+    assert events[2]["rows"] == [{"id": 3}]
+    assert events[3]["rowCount"] == 3
+    assert events[3]["truncated"] == "maxRows"
+    assert events[-1]["rowCount"] == 3
+    # Rows come from a named (server-side) cursor
+    assert "name" in connection.cursor.call_args.kwargs
+
+
+def test_ndjson():
+    app = Flask(__name__)
+    with app.app_context():
+        lines = list(ndjson([{"type": "rows", "rows": [{"b": 1, "a": 2}]}]))
+    assert lines[0].endswith("\n")
+    assert list(json.loads(lines[0])["rows"][0]) == ["b", "a"]
+
+
+def run_generation(chunks, early, fail_on=None):
+    generation_done = threading.Event()
+    executed = []
+
+    async def deltas():
+        for chunk in chunks:
+            await asyncio.sleep(0.01)
+            yield chunk
+        generation_done.set()
+
+    def execute(statements):
+        for statement in statements:
+            executed.append((statement, generation_done.is_set()))
+            if statement == fail_on:
+                error = Exception("boom")
+                error.query = statement
+                raise error
+            yield {"Query": statement}
+
+    events = list(iterate_sync(generate_and_execute(deltas(), execute, early=early)))
+    return events, executed
+
+
+def test_generate_and_execute_runs_read_only_prefix_early():
+    chunks = ["SELECT 1;", " SELECT", " 2; DELETE FROM t;", " SELECT 3"]
+    events, executed = run_generation(chunks, early=True)
+
+    statements = [event["query"] for event in events if event["type"] == "statement"]
+    assert statements == ["SELECT 1", "SELECT 2", "DELETE FROM t", "SELECT 3"]
+    assert "".join(event["text"] for event in events if event["type"] == "token") == "".join(chunks)
+    assert [event["Query"] for event in events if event["type"] == "result"] == statements
+    # Only the leading reads ran before generation finished
+    assert executed == [
+        ("SELECT 1", False),
+        ("SELECT 2", False),
+        ("DELETE FROM t", True),
+        ("SELECT 3", True),
+    ]
+
+
+def test_generate_and_execute_waits_without_early():
+    events, executed = run_generation(["SELECT 1;", "SELECT 2"], early=False)
+    assert all(after_generation for _, after_generation in executed)
+    assert [event["type"] for event in events][-2:] == ["result", "result"]
+
+
+def test_generate_and_execute_reports_statement_errors():
+    events, executed = run_generation(["SELECT 1; SELECT 2; SELECT 3"], early=True, fail_on="SELECT 2")
+    assert [statement for statement, _ in executed] == ["SELECT 1", "SELECT 2"]
+    assert events[-1] == {"type": "error", "error": "SQL Execution Error: boom", "query": "SELECT 2"}
+
+
+def test_sse_format():
+    app = Flask(__name__)
+    with app.app_context():
+        assert list(sse([{"type": "statement", "index": 0, "query": "SELECT 1"}])) == [
+            'event: statement\ndata: {"index": 0, "query": "SELECT 1"}\n\n'
+        ]
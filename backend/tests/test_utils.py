@@ -1,13 +1,24 @@
 import pytest
 from unittest.mock import patch, MagicMock
+from sqlparser import parse_statement, split_statements
 from utils import (
     fetch_db_schemas,
     fetch_table_list,
     fetch_table_details,
     get_table_name,
     get_where_clause,
-    get_new_rows,
+    add_returning,
+    get_statement_type,
+    parse_update,
+    build_update_capture,
+    schema_cache,
+    encode_page_cursor,
+    decode_page_cursor,
+    PageCursorMismatch,
+    apply_statements,
+    fetch_missing_descriptions,
 )
+import psycopg2
 
 
 # Mock database connection and cursor
@@ -20,33 +31,76 @@ def mock_db_connection():
         yield mock_cursor
 
 
+@pytest.fixture(autouse=True)
+def clear_schema_cache():
+    schema_cache.clear()
+    yield
+    schema_cache.clear()
+
+
+COLUMN_ROWS = [
+    {
+        "table_schema": "public",
+        "table_name": "users",
+        "table_oid": 100,
+        "attnum": 1,
+        "column_name": "id",
+        "data_type": "integer",
+        "is_nullable": False,
+        "column_default": "nextval('users_id_seq'::regclass)",
+        "description": None,
+    },
+    {
+        "table_schema": "public",
+        "table_name": "users",
+        "table_oid": 100,
+        "attnum": 2,
+        "column_name": "name",
+        "data_type": "text",
+        "is_nullable": True,
+        "column_default": None,
+        "description": None,
+    },
+    {
+        "table_schema": "public",
+        "table_name": "orders",
+        "table_oid": 200,
+        "attnum": 1,
+        "column_name": "user_id",
+        "data_type": "integer",
+        "is_nullable": True,
+        "column_default": None,
+        "description": "Ordering user",
+    },
+]
+
+CONSTRAINT_ROWS = [
+    {
+        "table_oid": 100,
+        "contype": "p",
+        "attnum": 1,
+        "foreign_table": None,
+        "foreign_column": None,
+    },
+    {
+        "table_oid": 200,
+        "contype": "f",
+        "attnum": 1,
+        "foreign_table": "public.users",
+        "foreign_column": "id",
+    },
+    {
+        "table_oid": 200,
+        "contype": "f",
+        "attnum": 1,
+        "foreign_table": "public.users",
+        "foreign_column": "id",
+    },
+]
+
+
 def test_fetch_db_schemas(mock_db_connection):
-    mock_db_connection.fetchall.return_value = [
-        {
-            "table_schema": "public",
-            "table_name": "users",
-            "column_name": "id",
-            "data_type": "integer",
-            "is_nullable": "NO",
-            "column_default": "nextval('users_id_seq'::regclass)",
-            "constraint_types": ["PRIMARY KEY"],
-            "foreign_tables": [],
-            "foreign_columns": [],
-            "description": None,
-        },
-        {
-            "table_schema": "public",
-            "table_name": "users",
-            "column_name": "name",
-            "data_type": "text",
-            "is_nullable": "YES",
-            "column_default": None,
-            "constraint_types": [],
-            "foreign_tables": [],
-            "foreign_columns": [],
-            "description": None,
-        },
-    ]
+    mock_db_connection.fetchall.side_effect = [COLUMN_ROWS, CONSTRAINT_ROWS]
     result = fetch_db_schemas("test_connection_id")
     expected = {
         "public": {
@@ -69,12 +123,55 @@ def test_fetch_db_schemas(mock_db_connection):
                     "foreign_keys": [],
                     "description": None,
                 },
-            ]
+            ],
+            "orders": [
+                {
+                    "name": "user_id",
+                    "type": "integer",
+                    "nullable": True,
+                    "default": None,
+                    "primary_key": False,
+                    "foreign_keys": [{"table": "public.users", "column": "id"}],
+                    "description": "Ordering user",
+                },
+            ],
         }
     }
     assert result == expected
 
 
+def test_fetch_db_schemas_cache(mock_db_connection):
+    mock_db_connection.fetchone.return_value = {"fingerprint": "v1"}
+    mock_db_connection.fetchall.side_effect = lambda: []
+    first = fetch_db_schemas(1)
+    assert fetch_db_schemas(1) is first
+    assert mock_db_connection.fetchall.call_count == 2
+
+    # A changed catalog fingerprint forces the schema to be read again
+    mock_db_connection.fetchone.return_value = {"fingerprint": "v2"}
+    fetch_db_schemas(1)
+    assert mock_db_connection.fetchall.call_count == 4
+
+    fetch_db_schemas(1, refresh=True)
+    assert mock_db_connection.fetchall.call_count == 6
+    assert schema_cache.stats()["hits"] == 1
+
+
+def test_fetch_db_schemas_reuses_unchanged_tables(mock_db_connection):
+    mock_db_connection.fetchone.return_value = {"fingerprint": "v1"}
+    mock_db_connection.fetchall.side_effect = [COLUMN_ROWS, CONSTRAINT_ROWS]
+    first = fetch_db_schemas(1)
+    # A comment on orders changes only that table
+    changed = [dict(row) for row in COLUMN_ROWS]
+    changed[-1]["description"] = "The user who placed the order"
+    mock_db_connection.fetchone.return_value = {"fingerprint": "v2"}
+    mock_db_connection.fetchall.side_effect = [changed, CONSTRAINT_ROWS]
+    second = fetch_db_schemas(1)
+    assert second is not first
+    assert second["public"]["users"] is first["public"]["users"]
+    assert second["public"]["orders"] is not first["public"]["orders"]
+
+
 def test_fetch_table_list(mock_db_connection):
     mock_db_connection.fetchall.side_effect = [
         [
@@ -101,18 +198,22 @@ def test_fetch_table_list(mock_db_connection):
 
 
 def test_fetch_table_details(mock_db_connection):
-    mock_db_connection.fetchall.side_effect = [
-        [
-            {"column_name": "id", "data_type": "integer"},
-            {"column_name": "name", "data_type": "text"},
-        ],
-        [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}],
+    mock_db_connection.fetchall.return_value = [
+        {"column_name": "id", "data_type": "integer"},
+        {"column_name": "name", "data_type": "text"},
     ]
     mock_db_connection.fetchone.side_effect = [
+        {
+            "description": "User table description",
+            "estimated_count": 2,
+            "primary_key": ["id"],
+        },
         {"count": 2},
-        {"description": "User table description"},
     ]
-    columns, row_count, data, description = fetch_table_details(
+    mock_db_connection.__iter__.return_value = iter(
+        [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}]
+    )
+    columns, row_count, data, description, next_cursor = fetch_table_details(
         "test_connection_id", "users", "public"
     )
     assert columns == [
@@ -122,6 +223,87 @@ def test_fetch_table_details(mock_db_connection):
     assert row_count == 2
     assert data == [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}]
     assert description == "User table description"
+    assert next_cursor is None
+
+
+def test_fetch_table_details_pagination(mock_db_connection):
+    mock_db_connection.fetchall.return_value = [
+        {"column_name": "id", "data_type": "integer"},
+    ]
+    mock_db_connection.fetchone.return_value = {
+        "description": None,
+        "estimated_count": 1000,
+        "primary_key": ["id"],
+    }
+    mock_db_connection.__iter__.return_value = iter([{"id": 3}, {"id": 4}, {"id": 5}])
+    columns, row_count, data, description, next_cursor = fetch_table_details(
+        "test_connection_id",
+        "users",
+        "public",
+        page_size=2,
+        after={"key": [2]},
+        estimate_count=True,
+    )
+    # The estimate replaces the COUNT(*) scan, so only two statements run before the page query
+    assert mock_db_connection.execute.call_count == 3
+    assert row_count == 1000
+    assert data == [{"id": 3}, {"id": 4}]
+    assert decode_page_cursor(next_cursor) == {"key": [4]}
+    page_query, params = mock_db_connection.execute.call_args[0]
+    assert params == [2, 3]
+
+
+@pytest.mark.parametrize(
+    "primary_key, after",
+    [(["id"], {"ctid": "(0,5)"}), ([], {"key": [2]}), (["a", "b"], {"key": [2]})],
+)
+def test_fetch_table_details_rejects_mismatched_cursor(mock_db_connection, primary_key, after):
+    mock_db_connection.fetchall.return_value = [{"column_name": "id", "data_type": "integer"}]
+    mock_db_connection.fetchone.return_value = {
+        "description": None,
+        "estimated_count": 10,
+        "primary_key": primary_key,
+    }
+    with pytest.raises(PageCursorMismatch):
+        fetch_table_details("test_connection_id", "users", "public", after=after)
+
+
+def test_fetch_table_details_pages_by_ctid(mock_db_connection):
+    mock_db_connection.fetchall.return_value = [{"column_name": "name", "data_type": "text"}]
+    mock_db_connection.fetchone.return_value = {
+        "description": None,
+        "estimated_count": 1000,
+        "primary_key": [],
+    }
+    mock_db_connection.__iter__.return_value = iter(
+        [
+            {"__page_ctid": "(0,3)", "name": "c"},
+            {"__page_ctid": "(0,4)", "name": "d"},
+            {"__page_ctid": "(1,1)", "name": "e"},
+        ]
+    )
+    _, _, data, _, next_cursor = fetch_table_details(
+        "test_connection_id",
+        "logs",
+        "public",
+        page_size=2,
+        after={"ctid": "(0,2)"},
+        estimate_count=True,
+    )
+    assert data == [{"name": "c"}, {"name": "d"}]
+    assert decode_page_cursor(next_cursor) == {"ctid": "(0,4)"}
+    page_query, params = mock_db_connection.execute.call_args[0]
+    assert params == ["(0,2)", 3]
+
+
+def test_decode_page_cursor():
+    assert decode_page_cursor(encode_page_cursor({"ctid": "(12,3)"})) == {"ctid": "(12,3)"}
+    # Offsets are not cursors; ctids must be well formed
+    for position in ({"offset": 500}, {"offset": -1}, {"ctid": "(0,1); DROP"}):
+        with pytest.raises(ValueError):
+            decode_page_cursor(encode_page_cursor(position))
+    with pytest.raises(ValueError):
+        decode_page_cursor("not a cursor")
 
 
 def test_get_table_name():
@@ -136,8 +318,89 @@ def test_get_where_clause():
     assert where_clause == "id = 1"
 
 
-def test_get_new_rows():
-    pre = [{"id": 1, "name": "Alice"}]
-    post = [{"id": 1, "name": "Alice"}, {"id": 2, "name": "Bob"}]
-    new_rows = get_new_rows(pre, post)
-    assert new_rows == [{"id": 2, "name": "Bob"}]
+def test_add_returning():
+    assert (
+        add_returning("INSERT INTO users (name) VALUES ('Bob');")
+        == "INSERT INTO users (name) VALUES ('Bob')\nRETURNING *"
+    )
+    query = "DELETE FROM users WHERE id = 1 RETURNING id"
+    assert add_returning(query) == query
+    # A trailing line comment must not swallow the clause
+    query = add_returning("INSERT INTO t VALUES (1) -- add row")
+    assert query == "INSERT INTO t VALUES (1) -- add row\nRETURNING *"
+    assert parse_statement(query).has_clause("returning")
+
+
+def test_get_statement_type():
+    assert get_statement_type("SELECT 1") == "select"
+    assert get_statement_type("-- note\nupdate users set name = 'x'") == "update"
+    assert (
+        get_statement_type(
+            "WITH moved AS (DELETE FROM a RETURNING *) INSERT INTO b SELECT * FROM moved"
+        )
+        == "insert"
+    )
+    assert get_statement_type("WITH s AS (SELECT 'update') SELECT * FROM s") == "select"
+
+
+def test_parse_update():
+    assert parse_update(
+        "UPDATE public.users u SET name = 'x' FROM teams t WHERE t.id = u.team_id;"
+    ) == {
+        "target": "public.users",
+        "only": False,
+        "alias": "u",
+        "set": "name = 'x'",
+        "from": "teams t",
+        "where": "t.id = u.team_id",
+    }
+    assert parse_update("UPDATE users SET name = 'x' RETURNING id") is None
+    assert (
+        parse_update("UPDATE t SET a = (SELECT b FROM c WHERE c.id = 1)")["where"]
+        is None
+    )
+
+
+def test_build_update_capture_keeps_only():
+    query = build_update_capture("UPDATE ONLY public.users SET name = 'x' WHERE id = 1")
+    assert "FROM ONLY public.users\n" in query
+    assert "UPDATE ONLY public.users SET name = 'x'" in query
+    assert "FOR UPDATE OF users" in query
+    assert "ONLY" not in build_update_capture("UPDATE users SET name = 'x'")
+
+
+def test_apply_statements_skips_failing_statements(mock_db_connection):
+    def execute(statement):
+        if "bad" in statement:
+            raise psycopg2.Error("syntax error")
+
+    mock_db_connection.execute.side_effect = execute
+    assert apply_statements(1, ["COMMENT ON TABLE a IS 'ok'"]) == []
+    assert mock_db_connection.execute.call_count == 1
+
+    mock_db_connection.execute.reset_mock()
+    skipped = apply_statements(1, ["COMMENT ON TABLE a IS 'ok'", "COMMENT bad"])
+    assert skipped == ["COMMENT bad"]
+    executed = [call.args[0] for call in mock_db_connection.execute.call_args_list]
+    assert "ROLLBACK TO SAVEPOINT apply_statement" in executed
+
+    # A trailing comment does not merge the next statement into it
+    mock_db_connection.execute.reset_mock()
+    statements = ["COMMENT ON TABLE a IS 'ok' -- table a", "COMMENT ON TABLE b IS 'ok'"]
+    assert apply_statements(1, statements) == []
+    script = mock_db_connection.execute.call_args.args[0]
+    assert split_statements(script) == statements
+
+
+def test_fetch_missing_descriptions(mock_db_connection):
+    mock_db_connection.fetchall.return_value = [
+        {"table_schema": "public", "table_name": "users", "column_name": None},
+        {"table_schema": "public", "table_name": "users", "column_name": "id"},
+        {"table_schema": "sales", "table_name": "orders", "column_name": "total"},
+    ]
+    assert fetch_missing_descriptions(1) == {
+        "public.users": {"table": True, "columns": ["id"]},
+        "sales.orders": {"table": False, "columns": ["total"]},
+    }
+    # One catalog query covers tables and columns in every schema
+    assert mock_db_connection.execute.call_count == 1
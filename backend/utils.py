@@ -1,9 +1,13 @@
-from database import get_db_connection
-from collections import defaultdict
+from database import get_db_connection, replica_router
+from cache import TTLCache
+from config import Config
+from result_cache import result_cache
+from sqlparser import parse_statement
+import base64
+import json
 import re
+from itertools import islice
 from psycopg2 import sql
-from datetime import date, datetime, time, timedelta
-from decimal import Decimal
 import uuid
 import psycopg2.extras
 
@@ -11,7 +15,7 @@ import psycopg2.extras
 # Fetch a list of all tables in the database along with their descriptions
 def fetch_table_list(connection_id):
     try:
-        with get_db_connection(connection_id) as connection:
+        with get_db_connection(connection_id, readonly=True) as connection:
             with connection.cursor() as cursor:
                 # Query to fetch all user-defined tables and their descriptions in the database, excluding system tables
                 table_query = """
@@ -46,9 +50,53 @@ def fetch_table_list(connection_id):
         return []
 
 
-def fetch_table_details(connection_id, table_name, schema_name):
+# A row's physical position, "(block,offset)", which orders tables that have no primary key
+CTID = re.compile(r"\(\d+,\d+\)")
+# Column the page query returns each row's ctid in, removed before the rows are returned
+CTID_COLUMN = "__page_ctid"
+
+
+# Encode the position after the last row of a page as an opaque cursor token
+# Keyset cursors carry the primary key values of the last row, or its ctid for tables without one
+def encode_page_cursor(position):
+    payload = json.dumps(position, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+# Decode a cursor token produced by encode_page_cursor, raising ValueError if it is malformed
+def decode_page_cursor(token):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page cursor")
+    if not isinstance(position, dict) or not (
+        isinstance(position.get("key"), list)
+        or (isinstance(position.get("ctid"), str) and CTID.fullmatch(position["ctid"]))
+    ):
+        raise ValueError("Invalid page cursor")
+    return position
+
+
+# Raised when a page cursor is for the other paging mode than the table's, or for another primary
+# key, for example after the key was added, dropped or changed
+class PageCursorMismatch(ValueError):
+    pass
+
+
+# Fetch one page of a table along with its columns, row count and description
+# Pages are read in primary key order when the table has one, and in ctid order otherwise; both are
+# keysets, so pages neither overlap nor skip rows however large the table (a ctid range is a TID
+# range scan on PostgreSQL 14+). Rows updated while paging by ctid move, and may be seen twice
+def fetch_table_details(
+    connection_id,
+    table_name,
+    schema_name,
+    page_size=Config.TABLE_PAGE_SIZE,
+    after=None,
+    estimate_count=False,
+):
     try:
-        with get_db_connection(connection_id) as connection:
+        with get_db_connection(connection_id, readonly=True) as connection:
             with connection.cursor() as cursor:
                 # Fetch column details
                 cursor.execute(
@@ -56,257 +104,422 @@ def fetch_table_details(connection_id, table_name, schema_name):
                     SELECT column_name, data_type
                     FROM information_schema.columns
                     WHERE table_name = %s AND table_schema = %s
+                    ORDER BY ordinal_position
                     """,
                     (table_name, schema_name),
                 )
                 columns = cursor.fetchall()
 
-                # Fetch row count
+                # Fetch table description, planner row estimate and primary key columns
                 cursor.execute(
-                    sql.SQL("SELECT COUNT(*) FROM {}.{}").format(
-                        sql.Identifier(schema_name), sql.Identifier(table_name)
-                    )
+                    """
+                    SELECT
+                        obj_description(c.oid, 'pg_class') AS description,
+                        c.reltuples::bigint AS estimated_count,
+                        ARRAY(
+                            SELECT a.attname::text
+                            FROM pg_index AS i
+                            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+                            JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                            WHERE i.indrelid = c.oid AND i.indisprimary
+                            ORDER BY k.ord
+                        ) AS primary_key
+                    FROM pg_class AS c
+                    JOIN pg_namespace AS n ON n.oid = c.relnamespace
+                    WHERE c.relname = %s AND n.nspname = %s
+                    """,
+                    (table_name, schema_name),
                 )
-                row_count = cursor.fetchone()
+                table_info = cursor.fetchone() or {}
+                primary_key = table_info.get("primary_key") or []
+                if after is not None:
+                    by_key = "key" in after
+                    if by_key != bool(primary_key) or (by_key and len(after["key"]) != len(primary_key)):
+                        raise PageCursorMismatch("Page cursor does not match the table's paging")
 
-                # Fetch table data
-                cursor.execute(
-                    sql.SQL("SELECT * FROM {}.{}").format(
-                        sql.Identifier(schema_name), sql.Identifier(table_name)
+                # Fetch row count, using the planner estimate when asked for and the table has been analyzed
+                estimated_count = table_info.get("estimated_count")
+                if estimate_count and estimated_count is not None and estimated_count >= 0:
+                    row_count = estimated_count
+                else:
+                    cursor.execute(
+                        sql.SQL("SELECT COUNT(*) FROM {}.{}").format(
+                            sql.Identifier(schema_name), sql.Identifier(table_name)
+                        )
                     )
-                )
-                data = cursor.fetchall()
+                    row_count = cursor.fetchone()
+                    row_count = row_count["count"] if row_count else 0
 
-                # Fetch table description
-                cursor.execute(
-                    """
-                    SELECT obj_description(oid) AS description
-                    FROM pg_class
-                    WHERE relname = %s AND relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = %s)
-                    """,
-                    (table_name, schema_name),
+            # Fetch one extra row to tell whether there is a next page
+            table = sql.SQL("{}.{}").format(
+                sql.Identifier(schema_name), sql.Identifier(table_name)
+            )
+            if primary_key:
+                key_columns = sql.SQL(", ").join(map(sql.Identifier, primary_key))
+                page_query = sql.SQL("SELECT * FROM {} ").format(table)
+                params = []
+                if after:
+                    page_query += sql.SQL("WHERE ({}) > ({}) ").format(
+                        key_columns,
+                        sql.SQL(", ").join(sql.Placeholder() * len(after["key"])),
+                    )
+                    params = list(after["key"])
+                page_query += sql.SQL("ORDER BY {} LIMIT %s").format(key_columns)
+                params.append(page_size + 1)
+            else:
+                page_query = sql.SQL("SELECT ctid::text AS {}, * FROM {} ").format(
+                    sql.Identifier(CTID_COLUMN), table
                 )
-                description = cursor.fetchone()
-
-                # Process the fetched data
-                columns = [
-                    {"name": col["column_name"], "type": col["data_type"]}
-                    for col in columns
-                ]
-                row_count = row_count["count"] if row_count else 0
-
-                # Convert non-serializable objects to strings
-                def convert_value(value):
-                    if isinstance(value, datetime):
-                        return value.isoformat(sep=" ")
-                    elif isinstance(value, date):
-                        return value.isoformat()
-                    elif isinstance(value, time):
-                        return value.strftime("%H:%M:%S")
-                    elif isinstance(value, Decimal):
-                        return float(value)
-                    elif isinstance(value, uuid.UUID):
-                        return str(value)
-                    elif isinstance(value, timedelta):
-                        return str(value)
-                    return value
-
-                data = [
-                    dict((k, convert_value(v)) for k, v in row.items()) for row in data
-                ]
-                description = description["description"] if description else ""
-                return columns, row_count, data, description
+                params = []
+                if after:
+                    page_query += sql.SQL("WHERE ctid > %s::tid ")
+                    params = [after["ctid"]]
+                page_query += sql.SQL("ORDER BY ctid LIMIT %s")
+                params.append(page_size + 1)
+
+            # Stream the page through a server-side cursor so only itersize rows are buffered per round trip
+            with connection.cursor(name=f"table_details_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = min(page_size + 1, Config.TABLE_CURSOR_ITERSIZE)
+                cursor.execute(page_query, params)
+                data = list(islice(cursor, page_size + 1))
+            ctids = [row.pop(CTID_COLUMN) for row in data] if not primary_key else None
+
+            next_cursor = None
+            if len(data) > page_size:
+                data = data[:page_size]
+                if primary_key:
+                    position = {"key": [data[-1][column] for column in primary_key]}
+                else:
+                    position = {"ctid": ctids[page_size - 1]}
+                next_cursor = encode_page_cursor(position)
+
+            # Process the fetched data
+            columns = [
+                {"name": col["column_name"], "type": col["data_type"]}
+                for col in columns
+            ]
+
+            description = table_info.get("description") or ""
+            return columns, row_count, data, description, next_cursor
+    except PageCursorMismatch:
+        raise
     except Exception as e:
         print(f"Error fetching table details: {e}")
-        return None, None, None, None
+        return None, None, None, None, None
 
 
-# Extract table name from a query using regex
+# Extract the table a query writes to, or the first table it reads from
 def get_table_name(query):
-    pattern = (
-        r"insert\s+into\s+(\w+)|"  # Match "insert into <table>"
-        r"delete\s+from\s+(\w+)|"  # Match "delete from <table>"
-        r"update\s+(\w+)|"  # Match "update <table>"
-        r"from\s+(\w+)"  # Match "from <table>" (for select queries)
-    )
-    # Find regex matches in the query
-    match = re.search(pattern, query, re.IGNORECASE)
-    if match:
-        # Return the first non-null captured group
-        return next(group for group in match.groups() if group is not None)
-    else:
-        return ""
+    statement = parse_statement(query)
+    if statement.target:
+        return statement.target
+    return statement.tables[0] if statement.tables else ""
 
 
-# Extract the WHERE clause from DELETE query
+# Extract the WHERE clause of the query's main statement
 def get_where_clause(query):
-    pattern = r"where\s+(.+)"
-    match = re.search(pattern, query, re.IGNORECASE)
-    if match:
-        return match.group(1)
-    else:
-        return ""
+    return parse_statement(query).where
+
+
+# Append RETURNING * to an INSERT, UPDATE or DELETE so the affected rows come back with the statement
+# Statements that already have a RETURNING clause are left as they are; the clause goes on its own
+# line so a trailing -- comment does not swallow it
+def add_returning(query):
+    if parse_statement(query).has_clause("returning"):
+        return query
+    return f"{query.rstrip().rstrip(';').rstrip()}\nRETURNING *"
+
+
+# Classify a statement by its main verb, looking past any leading WITH clauses
+def get_statement_type(query):
+    return parse_statement(query).type
+
+
+# Split a plain UPDATE into its target, alias, SET, FROM and WHERE clauses
+# Returns None for statements it cannot take apart, such as ones with WITH or RETURNING
+def parse_update(query):
+    return parse_statement(query).update_parts()
+
+
+# Rewrite a plain UPDATE so a single round trip returns each row before and after the change
+# A CTE locks and snapshots the matching rows, and the UPDATE joins it on tableoid/ctid to return both images
+# Parts go on separate lines, since a clause taken from the statement may end in a -- comment
+def build_update_capture(query):
+    parts = parse_update(query)
+    if parts is None:
+        return None
+    reference = parts["alias"] or parts["target"].split(".")[-1]
+    # ONLY keeps rows of inheriting tables out of both the snapshot and the update
+    target = ("ONLY " if parts["only"] else "") + parts["target"]
+    target += f" AS {parts['alias']}" if parts["alias"] else ""
+    extra_from = f", {parts['from']}" if parts["from"] else ""
+    # Statements with their own FROM list need their WHERE again to join those tables
+    new_where = f" AND ({parts['where']})" if parts["from"] and parts["where"] else ""
+    return "\n".join(
+        part
+        for part in (
+            "WITH __old AS (",
+            f"SELECT {reference}.tableoid AS __tableoid, {reference}.ctid AS __ctid, to_jsonb({reference}) AS __row",
+            f"FROM {target}{extra_from}",
+            f"WHERE {parts['where']}" if parts["where"] else "",
+            f"FOR UPDATE OF {reference}",
+            "), __new AS (",
+            f"UPDATE {target} SET {parts['set']}",
+            f"FROM __old{extra_from}",
+            f"WHERE {reference}.tableoid = __old.__tableoid AND {reference}.ctid = __old.__ctid{new_where}",
+            f"RETURNING __old.__row AS before, to_jsonb({reference}) AS after",
+            ") SELECT before, after FROM __new",
+        )
+        if part
+    )
+
+
+# Parsed schemas keyed by connection ID, stored alongside the catalog fingerprint they were read at
+schema_cache = TTLCache(maxsize=Config.SCHEMA_CACHE_SIZE, ttl=Config.SCHEMA_CACHE_TTL)
+
+# Cheap summary of the catalogs fetch_db_schemas reads; DDL and COMMENT statements
+# write new catalog rows, which changes the row counts or xmin totals
+SCHEMA_FINGERPRINT_QUERY = """
+    SELECT concat_ws(
+        '|',
+        (SELECT count(*) || '.' || sum(xmin::text::bigint) FROM pg_catalog.pg_class),
+        (SELECT count(*) || '.' || sum(xmin::text::bigint) FROM pg_catalog.pg_attribute),
+        (SELECT count(*) || '.' || sum(xmin::text::bigint) FROM pg_catalog.pg_constraint),
+        (SELECT count(*) || '.' || sum(xmin::text::bigint) FROM pg_catalog.pg_description)
+    ) AS fingerprint;
+"""
 
 
-# Compare before and after states of a table to determine new rows that were added
-def get_new_rows(pre, post):
-    pre_set = set(tuple(row.items()) for row in pre)
-    post_set = set(tuple(row.items()) for row in post)
-    new_rows = [dict(row) for row in (post_set - pre_set)]
-    return new_rows
+# Columns of every accessible table, read straight from the system catalogs
+SCHEMA_COLUMNS_QUERY = """
+    SELECT
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        c.oid AS table_oid,
+        a.attnum,
+        a.attname AS column_name,
+        pg_catalog.format_type(a.atttypid, NULL) AS data_type,
+        NOT a.attnotnull AS is_nullable,
+        pg_catalog.pg_get_expr(ad.adbin, ad.adrelid) AS column_default,
+        d.description
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n
+        ON n.oid = c.relnamespace
+    JOIN pg_catalog.pg_attribute AS a
+        ON a.attrelid = c.oid
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+    LEFT JOIN pg_catalog.pg_attrdef AS ad
+        ON ad.adrelid = c.oid
+        AND ad.adnum = a.attnum
+    LEFT JOIN pg_catalog.pg_description AS d
+        ON d.objoid = c.oid
+        AND d.classoid = 'pg_catalog.pg_class'::regclass
+        AND d.objsubid = a.attnum
+    WHERE
+        c.relkind IN ('r', 'p')
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        AND n.nspname !~ '^pg_toast'
+        AND pg_catalog.has_table_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES')
+    ORDER BY
+        n.nspname, c.relname, a.attnum;
+"""
+
+# Primary and foreign key columns, one row per constrained column
+SCHEMA_CONSTRAINTS_QUERY = """
+    SELECT
+        con.conrelid AS table_oid,
+        con.contype,
+        k.attnum,
+        fn.nspname || '.' || fc.relname AS foreign_table,
+        fa.attname AS foreign_column
+    FROM pg_catalog.pg_constraint AS con
+    JOIN pg_catalog.pg_namespace AS n
+        ON n.oid = con.connamespace
+    CROSS JOIN LATERAL unnest(con.conkey, con.confkey) AS k(attnum, foreign_attnum)
+    LEFT JOIN pg_catalog.pg_class AS fc
+        ON fc.oid = con.confrelid
+    LEFT JOIN pg_catalog.pg_namespace AS fn
+        ON fn.oid = fc.relnamespace
+    LEFT JOIN pg_catalog.pg_attribute AS fa
+        ON fa.attrelid = con.confrelid
+        AND fa.attnum = k.foreign_attnum
+    WHERE
+        con.contype IN ('p', 'f')
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    ORDER BY
+        con.conrelid, con.conname;
+"""
+
+
+# Build the schema dict from the catalog rows in a single pass over each result set
+def build_schema(column_rows, constraint_rows):
+    schema = {}
+    columns_by_key = {}
+    for row in column_rows:
+        tables = schema.setdefault(row["table_schema"], {})
+        column = {
+            "name": row["column_name"],
+            "type": row["data_type"],
+            "nullable": row["is_nullable"],
+            "default": row["column_default"],
+            "primary_key": False,
+            "foreign_keys": [],
+            "description": row["description"],
+        }
+        tables.setdefault(row["table_name"], []).append(column)
+        columns_by_key[(row["table_oid"], row["attnum"])] = column
+
+    seen_foreign_keys = set()
+    for row in constraint_rows:
+        column = columns_by_key.get((row["table_oid"], row["attnum"]))
+        # Constraints on tables the user cannot see have no matching column
+        if column is None:
+            continue
+        if row["contype"] == "p":
+            column["primary_key"] = True
+            column["nullable"] = False  # Ensure PK is not nullable
+        elif row["foreign_table"] and row["foreign_column"]:
+            fk_key = (id(column), row["foreign_table"], row["foreign_column"])
+            if fk_key not in seen_foreign_keys:
+                seen_foreign_keys.add(fk_key)
+                column["foreign_keys"].append(
+                    {"table": row["foreign_table"], "column": row["foreign_column"]}
+                )
+    return schema
+
+
+# Carry over the column lists of tables that did not change since the previous schema,
+# so per-table work keyed on those lists (such as rendered prompt fragments) is reused
+def reuse_unchanged_tables(previous, schema):
+    for schema_name, tables in schema.items():
+        previous_tables = previous.get(schema_name, {})
+        for table, columns in tables.items():
+            previous_columns = previous_tables.get(table)
+            if previous_columns == columns:
+                tables[table] = previous_columns
+    return schema
+
+
+# Drop the cached schema for a connection so the next fetch reads the catalogs again
+def invalidate_schema_cache(connection_id):
+    schema_cache.pop(str(connection_id))
 
 
 # Fetch schema data for all accessible schemas in the database, excluding views
-def fetch_db_schemas(connection_id):
+# Served from schema_cache while the catalog fingerprint is unchanged, unless refresh is set
+def fetch_db_schemas(connection_id, refresh=False):
+    key = str(connection_id)
     try:
-        with get_db_connection(connection_id) as connection, connection.cursor(
+        with get_db_connection(connection_id, readonly=True) as connection, connection.cursor(
             cursor_factory=psycopg2.extras.RealDictCursor
         ) as cursor:
-            schema_query = """
-                SELECT
-                    cols.table_schema,
-                    cols.table_name,
-                    cols.column_name,
-                    cols.data_type,
-                    cols.is_nullable,
-                    cols.column_default,
-                    ARRAY_AGG(DISTINCT tc.constraint_type) AS constraint_types,
-                    ARRAY_AGG(DISTINCT ccu_cc.table_schema || '.' || ccu_cc.table_name) FILTER (WHERE tc.constraint_type = 'FOREIGN KEY') AS foreign_tables,
-                    ARRAY_AGG(DISTINCT ccu_cc.column_name) FILTER (WHERE tc.constraint_type = 'FOREIGN KEY') AS foreign_columns,
-                    pgd.description,
-                    tbl.table_type
-                FROM
-                    information_schema.columns AS cols
-                LEFT JOIN
-                    information_schema.key_column_usage AS kcu
-                    ON cols.table_schema = kcu.table_schema
-                    AND cols.table_name = kcu.table_name
-                    AND cols.column_name = kcu.column_name
-                LEFT JOIN
-                    information_schema.table_constraints AS tc
-                    ON tc.table_schema = kcu.table_schema
-                    AND tc.table_name = kcu.table_name
-                    AND tc.constraint_name = kcu.constraint_name
-                LEFT JOIN
-                    information_schema.referential_constraints AS rc
-                    ON rc.constraint_schema = tc.constraint_schema
-                    AND rc.constraint_name = tc.constraint_name
-                LEFT JOIN
-                    information_schema.key_column_usage AS ccu_cc
-                    ON ccu_cc.constraint_schema = rc.unique_constraint_schema
-                    AND ccu_cc.constraint_name = rc.unique_constraint_name
-                    AND ccu_cc.ordinal_position = kcu.position_in_unique_constraint
-                LEFT JOIN
-                    pg_catalog.pg_statio_all_tables AS st
-                    ON st.schemaname = cols.table_schema
-                    AND st.relname = cols.table_name
-                LEFT JOIN
-                    pg_catalog.pg_description AS pgd
-                    ON pgd.objoid = st.relid
-                    AND pgd.objsubid = cols.ordinal_position
-                LEFT JOIN
-                    information_schema.tables AS tbl
-                    ON cols.table_schema = tbl.table_schema
-                    AND cols.table_name = tbl.table_name
-                WHERE
-                    cols.table_schema NOT IN ('pg_catalog', 'information_schema')
-                    AND tbl.table_type = 'BASE TABLE'
-                GROUP BY
-                    cols.table_schema,
-                    cols.table_name,
-                    cols.column_name,
-                    cols.data_type,
-                    cols.is_nullable,
-                    cols.column_default,
-                    pgd.description,
-                    tbl.table_type,
-                    cols.ordinal_position
-                ORDER BY
-                    cols.table_schema, cols.table_name, cols.ordinal_position;
-            """
-
-            cursor.execute(schema_query)
-            schema = defaultdict(lambda: defaultdict(dict))
-
-            for row in cursor.fetchall():
-                schema_name = row["table_schema"]
-                table = row["table_name"]
-                column = row["column_name"]
-
-                if column not in schema[schema_name][table]:
-                    schema[schema_name][table][column] = {
-                        "name": column,
-                        "type": row["data_type"],
-                        "nullable": row["is_nullable"] == "YES",
-                        "default": row["column_default"],
-                        "primary_key": False,
-                        "foreign_keys": [],
-                        "description": row["description"],
-                    }
-
-                # Handle Primary Key
-                constraint_types = row["constraint_types"]
-                if constraint_types and "PRIMARY KEY" in constraint_types:
-                    schema[schema_name][table][column]["primary_key"] = True
-                    schema[schema_name][table][column][
-                        "nullable"
-                    ] = False  # Ensure PK is not nullable
-
-                # Handle Foreign Keys
-                foreign_tables = row["foreign_tables"]
-                foreign_columns = row["foreign_columns"]
-
-                # Convert foreign_tables and foreign_columns to lists if they are strings
-                if isinstance(foreign_tables, str):
-                    foreign_tables = (
-                        foreign_tables.strip("{}").split(",") if foreign_tables else []
-                    )
-                if isinstance(foreign_columns, str):
-                    foreign_columns = (
-                        foreign_columns.strip("{}").split(",")
-                        if foreign_columns
-                        else []
-                    )
+            cursor.execute(SCHEMA_FINGERPRINT_QUERY)
+            fingerprint = cursor.fetchone()["fingerprint"]
+            previous = schema_cache.peek(key)
+            if not refresh:
+                cached = schema_cache.get(
+                    key, validate=lambda entry: entry[0] == fingerprint
+                )
+                if cached is not None:
+                    return cached[1]
 
-                if foreign_tables and foreign_columns:
-                    for foreign_table, foreign_column in zip(
-                        foreign_tables, foreign_columns
-                    ):
-                        foreign_table = (
-                            foreign_table.strip()
-                            if isinstance(foreign_table, str)
-                            else foreign_table
-                        )
-                        foreign_column = (
-                            foreign_column.strip()
-                            if isinstance(foreign_column, str)
-                            else foreign_column
-                        )
-                        if foreign_table and foreign_column:
-                            fk = {
-                                "table": foreign_table,
-                                "column": foreign_column,
-                            }
-                            if (
-                                fk
-                                not in schema[schema_name][table][column][
-                                    "foreign_keys"
-                                ]
-                            ):
-                                schema[schema_name][table][column][
-                                    "foreign_keys"
-                                ].append(fk)
-
-            # Convert defaultdict to regular dict
-            final_schema = {
-                schema_name: {
-                    table: list(columns.values()) for table, columns in tables.items()
-                }
-                for schema_name, tables in schema.items()
-            }
+            cursor.execute(SCHEMA_COLUMNS_QUERY)
+            column_rows = cursor.fetchall()
+            cursor.execute(SCHEMA_CONSTRAINTS_QUERY)
+            constraint_rows = cursor.fetchall()
+            final_schema = build_schema(column_rows, constraint_rows)
+            if previous is not None:
+                reuse_unchanged_tables(previous[1], final_schema)
 
+            schema_cache.set(key, (fingerprint, final_schema))
             return final_schema
 
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
+
+
+# Tables (attnum 0) and columns without a pg_description row, across the same tables
+# fetch_db_schemas lists, in one anti-join rather than a description lookup per row
+MISSING_DESCRIPTIONS_QUERY = """
+    SELECT
+        n.nspname AS table_schema,
+        c.relname AS table_name,
+        a.attname AS column_name
+    FROM pg_catalog.pg_class AS c
+    JOIN pg_catalog.pg_namespace AS n
+        ON n.oid = c.relnamespace
+    CROSS JOIN LATERAL (
+        SELECT 0 AS attnum, NULL::name AS attname
+        UNION ALL
+        SELECT attnum, attname
+        FROM pg_catalog.pg_attribute
+        WHERE attrelid = c.oid
+            AND attnum > 0
+            AND NOT attisdropped
+    ) AS a
+    LEFT JOIN pg_catalog.pg_description AS d
+        ON d.objoid = c.oid
+        AND d.classoid = 'pg_catalog.pg_class'::regclass
+        AND d.objsubid = a.attnum
+    WHERE
+        d.objoid IS NULL
+        AND c.relkind IN ('r', 'p')
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        AND n.nspname !~ '^pg_toast'
+        AND pg_catalog.has_table_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES')
+    ORDER BY
+        n.nspname, c.relname, a.attnum;
+"""
+
+
+# Find the tables and columns that have no description, in every schema the user can see
+# Returns {"schema.table": {"table": bool, "columns": [column names]}} for tables missing anything
+def fetch_missing_descriptions(connection_id):
+    with get_db_connection(connection_id, readonly=True) as connection, connection.cursor(
+        cursor_factory=psycopg2.extras.RealDictCursor
+    ) as cursor:
+        cursor.execute(MISSING_DESCRIPTIONS_QUERY)
+        rows = cursor.fetchall()
+    return build_missing_descriptions(rows)
+
+
+def build_missing_descriptions(rows):
+    missing = {}
+    for row in rows:
+        entry = missing.setdefault(
+            f"{row['table_schema']}.{row['table_name']}", {"table": False, "columns": []}
+        )
+        if row["column_name"] is None:
+            entry["table"] = True
+        else:
+            entry["columns"].append(row["column_name"])
+    return missing
+
+
+# Run statements in one transaction with a single multi-statement call
+# If that fails, they are retried one at a time under a savepoint so a bad statement is skipped
+# rather than losing the rest; returns the skipped statements
+def apply_statements(connection_id, statements):
+    skipped = []
+    with get_db_connection(connection_id) as connection, connection.cursor() as cursor:
+        try:
+            # Each separator on its own line, so a statement's trailing -- comment cannot swallow it
+            cursor.execute("\n;\n".join(statements))
+        except psycopg2.Error:
+            connection.rollback()
+            for statement in statements:
+                cursor.execute("SAVEPOINT apply_statement")
+                try:
+                    cursor.execute(statement)
+                except psycopg2.Error:
+                    cursor.execute("ROLLBACK TO SAVEPOINT apply_statement")
+                    skipped.append(statement)
+                else:
+                    cursor.execute("RELEASE SAVEPOINT apply_statement")
+    replica_router.record_write(connection_id)
+    for statement in statements:
+        if statement not in skipped:
+            result_cache.invalidate_statement(connection_id, statement)
+    return skipped